@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic-data benchmarks for the coastline pipeline stages.
+
+Builds NSIDC-like polar stereographic concentration GeoTIFFs (EPSG:3413
+and 3412, with the 2510/2530/2540/2550 class values), synthetic footprint
+tables with acq_time dates and a synthetic coastline, then times
+resample_nodata / resample_loop, sea-ice sampling and the coastline
+proximity selection at several scales. Results are written as JSON so
+runs can be compared for regressions.
+
+e.g. python benchmark_coastline.py --sizes 1000 10000 100000 --out bench.json
+"""
+
+import argparse
+from datetime import date, datetime, timedelta
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal, osr
+import shapely
+
+try:
+    import resource
+except ImportError:
+    ## Not available on Windows
+    resource = None
+
+from coastline_proximity import CoastlineIndex, segment_coastline, select_near_coast
+from pipeline_metrics import setup_logging
+from sea_ice_index import RasterIndex
+from sea_ice_nodata import NODATA_VALUES, resample_loop, resample_nodata
+from sea_ice_sampling import file_raster_source, sample_sea_ice
+
+
+gdal.UseExceptions()
+
+logger = logging.getLogger(__name__)
+
+
+## NSIDC 25 km polar stereographic grids
+GRIDS = {
+        'north': {'epsg': 3413, 'prefix': 'N', 'shape': (448, 304),
+                  'geotransform': (-3850000.0, 25000.0, 0.0, 5850000.0, 0.0, -25000.0)},
+        'south': {'epsg': 3412, 'prefix': 'S', 'shape': (332, 316),
+                  'geotransform': (-3950000.0, 25000.0, 0.0, 4350000.0, 0.0, -25000.0)},
+        }
+
+
+def peak_rss():
+    '''
+    Peak resident set sizes so far, in MB, or None where they cannot be
+    measured on this platform. Both are high-water marks over the whole
+    benchmark run, not per stage: cumulative_peak_rss_mb is this process,
+    cumulative_peak_child_rss_mb the largest finished worker process (e.g.
+    of resample_loop's or select_near_coast's pool).
+    '''
+    if resource is None:
+        return {'cumulative_peak_rss_mb': None, 'cumulative_peak_child_rss_mb': None}
+    ## ru_maxrss is bytes on macOS, kilobytes elsewhere
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+
+    return {'cumulative_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            'cumulative_peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+
+def synthetic_concentration(shape, day, rng):
+    '''
+    Returns an int16 concentration grid with land, coast, missing and pole
+    hole class values around an ice pack that grows and shrinks with day.
+    '''
+    rows, cols = np.indices(shape)
+    centre_r, centre_c = shape[0] / 2, shape[1] / 2
+    radius = np.hypot(rows - centre_r, cols - centre_c)
+    ice_edge = shape[1] * (0.3 + 0.1 * np.sin(2 * np.pi * day / 365))
+
+    arr = np.clip(1000 - (radius - ice_edge) * 40, 0, 1000).astype(np.int16)
+    arr[radius > ice_edge * 1.3] = 0
+    arr += rng.integers(-20, 20, size=shape, dtype=np.int16)
+    arr = np.clip(arr, 0, 1000)
+    ## Land on one side with a coast edge, a pole hole and scattered missing cells
+    land = cols < shape[1] * 0.15
+    arr[land] = 2540
+    arr[(cols >= shape[1] * 0.15) & (cols < shape[1] * 0.15 + 2)] = 2530
+    arr[radius < 3] = 2510
+    arr[rng.random(shape) < 0.001] = 2550
+
+    return arr
+
+
+def make_synthetic_rasters(out_dir, hemisphere, days, start=date(2019, 1, 1), seed=0):
+    '''
+    Writes days of synthetic daily concentration GeoTIFFs in the NSIDC
+    {hemisphere}/daily/geotiff/YYYY/MM_Mon layout. Returns the paths.
+    '''
+    grid = GRIDS[hemisphere]
+    rng = np.random.default_rng(seed)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(grid['epsg'])
+    driver = gdal.GetDriverByName('GTiff')
+
+    paths = []
+    for i in range(days):
+        day = start + timedelta(days=i)
+        month_dir = os.path.join(out_dir, hemisphere, 'daily', 'geotiff', day.strftime('%Y'), day.strftime('%m_%b'))
+        os.makedirs(month_dir, exist_ok=True)
+        raster_p = os.path.join(month_dir, '{}_{}_concentration_v3.0.tif'.format(grid['prefix'], day.strftime('%Y%m%d')))
+        ds = driver.Create(raster_p, grid['shape'][1], grid['shape'][0], 1, gdal.GDT_UInt16)
+        ds.SetGeoTransform(grid['geotransform'])
+        ds.SetProjection(srs.ExportToWkt())
+        ds.GetRasterBand(1).WriteArray(synthetic_concentration(grid['shape'], day.timetuple().tm_yday, rng))
+        ds = None
+        paths.append(raster_p)
+
+    return paths
+
+
+def synthetic_footprints(n, days, start=date(2019, 1, 1), seed=0):
+    '''
+    Returns a dictionary of n synthetic footprints: centroid lon/lat (half
+    each pole, some non-polar), acq_time strings and WKB polygons of about
+    15 x 15 km.
+    '''
+    rng = np.random.default_rng(seed)
+    lons = rng.uniform(-180, 180, n)
+    lats = rng.uniform(55, 85, n) * rng.choice([1, -1], n)
+    nonpolar = rng.random(n) < 0.1
+    lats[nonpolar] = rng.uniform(-45, 45, nonpolar.sum())
+    offsets = rng.integers(0, days, n)
+    acq_times = np.array(['{} 12:00:00'.format(start + timedelta(days=int(o))) for o in offsets])
+
+    half_lat = 7.5 / 110.5
+    half_lon = half_lat / np.maximum(np.cos(np.radians(lats)), 0.05)
+    polygons = shapely.box(lons - half_lon, lats - half_lat, lons + half_lon, lats + half_lat)
+
+    return {'lon': lons, 'lat': lats, 'acq_time': acq_times, 'wkb': shapely.to_wkb(polygons)}
+
+
+def synthetic_coastline(seed=0):
+    '''
+    Returns a wiggly circumpolar coastline around each pole plus a few
+    mid-latitude islands, as shapely geometries in WGS84.
+    '''
+    rng = np.random.default_rng(seed)
+    lons = np.linspace(-180, 180, 20000)
+    lines = [shapely.LineString(np.column_stack([lons, lat + np.sin(np.radians(lons) * 40) + rng.normal(0, 0.05, lons.size)]))
+             for lat in (68, -68)]
+    islands = [shapely.Point(lon, lat).buffer(0.5, quad_segs=32) for lon, lat in rng.uniform([-180, -40], [180, 40], (20, 2))]
+
+    return np.array(lines + islands, dtype=object)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = fn(*args, **kwargs)
+
+    return result, time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def bench_resample(work_dir, days, processes):
+    results = []
+    src_dir = os.path.join(work_dir, 'raw')
+    paths = make_synthetic_rasters(src_dir, 'north', days) + make_synthetic_rasters(src_dir, 'south', days)
+
+    out_dir = os.path.join(work_dir, 'resampled_single')
+    nodata = NODATA_VALUES['_concentration_v3.0.tif']
+    def single():
+        for p in paths:
+            resample_nodata(p, *nodata, out_path=os.path.join(out_dir, os.path.relpath(p, src_dir)), out_nodata=-9999)
+    _, wall, cpu = timed(single)
+    results.append({'stage': 'resample_nodata', 'files': len(paths), 'wall_s': wall, 'cpu_s': cpu,
+                    'files_per_s': len(paths) / wall, **peak_rss()})
+
+    out_dir = os.path.join(work_dir, 'resampled')
+    _, wall, cpu = timed(resample_loop, src_dir, out_dir=out_dir, last_update='1978-01-01',
+                         out_nodata=-9999, processes=processes)
+    results.append({'stage': 'resample_loop', 'files': len(paths), 'processes': processes, 'wall_s': wall,
+                    'cpu_s': cpu, 'files_per_s': len(paths) / wall, **peak_rss()})
+
+    return results, out_dir
+
+
+def bench_sampling(resampled_dir, sizes, days):
+    results = []
+    indexes = {}
+    for pole, hemisphere in (('arctic', 'north'), ('antarctic', 'south')):
+        indexes[pole] = RasterIndex()
+        indexes[pole].refresh(os.path.join(resampled_dir, hemisphere))
+    def raster_lookup(pole, date):
+        return indexes[pole].lookup(date)
+
+    for n in sizes:
+        fps = synthetic_footprints(n, days)
+        _, wall, cpu = timed(sample_sea_ice, fps['lon'], fps['lat'], fps['acq_time'], file_raster_source(raster_lookup))
+        results.append({'stage': 'sample_sea_ice', 'rows': n, 'wall_s': wall, 'cpu_s': cpu,
+                        'rows_per_s': n / wall, **peak_rss()})
+
+    return results
+
+
+def bench_proximity(sizes, days, distance, processes):
+    results = []
+    coast_index, wall, cpu = timed(CoastlineIndex, segment_coastline(synthetic_coastline()))
+    results.append({'stage': 'coastline_index', 'segments': int(coast_index.segments.size), 'wall_s': wall,
+                    'cpu_s': cpu, **peak_rss()})
+    for n in sizes:
+        fps = synthetic_footprints(n, days)
+        near, wall, cpu = timed(select_near_coast, fps['wkb'], coast_index, distance, processes=processes)
+        results.append({'stage': 'select_near_coast', 'rows': n, 'selected': int(near.sum()), 'distance_km': distance,
+                        'processes': processes, 'wall_s': wall, 'cpu_s': cpu, 'rows_per_s': n / wall,
+                        **peak_rss()})
+
+    return results
+
+
+def run_benchmarks(sizes, days, processes, distance, work_dir=None):
+    '''
+    Runs every benchmark, returning a JSON-serialisable dictionary of results.
+    '''
+    cleanup = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='coastline_bench_')
+    try:
+        resample_results, resampled_dir = bench_resample(work_dir, days, processes)
+        results = (resample_results
+                   + bench_sampling(resampled_dir, sizes, days)
+                   + bench_proximity(sizes, days, distance, processes))
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+            'run': datetime.now().isoformat(timespec='seconds'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'gdal': gdal.__version__,
+            'sizes': sizes,
+            'days': days,
+            'results': results,
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of synthetic footprints to benchmark. Default = 1000 10000 100000')
+    parser.add_argument('--days', type=int, default=30,
+                        help='Days of synthetic rasters per pole. Default = 30')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='Worker processes for the parallel stages. Default = 4')
+    parser.add_argument('--distance', type=float, default=10,
+                        help='Coastline search distance in km. Default = 10')
+    parser.add_argument('--work_dir', type=str,
+                        help='Directory for synthetic data, kept after the run. Default = a temporary directory')
+    parser.add_argument('--out', type=str,
+                        help='Path to write JSON results to. Default = print to stdout')
+
+    args = parser.parse_args()
+
+    setup_logging(logging.WARNING)
+    report = run_benchmarks(args.sizes, args.days, args.processes, args.distance, work_dir=args.work_dir)
+    if args.out:
+        with open(args.out, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -14,12 +14,15 @@ Selects footprints from the master footprint that meet the following criteria:
 
 import arcpy
 
-import os, logging, sys, pickle
+import os, logging, sys
 #import geopandas as gpd
-import pandas as pd
+import numpy as np
 #from tqdm import tqdm
 
-from query_danco import query_footprint
+from coastline_proximity import CoastlineIndex, select_near_coast
+from coastline_selection import ID_COL_LUT, selection_clause
+from pipeline_metrics import RunMetrics, setup_logging
+from stereo_exclusion import MaxOnaCache
 
 #
 ##### Paths to source data
@@ -38,7 +41,31 @@ from query_danco import query_footprint
 #out_name = 'nasa_global_coastline_candidates'
 
 
-def coastline_candidates(src, gdb, wd, coast_n, distance, out_name):
+def source_path(src):
+    '''
+    Returns the path to the 'mfp' or 'nasa' source footprint, None for 'dg',
+    which is read through a database connection.
+    '''
+    if src == 'mfp':
+        try:
+            sys.path.insert(0, r'C:\pgc-code-all\misc_utils')
+            from id_parse_utils import pgc_index_path
+            src_p = pgc_index_path()
+        except ImportError:
+            src_p = r'C:\pgc_index\pgcImageryIndexV6_2019aug28.gdb\pgcImageryIndexV6_2019aug28'
+            print('Could not load updated index. Using last known path: {}'.format(src_p))
+        
+        # src_p = r'C:\pgc_index\pgcImageryIndexV6_2019jun06.gdb\pgcImageryIndexV6_2019jun06'
+    elif src == 'nasa':
+        src_p = r'C:\pgc_index\nga_inventory_canon20190505\nga_inventory_canon20190505.gdb\nga_inventory_canon20190505'
+    else:
+        src_p = None
+
+    return src_p
+
+
+def coastline_candidates(src, gdb, wd, coast_n, distance, out_name, engine='arcpy', processes=4,
+                         update_max_ona=False, max_ona_changed_col=None, metrics_p=None, profile=False):
     '''
     Selects initial candidates for coastline analysis.
     src: 'mfp', 'nasa', or 'dg' - chooses the footprint to use.
@@ -47,101 +74,19 @@ def coastline_candidates(src, gdb, wd, coast_n, distance, out_name):
     coast_n: name of coastline in project geodatabase
     distace: search distance from coastline
     out_name: feature class name to write inital candidates out as
+    engine: 'arcpy' to select by location with arcpy, 'ogr' to use the
+            GDAL/shapely engine in coastline_proximity.py
+    processes: number of worker processes for the 'ogr' engine
+    update_max_ona: pull stereopairs added since the last refresh into the
+                    max off nadir id cache
+    max_ona_changed_col: ingest or modification timestamp column of the
+                         stereo layer, to refresh the cache incrementally
+    metrics_p: path to write per-stage timings and row counts to as JSON
+    profile: also save a cProfile of the run next to metrics_p
     '''
     #### Logging
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    
-    
-    def get_max_ona_ids(update=False, where=None, wd=wd):
-        '''
-        Gets a list of those ids with the higher off nadir angle out of the stereopair
-        where: SQL query to reduce load times if only specific records are needed. E.g. "platform in ('WV02', 'WV03')"
-        '''
-        if update:
-            # Load min ona footprint
-            min_ona = query_footprint(layer='dg_stereo_catalogids_having_min_ona',
-                                      columns=['catalogid'],
-                                      where=where)
-            # Load all stereo footprint with stereopair column
-            all_str = query_footprint(layer='dg_imagery_index_stereo_onhand_cc20',
-                                      columns=['catalogid', 'stereopair'],
-                                      where=where)
-            
-            # Finds only min_ona ids listed as 'catalogid' in stereo footprint
-            min_ona_pairs1 = pd.merge(min_ona, all_str, on='catalogid', how='inner')
-            max_ona_ids1 = min_ona_pairs1['stereopair']
-            
-            # Finds only min_ona ids listed as 'stereopair' in stereo footprint
-            min_ona_pairs2 = pd.merge(min_ona, all_str, left_on='catalogid', right_on='stereopair', suffixes=('_l', '_r'))
-            max_ona_ids2 = min_ona_pairs2['catalogid_r']
-            
-            # Add two lists together, return unique ids (they all should be...) as a list
-            max_ona_ids = pd.concat([max_ona_ids1, max_ona_ids2])
-            max_ona_ids = max_ona_ids.unique()
-            max_ona_ids = list(max_ona_ids)
-            
-            with open(os.path.join(wd, 'pickles', 'max_ona_ids.pkl'), 'wb') as pkl:
-                pickle.dump(max_ona_ids, pkl)
-        
-        else:
-            with open(os.path.join(wd, 'pickles', 'max_ona_ids.pkl'), 'rb') as pkl:
-                max_ona_ids = pickle.load(pkl)
-        
-        return tuple(max_ona_ids)
-    
-    
-    def selection_clause(src):
-        '''
-        Returns the selection criteria for a given source, master footprint or dg footprint
-        src: str 'mfp' or 'dg'
-        '''
-        #### Selection criteria
-#        status = 'online' ## Not currently being used
-        cloudcover = 0.2
-        sensors = ('WV02', 'WV03')
-        prod_code = 'M1BS'
-        abscalfact = 'NOT NULL'
-        bandwith = 'NOT NULL'
-        sun_elev = 'NOT NULL'
-        max_ona = get_max_ona_ids()
-    
-        if src == 'mfp':
-            where = f"""(cloudcover <= {cloudcover}) 
-                AND (sensor IN {sensors})
-                AND (prod_code = '{prod_code}')
-                AND (abscalfact IS {abscalfact}) 
-                AND (bandwidth IS {bandwith}) 
-                AND (sun_elev IS {sun_elev})
-                AND (catalog_id NOT IN {max_ona})"""
-    #           AND (status = {status})"""
-    
-        elif src == 'dg':
-            where = f"""(cloudcover <= {int(cloudcover*100)})
-                AND (platform IN {sensors})
-                AND (catalogid NOT IN {max_ona})"""
-        
-        elif src == 'nasa':
-            where = f"""(CLOUDCOVER <= {cloudcover}) 
-                AND (SENSOR IN {sensors}) 
-                AND (PROD_CODE = '{prod_code}')
-                AND (ABSCALFACT IS {abscalfact}) 
-                AND (BANDWIDTH IS {bandwith}) 
-                AND (SUN_ELEV IS {sun_elev})
-                AND (CATALOG_ID NOT IN {max_ona})"""
-    #            AND (status = {status})"""
-                
-        else:
-            print('Unknown source for selection_clause(), must be one of "mfp" or "dg"')
-            sys.exit()
-    
-        return where
+    logger = setup_logging()
+    metrics = RunMetrics('coastline_candidates', profile=profile)
     
     
     def danco_footprint_connection(layer):
@@ -175,7 +120,8 @@ def coastline_candidates(src, gdb, wd, coast_n, distance, out_name):
         count = int(arcpy.GetCount_management(feat)[0])
         if count == 0:
             logger.info('No features in selection. Exiting.')
-            del selection
+            if metrics_p:
+                metrics.write(metrics_p)
             sys.exit()
         else:
             return count
@@ -188,50 +134,97 @@ def coastline_candidates(src, gdb, wd, coast_n, distance, out_name):
     
     #### Load src footprint, using coastline selection criteria
     logger.info('Loading source footprint.')
-    if src == 'mfp':
-
-        try:
-            sys.path.insert(0, r'C:\pgc-code-all\misc_utils')
-            from id_parse_utils import pgc_index_path
-            src_p = pgc_index_path()
-        except ImportError:
-            src_p = r'C:\pgc_index\pgcImageryIndexV6_2019aug28.gdb\pgcImageryIndexV6_2019aug28'
-            print('Could not load updated index. Using last known path: {}'.format(imagery_index))
-        
-        # src_p = r'C:\pgc_index\pgcImageryIndexV6_2019jun06.gdb\pgcImageryIndexV6_2019jun06'
-    elif src == 'dg':
+    if src == 'dg':
         src_p = danco_footprint_connection('index_dg')
-    elif src == 'nasa':
-        src_p = r'C:\pgc_index\nga_inventory_canon20190505\nga_inventory_canon20190505.gdb\nga_inventory_canon20190505'
+    else:
+        src_p = source_path(src)
         
     
     #### Select by criteria
     logger.info('Selecting based on criteria.')
     intermed_fc = 'memory\{}_intermed'.format(src)
-    selection = arcpy.MakeFeatureLayer_management(src_p, os.path.join(gdb, intermed_fc), where_clause=selection_clause(src))
-       
-    count = count_or_no_results_exit(selection)
+    with metrics.stage('query'):
+        selection = arcpy.MakeFeatureLayer_management(src_p, os.path.join(gdb, intermed_fc), where_clause=selection_clause(src))
+        count = count_or_no_results_exit(selection)
+    metrics.count('rows_selected', count)
     
     logger.info('Features selected: {}'.format(count))
     logger.info('Writing intermediate selection...')
-    selection = arcpy.CopyFeatures_management(selection, os.path.join(gdb, 'intermed_sel2'))
+    intermed_p = os.path.join(gdb, 'intermed_sel2')
+    with metrics.stage('attribute_select'):
+        arcpy.CopyFeatures_management(selection, intermed_p)
+    
+    
+    #### Drop the higher off nadir angle id of each stereopair
+    logger.info('Removing max off nadir stereopair ids.')
+    with metrics.stage('max_ona_select'):
+        max_ona = MaxOnaCache(wd)
+        if update_max_ona or len(max_ona) == 0:
+            max_ona.refresh(changed_col=max_ona_changed_col)
+        oids, ids = [], []
+        with arcpy.da.SearchCursor(intermed_p, ['OID@', ID_COL_LUT[src]]) as cursor:
+            for row in cursor:
+                oids.append(row[0])
+                ids.append(row[1])
+        excluded_oids = set(np.array(oids)[max_ona.excluded(ids)].tolist())
+        with arcpy.da.UpdateCursor(intermed_p, ['OID@']) as cursor:
+            for row in cursor:
+                if row[0] in excluded_oids:
+                    cursor.deleteRow()
+    logger.info('Max off nadir ids removed: {}'.format(len(excluded_oids)))
+    metrics.count('rows_max_ona_removed', len(excluded_oids))
+    
+    intermed_fc = 'memory\{}_intermed_sel2'.format(src)
+    selection = arcpy.MakeFeatureLayer_management(intermed_p, os.path.join(gdb, intermed_fc))
+    count = count_or_no_results_exit(selection)
     
     
     #### Select only footprints that are within 10 km of coastline
     logger.info('Identifying footprints within {} kilometers of coastline.'.format(distance))
-    selection = arcpy.SelectLayerByLocation_management(os.path.join(gdb, intermed_fc), 
-                                                       overlap_type='INTERSECT',
-                                                       select_features=noaa_coast_p,
-                                                       search_distance=f'{distance} Kilometers',
-                                                       selection_type='NEW_SELECTION')
-    
-    count = count_or_no_results_exit(selection)
-    logger.info('Features selected: {}'.format(count))
-    
-    ##### Write to new feature class
-    logger.info('Writing final candidates to feature class.')
-    arcpy.CopyFeatures_management(selection, out_feature_class=os.path.join(gdb, out_name))
-    logger.info('Features selected: {}'.format(arcpy.GetCount_management(selection)))
-    
+    out_fc = os.path.join(gdb, out_name)
+    if engine == 'ogr':
+        ## Exact distances with GDAL/shapely, then drop the far footprints from a copy
+        with metrics.stage('proximity_select'):
+            ## Distance grid pre-screen, rebuilt only when the coastline changes
+            coast_index = CoastlineIndex.from_path(gdb, layer=coast_n,
+                                                   grid_p=os.path.join(wd, 'pickles', '{}_distance_grid.npz'.format(coast_n)))
+            arcpy.CopyFeatures_management(selection, out_feature_class=out_fc)
+            oids, wkbs = [], []
+            with arcpy.da.SearchCursor(out_fc, ['OID@', 'SHAPE@WKB'], spatial_reference=arcpy.SpatialReference(4326)) as cursor:
+                for row in cursor:
+                    oids.append(row[0])
+                    wkbs.append(bytes(row[1]))
+            near = select_near_coast(wkbs, coast_index, distance, processes=processes)
+            near_oids = set(np.array(oids)[near].tolist())
+        
+        logger.info('Writing final candidates to feature class.')
+        with metrics.stage('write'):
+            with arcpy.da.UpdateCursor(out_fc, ['OID@']) as cursor:
+                for row in cursor:
+                    if row[0] not in near_oids:
+                        cursor.deleteRow()
+            count = count_or_no_results_exit(out_fc)
+        logger.info('Features selected: {}'.format(count))
+        
+    else:
+        with metrics.stage('proximity_select'):
+            selection = arcpy.SelectLayerByLocation_management(os.path.join(gdb, intermed_fc), 
+                                                               overlap_type='INTERSECT',
+                                                               select_features=noaa_coast_p,
+                                                               search_distance=f'{distance} Kilometers',
+                                                               selection_type='NEW_SELECTION')
+            count = count_or_no_results_exit(selection)
+        logger.info('Features selected: {}'.format(count))
+        
+        ##### Write to new feature class
+        logger.info('Writing final candidates to feature class.')
+        with metrics.stage('write'):
+            arcpy.CopyFeatures_management(selection, out_feature_class=out_fc)
+        logger.info('Features selected: {}'.format(arcpy.GetCount_management(selection)))
+    metrics.count('rows_out', count)
+    
+    metrics.log()
+    if metrics_p:
+        metrics.write(metrics_p)
     logger.info('Done.')
 
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed distance-to-coastline grid for pre-screening footprints.
+
+The coastline is densified to points at most spacing_km apart and held in
+a KD-tree of unit vectors, so distances are great-circle distances with no
+antimeridian or polar special cases. The distance from every cell centre
+of a coarse global grid is stored, and coarse cells near the coast are
+refined into blocks of finer cells. Each cell gives bounds on the distance
+from any point in it: the centre distance plus or minus the cell radius
+and half the densification spacing.
+
+A footprint whose point on surface is surely within the search distance is
+accepted, one whose whole extent is surely beyond it is rejected, and
+only those in between need exact geometry tests. The exact tests measure
+planar distances in a projection per latitude band, which differ from
+great-circle distances by up to the projection's scale error, so the
+bounds are widened by that much to decide every footprint as the exact
+test would. The grid is saved with
+a fingerprint of the coastline and rebuilt when the coastline changes.
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+import shapely
+
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+
+## Largest relative difference between the exact test's planar distances and great-circle
+## distances: about 2.2% at the edges of the 10 degree polar stereographic bands and 0.1%
+## in UTM zones, plus the spherical earth radius against the WGS84 ellipsoid
+PROJECTION_SCALE_ERROR = 0.03
+
+
+def unit_vectors(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(v) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def densify_coastline(segments, spacing_km=1.0):
+    '''
+    Returns (lon, lat) arrays of points along the coastline segments, with
+    consecutive points at most spacing_km apart.
+    segments: array of shapely linestrings in WGS84
+    '''
+    coords, line_i = shapely.get_coordinates(segments, return_index=True)
+    same_line = line_i[1:] == line_i[:-1]
+    start, end = coords[:-1][same_line], coords[1:][same_line]
+    lengths = haversine_km(start[:, 0], start[:, 1], end[:, 0], end[:, 1])
+    steps = np.maximum(np.ceil(lengths / spacing_km).astype(np.int64), 1)
+
+    ## Every edge's start point plus its interior points, then each line's last point
+    edge_i = np.repeat(np.arange(steps.size), steps)
+    fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[edge_i]
+    points = start[edge_i] + (end[edge_i] - start[edge_i]) * fraction[:, None]
+    last = np.append(line_i[1:] != line_i[:-1], True)
+    points = np.concatenate([points, coords[last]])
+
+    return points[:, 0], points[:, 1]
+
+
+def coastline_fingerprint(segments):
+    '''
+    Returns a hash of the coastline segments' geometry.
+    '''
+    digest = hashlib.sha1()
+    for wkb in shapely.to_wkb(segments):
+        digest.update(wkb)
+
+    return digest.hexdigest()
+
+
+def cell_radius_km(lat0, lat1, half_width):
+    '''
+    Returns the largest distance from a cell's centre to its corners.
+    lat0, lat1: arrays of the cells' southern and northern edges
+    half_width: half the cell width in degrees of longitude
+    '''
+    lat_c = (lat0 + lat1) / 2
+
+    return np.maximum(haversine_km(0, lat_c, half_width, lat0), haversine_km(0, lat_c, half_width, lat1))
+
+
+class DistanceGrid(object):
+    '''
+    Two-level grid of distances (km) from cell centres to the coastline.
+    coarse: (rows, cols) distances of the coarse cells, row 0 at 90 N
+    blocks: (n, refine, refine) distances of the refined cells
+    block_of: (rows, cols) index into blocks of each coarse cell, -1 if not refined
+    resolution: coarse cell size in degrees
+    spacing_km: spacing of the densified coastline
+    fingerprint: coastline_fingerprint of the coastline the grid was built from
+    '''
+    def __init__(self, coarse, blocks, block_of, resolution, spacing_km, fingerprint):
+        self.coarse = coarse
+        self.blocks = blocks
+        self.block_of = block_of
+        self.resolution = float(resolution)
+        self.refine = blocks.shape[1] if blocks.ndim == 3 else 1
+        self.spacing_km = float(spacing_km)
+        self.fingerprint = str(fingerprint)
+
+
+    @classmethod
+    def build(cls, segments, resolution=1.0, refine=16, refine_km=150, spacing_km=1.0):
+        '''
+        Builds the grid for a coastline.
+        segments: array of shapely linestrings in WGS84
+        resolution: coarse cell size in degrees
+        refine: coarse cells are split into refine x refine fine cells
+        refine_km: coarse cells that may be closer than this to the coastline are refined
+        spacing_km: densification spacing of the coastline
+        '''
+        lon, lat = densify_coastline(segments, spacing_km=spacing_km)
+        logger.info('Building distance grid from {:,} coastline points.'.format(lon.size))
+        tree = cKDTree(unit_vectors(lon, lat))
+
+        def centre_distances(lon_c, lat_c):
+            chord, _i = tree.query(unit_vectors(lon_c.ravel(), lat_c.ravel()))
+            return (2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1))).reshape(lon_c.shape).astype(np.float32)
+
+        rows, cols = int(round(180 / resolution)), int(round(360 / resolution))
+        lat_c = 90 - (np.arange(rows) + 0.5) * resolution
+        lon_c = -180 + (np.arange(cols) + 0.5) * resolution
+        coarse = centre_distances(*np.meshgrid(lon_c, lat_c))
+
+        radius = cell_radius_km(lat_c - resolution / 2, lat_c + resolution / 2, resolution / 2)
+        near = coarse - radius[:, None] - spacing_km / 2 < refine_km
+        block_of = np.full((rows, cols), -1, dtype=np.int32)
+        block_of[near] = np.arange(near.sum())
+
+        ## Fine cell centres of every refined coarse cell, one query for all
+        fine = (np.arange(refine) + 0.5) * resolution / refine
+        near_r, near_c = np.nonzero(near)
+        fine_lat = (90 - near_r * resolution)[:, None, None] - fine[None, :, None]
+        fine_lon = (-180 + near_c * resolution)[:, None, None] + fine[None, None, :]
+        fine_lat, fine_lon = np.broadcast_arrays(fine_lat, fine_lon)
+        blocks = centre_distances(fine_lon, fine_lat) if near_r.size else np.zeros((0, refine, refine), np.float32)
+        logger.info('Refined {:,} of {:,} coarse cells.'.format(near_r.size, rows * cols))
+
+        return cls(coarse, blocks, block_of, resolution, spacing_km, coastline_fingerprint(segments))
+
+
+    @classmethod
+    def load(cls, grid_p):
+        with np.load(grid_p) as npz:
+            return cls(npz['coarse'], npz['blocks'], npz['block_of'], npz['resolution'],
+                       npz['spacing_km'], npz['fingerprint'])
+
+
+    def save(self, grid_p):
+        os.makedirs(os.path.dirname(os.path.abspath(grid_p)), exist_ok=True)
+        ## np.savez appends .npz to names without it, so write to a .npz temp file
+        tmp_p = '{}.tmp.npz'.format(os.path.splitext(grid_p)[0])
+        np.savez(tmp_p, coarse=self.coarse, blocks=self.blocks, block_of=self.block_of,
+                 resolution=self.resolution, spacing_km=self.spacing_km, fingerprint=self.fingerprint)
+        os.replace(tmp_p, grid_p)
+
+
+    def point_bounds(self, lon, lat):
+        '''
+        Returns (lower, upper) bounds in km on the distance from each point
+        to the coastline.
+        '''
+        lon = (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+        lat = np.clip(np.asarray(lat, dtype=np.float64), -90, 90)
+        rows, cols = self.coarse.shape
+        row_f = np.clip((90 - lat) / self.resolution, 0, rows - 1e-9)
+        col_f = np.clip((lon + 180) / self.resolution, 0, cols - 1e-9)
+        row, col = row_f.astype(np.int64), col_f.astype(np.int64)
+
+        centre = self.coarse[row, col].astype(np.float64)
+        size = np.full(lon.shape, self.resolution)
+        block = self.block_of[row, col]
+        refined = block >= 0
+        if refined.any():
+            fine_row = ((row_f[refined] - row[refined]) * self.refine).astype(np.int64)
+            fine_col = ((col_f[refined] - col[refined]) * self.refine).astype(np.int64)
+            centre[refined] = self.blocks[block[refined], fine_row, fine_col]
+            size[refined] = self.resolution / self.refine
+            row_f = np.where(refined, row + (np.floor((row_f - row) * self.refine) + 0.5) / self.refine, row + 0.5)
+        else:
+            row_f = row + 0.5
+        lat_c = 90 - row_f * self.resolution
+        radius = cell_radius_km(lat_c - size / 2, lat_c + size / 2, size / 2)
+        slack = radius + self.spacing_km / 2
+
+        return np.maximum(centre - slack, 0), centre + slack
+
+
+    def screen(self, geoms, distance, scale_error=PROJECTION_SCALE_ERROR):
+        '''
+        Returns (accept, reject) boolean arrays: footprints surely within
+        distance (km) of the coastline and footprints surely beyond it,
+        by the exact test in coastline_proximity as well as on the sphere.
+        geoms: array of shapely footprint geometries in WGS84
+        scale_error: largest relative error of the exact test's distances
+        '''
+        geoms = np.asarray(geoms, dtype=object)
+        points = shapely.point_on_surface(geoms)
+        lon, lat = shapely.get_x(points), shapely.get_y(points)
+        lower, upper = self.point_bounds(lon, lat)
+
+        ## Furthest vertex from the point, with a margin for edges bowing away on the sphere
+        coords, geom_i = shapely.get_coordinates(geoms, return_index=True)
+        extent = np.zeros(geoms.shape)
+        np.maximum.at(extent, geom_i, haversine_km(lon[geom_i], lat[geom_i], coords[:, 0], coords[:, 1]))
+        extent *= 1.01
+
+        accept = upper * (1 + scale_error) <= distance
+        reject = (lower - extent) * (1 - scale_error) > distance
+
+        return accept, reject & ~accept
+
+
+def load_distance_grid(grid_p, segments, **build_kwargs):
+    '''
+    Loads the grid saved at grid_p, building and saving it if it does not
+    exist or was built from a different coastline.
+    '''
+    fingerprint = coastline_fingerprint(segments)
+    if os.path.exists(grid_p):
+        grid = DistanceGrid.load(grid_p)
+        if grid.fingerprint == fingerprint:
+            return grid
+        logger.info('Coastline has changed since {} was built, rebuilding.'.format(grid_p))
+
+    grid = DistanceGrid.build(segments, **build_kwargs)
+    grid.save(grid_p)
+
+    return grid
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming coastline candidate pipeline.
+
+Reads footprints from the source with OGR in bounded-size record batches
+and passes each batch through the attribute filter, the max off nadir
+stereo exclusion, the coastline proximity filter, sea-ice sampling and
+the ice threshold, writing only the final candidates. Nothing is written
+between stages, and memory use depends on the batch size rather than on
+the number of footprints.
+"""
+
+import argparse
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+import shapely
+
+from coastline_proximity import CoastlineIndex
+from coastline_selection import DATE_COL_LUT, ID_COL_LUT, selection_clause
+from footprint_mirror import FootprintMirror, selection_expression
+from pipeline_metrics import RunMetrics, setup_logging
+from sea_ice_cache import RasterCache
+from sea_ice_index import load_pole_indexes
+from sea_ice_sampling import file_nearest_lookup, file_raster_source, sample_sea_ice
+from sea_ice_tiles import file_tile_lookup
+from stereo_exclusion import MaxOnaCache
+
+
+gdal.UseExceptions()
+
+logger = logging.getLogger(__name__)
+
+
+CONCENTRATION_FIELD = 'sea_ice_concentration'
+DISTANCE_FIELD = 'sea_ice_distance'
+
+
+def wgs84():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return srs
+
+
+def read_batches(lyr, batch_size):
+    '''
+    Yields record batches from an OGR layer as dictionaries of column
+    arrays: 'wkb' geometries in WGS84 plus one array per attribute field.
+    '''
+    defn = lyr.GetLayerDefn()
+    names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    src_srs = lyr.GetSpatialRef()
+    transform = None
+    if src_srs is not None and not src_srs.IsSame(wgs84()):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src_srs, wgs84())
+
+    def to_batch(wkbs, rows):
+        batch = {'wkb': np.array(wkbs, dtype=object)}
+        for i, name in enumerate(names):
+            batch[name] = np.array([row[i] for row in rows], dtype=object)
+        return batch
+
+    wkbs, rows = [], []
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        if geom is None:
+            continue
+        if transform is not None:
+            geom.Transform(transform)
+        wkbs.append(bytes(geom.ExportToWkb()))
+        rows.append([feat.GetField(i) for i in range(len(names))])
+        if len(wkbs) == batch_size:
+            yield to_batch(wkbs, rows)
+            wkbs, rows = [], []
+    if wkbs:
+        yield to_batch(wkbs, rows)
+
+
+def take(batch, mask):
+    return {k: v[mask] for k, v in batch.items()}
+
+
+def create_output(out_p, src_lyr, driver='GPKG', layer_name=None):
+    '''
+    Creates the output datasource with the source's fields plus the sea-ice
+    fields, returning (datasource, layer).
+    '''
+    if os.path.exists(out_p):
+        gdal.GetDriverByName(driver).Delete(out_p)
+    out_ds = ogr.GetDriverByName(driver).CreateDataSource(out_p)
+    layer_name = layer_name or os.path.splitext(os.path.basename(out_p))[0]
+    out_lyr = out_ds.CreateLayer(layer_name, srs=wgs84(), geom_type=src_lyr.GetGeomType())
+    src_defn = src_lyr.GetLayerDefn()
+    for i in range(src_defn.GetFieldCount()):
+        out_lyr.CreateField(src_defn.GetFieldDefn(i))
+    for name in (CONCENTRATION_FIELD, DISTANCE_FIELD):
+        out_lyr.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+
+    return out_ds, out_lyr
+
+
+def write_batch(out_lyr, batch):
+    defn = out_lyr.GetLayerDefn()
+    names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    out_lyr.StartTransaction()
+    for i in range(batch['wkb'].size):
+        feat = ogr.Feature(defn)
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(batch['wkb'][i]))
+        for name in names:
+            value = batch[name][i]
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                feat.SetFieldNull(name)
+            else:
+                feat.SetField(name, value)
+        out_lyr.CreateFeature(feat)
+    out_lyr.CommitTransaction()
+
+
+def run_pipeline(src, src_p, out_p, coast_index, distance, ice_threshold, raster_source, nearest_lookup=None,
+                 src_layer=None, where=None, max_ona=None, max_radius_km=100, batch_size=50000, driver='GPKG',
+                 metrics=None, mirror=None, tile_lookup=None):
+    '''
+    Streams footprints from src_p through every selection stage, writing
+    the final candidates to out_p. Returns a dictionary of row counts out
+    of each stage.
+    src: 'mfp', 'nasa', or 'dg' - chooses the id, date and selection columns
+    src_p: OGR datasource of the source footprint
+    coast_index: CoastlineIndex of the coastline
+    distance: search distance from coastline in km
+    ice_threshold: highest sea-ice concentration to keep
+    raster_source, nearest_lookup, tile_lookup: as for sea_ice_sampling.sample_sea_ice
+    src_layer: layer within src_p, the first layer if None
+    where: attribute filter, selection_clause(src) if None; a pyarrow
+           expression, selection_expression(src) if None, with mirror
+    max_ona: MaxOnaCache of stereopair ids to drop, or None to keep all
+    batch_size: footprints per record batch
+    metrics: RunMetrics to time each stage in, summed over batches
+    mirror: FootprintMirror of src to read from instead of scanning src_p,
+            which then only supplies the output fields
+    '''
+    metrics = metrics if metrics is not None else RunMetrics('coastline_pipeline')
+    src_ds = ogr.Open(src_p)
+    lyr = src_ds.GetLayerByName(src_layer) if src_layer else src_ds.GetLayer(0)
+    out_ds, out_lyr = create_output(out_p, lyr, driver=driver)
+    if mirror is not None:
+        ## Partition and row group pruning on the selection criteria
+        batches = mirror.batches(batch_size, where=where if where is not None else selection_expression(src))
+    else:
+        lyr.SetAttributeFilter(where or selection_clause(src))
+        batches = read_batches(lyr, batch_size)
+
+    counts = {'attribute': 0, 'max_ona': 0, 'coastline': 0, 'sea_ice': 0}
+    i = 0
+    while True:
+        ## Reading is timed separately from the stages consuming the batch
+        with metrics.stage('query'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        i += 1
+        counts['attribute'] += batch['wkb'].size
+
+        with metrics.stage('max_ona_select'):
+            if max_ona is not None:
+                batch = take(batch, ~max_ona.excluded(batch[ID_COL_LUT[src]].astype(str)))
+        counts['max_ona'] += batch['wkb'].size
+
+        with metrics.stage('proximity_select'):
+            geoms = shapely.from_wkb(batch['wkb'])
+            near = coast_index.within_distance(geoms, distance)
+            batch, geoms = take(batch, near), geoms[near]
+        counts['coastline'] += batch['wkb'].size
+        if batch['wkb'].size == 0:
+            continue
+
+        with metrics.stage('sampling'):
+            centroids = shapely.centroid(geoms)
+            concentrations, distances = sample_sea_ice(shapely.get_x(centroids), shapely.get_y(centroids),
+                                                       batch[DATE_COL_LUT[src]], raster_source,
+                                                       max_radius_km=max_radius_km, nearest_lookup=nearest_lookup,
+                                                       tile_lookup=tile_lookup, return_distance=True, metrics=metrics)
+            batch[CONCENTRATION_FIELD] = concentrations
+            batch[DISTANCE_FIELD] = distances
+            ## Empty concentrations fail the threshold, as in a SQL <= comparison
+            batch = take(batch, concentrations <= ice_threshold)
+        counts['sea_ice'] += batch['wkb'].size
+
+        with metrics.stage('write'):
+            write_batch(out_lyr, batch)
+        logger.info('Batch {}: {}'.format(i, ', '.join('{}: {:,}'.format(k, v) for k, v in counts.items())))
+
+    out_lyr = None
+    out_ds = None
+    src_ds = None
+    logger.info('Wrote {:,} candidates to {}.'.format(counts['sea_ice'], out_p))
+    metrics.update(counts, prefix='rows_')
+
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src', type=str, choices=['mfp', 'dg', 'nasa'],
+                        help='Footprint source, chooses the id, date and selection columns.')
+    parser.add_argument('src_path', type=str,
+                        help='OGR datasource of the source footprint, e.g. the imagery index gdb.')
+    parser.add_argument('coast_path', type=str,
+                        help='OGR datasource holding the coastline.')
+    parser.add_argument('wd', type=str,
+                        help='Project working directory holding noaa_sea_ice and pickles.')
+    parser.add_argument('out_path', type=str,
+                        help='Path to write final candidates to.')
+    parser.add_argument('--src_layer', type=str,
+                        help='Layer within src_path. Default = first layer')
+    parser.add_argument('--coast_layer', type=str,
+                        help='Layer within coast_path. Default = first layer')
+    parser.add_argument('--coast_grid', type=str,
+                        help='Path of the distance-to-coast grid used to pre-screen footprints, '
+                             'built there if missing or out of date. Default = no pre-screen')
+    parser.add_argument('--distance', type=float, default=10,
+                        help='Search distance from coastline in km. Default = 10')
+    parser.add_argument('--ice_threshold', type=float, default=0,
+                        help='Highest sea-ice concentration to keep. Default = 0')
+    parser.add_argument('--batch_size', type=int, default=50000,
+                        help='Footprints per batch. Default = 50000')
+    parser.add_argument('--cache_mb', type=int, default=512,
+                        help='Memory budget for decoded sea-ice rasters. Default = 512')
+    parser.add_argument('--driver', type=str, default='GPKG',
+                        help='OGR driver for the output. Default = GPKG')
+    parser.add_argument('--mirror_dir', type=str,
+                        help='Read footprints from the GeoParquet mirror in this directory, see footprint_mirror.py.')
+    parser.add_argument('--sync', action='store_true',
+                        help='Pull new rows from src_path into the mirror before running.')
+    parser.add_argument('--update_max_ona', action='store_true',
+                        help='Refresh the max off nadir stereopair ids before running. '
+                             'They are always refreshed if the cache is empty.')
+    parser.add_argument('--max_ona_changed_col', type=str,
+                        help='Ingest or modification timestamp column of the stereo layer, '
+                             'to refresh the max off nadir ids incrementally. Default = full refresh')
+    parser.add_argument('--metrics', type=str,
+                        help='Path to write per-stage timings and counters to as JSON.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Also save a cProfile of the run next to --metrics.')
+
+    args = parser.parse_args()
+
+    setup_logging()
+
+    luts = load_pole_indexes(args.wd)
+    def raster_lookup(pole, date):
+        return luts[pole].lookup(date)
+    raster_cache = RasterCache(max_mb=args.cache_mb)
+    metrics = RunMetrics('coastline_pipeline', profile=args.profile)
+    max_ona = MaxOnaCache(args.wd)
+    if args.update_max_ona or len(max_ona) == 0:
+        with metrics.stage('max_ona_refresh'):
+            max_ona.refresh(changed_col=args.max_ona_changed_col)
+    if len(max_ona) == 0:
+        logger.error('No max off nadir stereopair ids after refreshing, none will be excluded.')
+    mirror = None
+    if args.mirror_dir:
+        mirror = FootprintMirror(args.mirror_dir, args.src)
+        if args.sync or len(mirror) == 0:
+            with metrics.stage('mirror_sync'):
+                mirror.sync(args.src_path, src_layer=args.src_layer)
+
+    run_pipeline(args.src, args.src_path, args.out_path,
+                 CoastlineIndex.from_path(args.coast_path, layer=args.coast_layer, grid_p=args.coast_grid),
+                 args.distance, args.ice_threshold,
+                 file_raster_source(raster_lookup, reader=raster_cache.read),
+                 nearest_lookup=file_nearest_lookup(raster_lookup),
+                 tile_lookup=file_tile_lookup(raster_lookup),
+                 src_layer=args.src_layer, max_ona=max_ona,
+                 batch_size=args.batch_size, driver=args.driver, metrics=metrics,
+                 mirror=mirror)
+    raster_cache.log_stats()
+    ## Cache misses are the rasters opened
+    metrics.update(raster_cache.stats(), prefix='raster_cache_')
+    metrics.log()
+    if args.metrics:
+        metrics.write(args.metrics)
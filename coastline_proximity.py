@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Selects footprints within a distance of a coastline without arcpy.
+
+The coastline is read with OGR and split into short segments held in a
+shapely STRtree. Footprints are first matched to segments by bounding
+box, expanded by the search distance, and only those candidate pairs
+get an exact distance test, in a projection suited to the footprint's
+latitude band: polar stereographic with true scale at the centre of
+each 10 degree band poleward of 60, UTM elsewhere. Footprints are
+processed in chunks across a process pool. With a distance grid from
+coastline_grid.py, footprints clearly near or far from the coast are
+decided from the grid and skip the exact tests.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import math
+
+import numpy as np
+from osgeo import ogr, osr
+import shapely
+
+from coastline_grid import load_distance_grid
+
+logger = logging.getLogger(__name__)
+
+## Fewest kilometers per degree of latitude, to keep bounding box expansion conservative
+KM_PER_DEG = 110.5
+
+
+def read_coastline(coast_p, layer=None):
+    '''
+    Reads coastline geometries with OGR, returned in WGS84 as shapely geometries.
+    coast_p: path to coastline datasource, e.g. a shapefile or file geodatabase
+    layer: layer name within the datasource, the first layer if None
+    '''
+    ds = ogr.Open(coast_p)
+    lyr = ds.GetLayerByName(layer) if layer else ds.GetLayer(0)
+
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    src_srs = lyr.GetSpatialRef()
+    transform = None
+    if src_srs is not None and not src_srs.IsSame(wgs84):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src_srs, wgs84)
+
+    wkbs = []
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        if geom is None:
+            continue
+        if transform is not None:
+            geom.Transform(transform)
+        wkbs.append(bytes(geom.ExportToWkb()))
+    ds = None
+
+    return shapely.from_wkb(np.array(wkbs, dtype=object))
+
+
+def segment_coastline(geoms, max_vertices=32):
+    '''
+    Splits (multi)lines and polygon boundaries into linestrings of at most
+    max_vertices vertices so each has a tight bounding box.
+    '''
+    geoms = np.asarray(geoms, dtype=object)
+    ## Polygon coastlines are measured to their boundaries
+    polygons = np.isin(shapely.get_type_id(geoms), (3, 6))
+    lines = np.where(polygons, shapely.boundary(geoms), geoms)
+    segments = []
+    step = max_vertices - 1
+    for line in shapely.get_parts(lines):
+        coords = shapely.get_coordinates(line)
+        for start in range(0, max(len(coords) - 1, 1), step):
+            chunk = coords[start:start + max_vertices]
+            if len(chunk) >= 2:
+                segments.append(shapely.LineString(chunk))
+
+    return np.array(segments, dtype=object)
+
+
+def band_projection(lat, lon):
+    '''
+    Returns a key for the projection used for exact distances at (lat, lon):
+    ('stere', latitude of true scale) poleward of 60, ('utm', zone, north) otherwise.
+    '''
+    if abs(lat) >= 60:
+        band_centre = math.copysign(min(math.floor(abs(lat) / 10) * 10 + 5, 85), lat)
+        return ('stere', band_centre)
+    zone = int(math.floor((lon + 180) / 6)) % 60 + 1
+
+    return ('utm', zone, lat >= 0)
+
+
+def projection_srs(key):
+    srs = osr.SpatialReference()
+    if key[0] == 'stere':
+        srs.ImportFromProj4('+proj=stere +lat_0={} +lat_ts={} +lon_0=0 +datum=WGS84 +units=m'.format(
+            90 if key[1] > 0 else -90, key[1]))
+    else:
+        srs.ImportFromEPSG((32600 if key[2] else 32700) + key[1])
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return srs
+
+
+def project_geometries(geoms, key):
+    '''
+    Reprojects WGS84 shapely geometries into the projection for key with a
+    single coordinate transform.
+    '''
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(wgs84, projection_srs(key))
+
+    def to_prj(coords):
+        if len(coords) == 0:
+            return coords
+        return np.array(transform.TransformPoints(coords.tolist()))[:, :2]
+
+    return shapely.transform(geoms, to_prj)
+
+
+class CoastlineIndex(object):
+    '''
+    STRtree of coastline segments for distance selection.
+    segments: array of shapely linestrings in WGS84
+    grid: coastline_grid.DistanceGrid to pre-screen footprints with, or None
+    '''
+    def __init__(self, segments, grid=None):
+        self.segments = np.asarray(segments, dtype=object)
+        self.tree = shapely.STRtree(self.segments)
+        self.grid = grid
+
+
+    @classmethod
+    def from_path(cls, coast_p, layer=None, max_vertices=32, grid_p=None):
+        '''
+        grid_p: path of the distance grid to pre-screen with, built there
+                if missing or built from a different coastline
+        '''
+        segments = segment_coastline(read_coastline(coast_p, layer=layer), max_vertices=max_vertices)
+        grid = load_distance_grid(grid_p, segments) if grid_p else None
+
+        return cls(segments, grid=grid)
+
+
+    def search_boxes(self, geoms, distance):
+        '''
+        Returns the bounding boxes of geoms expanded by distance (km) in degrees.
+        '''
+        bounds = shapely.bounds(geoms)
+        dlat = distance / KM_PER_DEG
+        max_lat = np.minimum(np.maximum(np.abs(bounds[:, 1]), np.abs(bounds[:, 3])) + dlat, 90.0)
+        cos_lat = np.cos(np.radians(max_lat))
+        ## Near the poles any longitude may be within distance
+        dlon = np.where(cos_lat > 1e-6, dlat / np.maximum(cos_lat, 1e-6), 360.0)
+        dlon = np.minimum(dlon, 360.0)
+
+        return shapely.box(bounds[:, 0] - dlon, bounds[:, 1] - dlat, bounds[:, 2] + dlon, bounds[:, 3] + dlat)
+
+
+    def within_distance(self, geoms, distance):
+        '''
+        Returns a boolean array, True for geoms within distance (km) of the coastline.
+        geoms: array of shapely footprint geometries in WGS84
+        '''
+        geoms = np.asarray(geoms, dtype=object)
+        if self.grid is None or geoms.size == 0:
+            return self.exact_within_distance(geoms, distance)
+
+        accept, reject = self.grid.screen(geoms, distance)
+        undecided = np.flatnonzero(~accept & ~reject)
+        logger.debug('Distance grid - accepted: {:,}, rejected: {:,}, exact tests: {:,}'.format(
+            accept.sum(), reject.sum(), undecided.size))
+        selected = accept.copy()
+        selected[undecided] = self.exact_within_distance(geoms[undecided], distance)
+
+        return selected
+
+
+    def exact_within_distance(self, geoms, distance):
+        '''
+        within_distance from exact geometry alone.
+        '''
+        geoms = np.asarray(geoms, dtype=object)
+        selected = np.zeros(geoms.shape, dtype=bool)
+        if geoms.size == 0 or self.segments.size == 0:
+            return selected
+
+        ## Bounding box rejection, repeating boxes that cross the antimeridian on the other side
+        boxes = self.search_boxes(geoms, distance)
+        geom_i, seg_i = self.tree.query(boxes)
+        bounds = shapely.bounds(boxes)
+        for shift, crosses in ((360, bounds[:, 0] < -180), (-360, bounds[:, 2] > 180)):
+            if crosses.any():
+                shifted = shapely.transform(boxes[crosses], lambda coords: coords + [shift, 0])
+                shifted_i, shifted_seg_i = self.tree.query(shifted)
+                geom_i = np.concatenate([geom_i, np.flatnonzero(crosses)[shifted_i]])
+                seg_i = np.concatenate([seg_i, shifted_seg_i])
+        if geom_i.size == 0:
+            return selected
+
+        ## Exact distances, one projection per latitude band
+        centroids = shapely.centroid(geoms)
+        keys = [band_projection(lat, lon) for lon, lat in zip(shapely.get_x(centroids), shapely.get_y(centroids))]
+        key_ids = {}
+        geom_keys = np.array([key_ids.setdefault(k, len(key_ids)) for k in keys])
+        pair_keys = geom_keys[geom_i]
+        for key, key_id in key_ids.items():
+            in_key = pair_keys == key_id
+            if not in_key.any():
+                continue
+            g_i, s_i = geom_i[in_key], seg_i[in_key]
+            g_u, g_inv = np.unique(g_i, return_inverse=True)
+            s_u, s_inv = np.unique(s_i, return_inverse=True)
+            geoms_prj = project_geometries(geoms[g_u], key)
+            segs_prj = project_geometries(self.segments[s_u], key)
+            near = shapely.distance(geoms_prj[g_inv], segs_prj[s_inv]) <= distance * 1000
+            selected[g_i[near]] = True
+
+        return selected
+
+
+## Coastline index for worker processes, built once per worker by init_worker
+_worker_index = None
+
+
+def init_worker(segment_wkbs, grid=None):
+    global _worker_index
+    _worker_index = CoastlineIndex(shapely.from_wkb(segment_wkbs), grid=grid)
+
+
+def within_distance_chunk(args):
+    wkbs, distance = args
+    return _worker_index.within_distance(shapely.from_wkb(wkbs), distance)
+
+
+def select_near_coast(footprint_wkbs, coast_index, distance, chunk_size=10000, processes=4):
+    '''
+    Returns a boolean array, True for footprints within distance (km) of the
+    coastline, processing chunks of footprints across a process pool.
+    footprint_wkbs: sequence of WKB footprint geometries in WGS84
+    coast_index: CoastlineIndex
+    processes: number of worker processes, 1 to run in this process
+    '''
+    footprint_wkbs = np.asarray(footprint_wkbs, dtype=object)
+    chunks = [footprint_wkbs[i:i + chunk_size] for i in range(0, footprint_wkbs.size, chunk_size)]
+    logger.info('Testing {:,} footprints against {:,} coastline segments in {:,} chunks.'.format(
+        footprint_wkbs.size, coast_index.segments.size, len(chunks)))
+    if not chunks:
+        return np.zeros(0, dtype=bool)
+
+    if processes <= 1:
+        results = [coast_index.within_distance(shapely.from_wkb(chunk), distance) for chunk in chunks]
+    else:
+        segment_wkbs = shapely.to_wkb(coast_index.segments)
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                 initargs=(segment_wkbs, coast_index.grid)) as executor:
+            results = list(executor.map(within_distance_chunk, [(chunk, distance) for chunk in chunks]))
+
+    return np.concatenate(results)
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the coastline stages as a dependency graph, skipping stages whose
+inputs have not changed.
+
+Each stage fingerprints its inputs and parameters (source footprint
+version, coastline, distance, ice threshold, raster listings and resample
+manifests) and output paths together with the versions of the stages it
+depends on. A stage reruns only when its fingerprint differs from the last
+successful run or an output is missing, and each run gives the stage a new
+version, so a rerun upstream, even a forced one, reruns everything
+downstream of it and nothing else. Stages whose dependencies are done run
+concurrently, e.g. resampling the north and south rasters alongside
+candidate selection; arcpy is not thread safe, so stages using it run one
+at a time on the main thread.
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+import arcpy
+
+from coastline_candidates_arcpy import coastline_candidates, source_path
+from coastline_grid import coastline_fingerprint
+from coastline_proximity import read_coastline, segment_coastline
+from coastline_sea_ice_arcpy import coastline_sea_ice
+from pipeline_metrics import RunMetrics, setup_logging
+from sea_ice_nodata import resample_loop
+
+
+logger = logging.getLogger(__name__)
+
+
+def file_version(path):
+    '''
+    Returns [size, mtime] of a file, None if it does not exist.
+    '''
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def tree_version(dir_p, suffixes=None):
+    '''
+    Returns a hash of the relative path, size and mtime of every file under
+    dir_p, or only files ending with one of suffixes.
+    '''
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(dir_p)):
+        for f in sorted(files):
+            if suffixes and not f.endswith(tuple(suffixes)):
+                continue
+            f_p = os.path.join(root, f)
+            digest.update('{}|{}\n'.format(os.path.relpath(f_p, dir_p), file_version(f_p)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def fingerprint(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Stage(object):
+    '''
+    One step of the pipeline.
+    name: unique stage name
+    run: function taking the set of stage names rerun so far in this run
+    inputs: function returning a JSON-able description of the stage's inputs
+            and parameters, called once the stage's dependencies are done
+    deps: names of stages that must finish first
+    outputs: function returning the paths the stage writes; they are part
+             of its fingerprint, and the stage reruns if any is missing
+    main_thread: run on the runner's own thread, one such stage at a time,
+                 e.g. for arcpy, which is not thread safe
+    '''
+    def __init__(self, name, run, inputs, deps=(), outputs=None, main_thread=False):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.deps = tuple(deps)
+        self.outputs = outputs if outputs is not None else lambda: []
+        self.main_thread = main_thread
+
+
+def outputs_exist(paths):
+    '''
+    Returns True if every path exists, as a file, directory or geodatabase
+    feature class.
+    '''
+    return all(os.path.exists(p) or arcpy.Exists(p) for p in paths)
+
+
+class PipelineRunner(object):
+    '''
+    Runs stages in dependency order, concurrently where independent.
+    state_p: JSON file of the fingerprint and run id of each stage's last successful run
+    max_workers: most stages to run at once
+    '''
+    def __init__(self, stages, state_p, max_workers=4, metrics=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_p = state_p
+        self.max_workers = max_workers
+        self.metrics = metrics if metrics is not None else RunMetrics('coastline_runner')
+        self.state = {}
+        ## Stages run on worker threads and update the state as they start
+        self.state_lock = threading.Lock()
+        if os.path.exists(state_p):
+            with open(state_p, 'r') as handle:
+                self.state = json.load(handle)
+        for stage in stages:
+            missing = [d for d in stage.deps if d not in self.stages]
+            if missing:
+                raise ValueError('Stage {} depends on unknown stages: {}'.format(stage.name, missing))
+
+
+    def save_state(self):
+        with self.state_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_p)), exist_ok=True)
+            tmp_p = '{}.tmp'.format(self.state_p)
+            with open(tmp_p, 'w') as handle:
+                json.dump(self.state, handle, indent=2)
+            os.replace(tmp_p, self.state_p)
+
+
+    def set_state(self, name, entry):
+        '''
+        Records a stage's state entry, or forgets it if None, and saves the state.
+        '''
+        with self.state_lock:
+            if entry is None:
+                self.state.pop(name, None)
+            else:
+                self.state[name] = entry
+        self.save_state()
+
+
+    def stage_fingerprint(self, stage, versions):
+        outputs = list(stage.outputs())
+        return fingerprint({'inputs': stage.inputs(), 'outputs': outputs,
+                            'deps': {d: versions[d] for d in stage.deps}}), outputs
+
+
+    def run_stage(self, stage, versions, rerun, force):
+        '''
+        Runs stage if its fingerprint changed or an output is missing.
+        Returns (state entry, ran): the entry holds the fingerprint and the
+        id of the run that produced the stage's outputs.
+        versions: version of each finished stage, from stage_version
+        '''
+        current, outputs = self.stage_fingerprint(stage, versions)
+        with self.state_lock:
+            last = self.state.get(stage.name)
+        ## Entries from before run ids were kept are strings, and rerun once
+        if (stage.name not in force and isinstance(last, dict) and last.get('fingerprint') == current
+                and outputs_exist(outputs)):
+            logger.info('{} is up to date, skipping.'.format(stage.name))
+            return last, False
+
+        ## Forgotten while the stage runs, so an interrupted run is not taken for a finished one
+        self.set_state(stage.name, None)
+        logger.info('Running {}...'.format(stage.name))
+        with self.metrics.stage(stage.name):
+            stage.run(set(rerun))
+        ## The stage's own outputs may change its inputs (e.g. a manifest), so fingerprint again
+        current, _outputs = self.stage_fingerprint(stage, versions)
+
+        return {'fingerprint': current, 'run': uuid.uuid4().hex}, True
+
+
+    def run(self, force=(), stages=None):
+        '''
+        Runs every stage, or stages and what they depend on, rerunning
+        those whose inputs changed and any in force. Returns the set of
+        stages that ran.
+        '''
+        wanted = set(stages or self.stages)
+        pending = list(wanted)
+        while pending:
+            for dep in self.stages[pending.pop()].deps:
+                if dep not in wanted:
+                    wanted.add(dep)
+                    pending.append(dep)
+
+        versions, rerun, failed = {}, set(), set()
+        running = {}
+
+        def finish(name, result):
+            try:
+                entry, ran = result()
+            except (Exception, SystemExit) as e:
+                logger.error('{} failed: {!r}'.format(name, e))
+                failed.add(name)
+                return
+            ## A new run id gives a new version, so stages depending on a rerun stage rerun too
+            versions[name] = fingerprint(entry)
+            if ran:
+                rerun.add(name)
+            ## Saved as each stage finishes, so a later failure keeps earlier work
+            self.set_state(name, entry)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                main_ready = []
+                for name in sorted(wanted - set(versions) - failed - set(running.values())):
+                    deps = self.stages[name].deps
+                    if any(d in failed for d in deps):
+                        logger.warning('Not running {}: a stage it depends on failed.'.format(name))
+                        failed.add(name)
+                    elif not all(d in versions for d in deps):
+                        continue
+                    elif self.stages[name].main_thread:
+                        main_ready.append(name)
+                    else:
+                        running[executor.submit(self.run_stage, self.stages[name], versions, rerun, force)] = name
+                if main_ready:
+                    ## Worker thread stages carry on meanwhile
+                    name = main_ready[0]
+                    finish(name, lambda: self.run_stage(self.stages[name], versions, rerun, force))
+                    continue
+                if not running:
+                    break
+                done, _not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result)
+
+        self.metrics.log()
+        if failed:
+            raise RuntimeError('Stages failed: {}'.format(', '.join(sorted(failed))))
+
+        return rerun
+
+
+def resample_dirs(wd, hemisphere):
+    '''
+    Returns the (downloaded, resampled) raster directories of a hemisphere.
+    '''
+    hemisphere_dir = os.path.join(wd, 'noaa_sea_ice', hemisphere)
+
+    return os.path.join(hemisphere_dir, 'daily'), os.path.join(hemisphere_dir, 'resampled_nd', 'daily')
+
+
+def coastline_stages(args):
+    '''
+    Returns the resample, candidate selection and sea-ice stages for the
+    command line arguments.
+    '''
+    stages = []
+    aggregate_dir = os.path.join(args.wd, 'noaa_sea_ice', 'aggregates') if args.aggregates else None
+    hemispheres = ('north', 'south')
+    ## The hemispheres resample at the same time, so they share the process budget
+    resample_processes = max(1, args.processes // len(hemispheres))
+    for hemisphere in hemispheres:
+        src_dir, out_dir = resample_dirs(args.wd, hemisphere)
+        stages.append(Stage(
+                'resample_{}'.format(hemisphere),
+                lambda rerun, src_dir=src_dir, out_dir=out_dir: resample_loop(
+                        src_dir, out_dir, args.last_update, args.out_nodata, processes=resample_processes,
+                        compact=args.compact, aggregate_dir=aggregate_dir),
+                lambda src_dir=src_dir: {'rasters': tree_version(src_dir, suffixes=('.tif', )),
+                                         'last_update': args.last_update, 'out_nodata': args.out_nodata,
+                                         'compact': args.compact, 'aggregates': args.aggregates},
+                outputs=lambda out_dir=out_dir: [out_dir, os.path.join(out_dir, 'resample_manifest.jsonl')]))
+
+    def source_version():
+        src_p = source_path(args.src)
+        if args.src_version:
+            return args.src_version
+        if src_p is None:
+            ## Live database: treat as changed once a day
+            return datetime.date.today().isoformat()
+        return tree_version(os.path.dirname(src_p)) if os.path.isdir(os.path.dirname(src_p)) else src_p
+
+    coast_fingerprint = {}
+    def coast_version():
+        if not coast_fingerprint:
+            coast = segment_coastline(read_coastline(args.gdb, layer=args.coast_n))
+            coast_fingerprint['coast'] = coastline_fingerprint(coast)
+        return coast_fingerprint['coast']
+
+    stages.append(Stage(
+            'candidates',
+            lambda rerun: coastline_candidates(args.src, args.gdb, args.wd, args.coast_n, args.distance,
+                                               args.candidates, engine=args.engine, processes=args.processes),
+            lambda: {'src': args.src, 'source': source_version(), 'coast': coast_version(),
+                     'distance': args.distance, 'engine': args.engine},
+            outputs=lambda: [os.path.join(args.gdb, args.candidates)],
+            main_thread=True))
+
+    def manifests():
+        return {hemisphere: file_version(os.path.join(resample_dirs(args.wd, hemisphere)[1], 'resample_manifest.jsonl'))
+                for hemisphere in ('north', 'south')}
+
+    stages.append(Stage(
+            'sea_ice',
+            lambda rerun: coastline_sea_ice(args.src, os.path.join(args.gdb, args.candidates), args.final_candidates,
+                                            args.wd, args.gdb, args.ice_threshold,
+                                            update_luts=True,
+                                            processes=args.processes, aggregate_dir=aggregate_dir),
+            lambda: {'src': args.src, 'candidates': os.path.join(args.gdb, args.candidates),
+                     'manifests': manifests(), 'ice_threshold': args.ice_threshold},
+            deps=('resample_north', 'resample_south', 'candidates'),
+            outputs=lambda: [args.final_candidates],
+            main_thread=True))
+
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('wd', type=str,
+                        help='Project working directory holding noaa_sea_ice and pickles.')
+    parser.add_argument('gdb', type=str,
+                        help='Project geodatabase holding the coastline and candidates.')
+    parser.add_argument('src', type=str, choices=['mfp', 'dg', 'nasa'],
+                        help='Footprint source.')
+    parser.add_argument('coast_n', type=str,
+                        help='Name of the coastline in the project geodatabase.')
+    parser.add_argument('candidates', type=str,
+                        help='Feature class name to write initial candidates to.')
+    parser.add_argument('final_candidates', type=str,
+                        help='Feature class to write final candidates to.')
+    parser.add_argument('--distance', type=float, default=10,
+                        help='Search distance from coastline in km. Default = 10')
+    parser.add_argument('--ice_threshold', type=float, default=0,
+                        help='Highest sea-ice concentration to keep. Default = 0')
+    parser.add_argument('--engine', type=str, default='arcpy', choices=['arcpy', 'ogr'],
+                        help='Proximity selection engine. Default = arcpy')
+    parser.add_argument('--last_update', type=str, default='1978-01-01',
+                        help='Resample rasters after this date. Default = 1978-01-01')
+    parser.add_argument('--out_nodata', type=int, default=-9999,
+                        help='No data value of resampled rasters. Default = -9999')
+    parser.add_argument('--compact', action='store_true',
+                        help='Resample to Byte rasters with concentration as percent.')
+    parser.add_argument('--aggregates', action='store_true',
+                        help='Keep weekly, monthly and seasonal maximum rasters and use them to skip '
+                             'daily reads for surely ice-free footprints.')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='Worker processes within each stage. Default = 4')
+    parser.add_argument('--src_version', type=str,
+                        help='Version of the source footprint, e.g. an index date. Default = from the source files')
+    parser.add_argument('--stages', type=str, nargs='+',
+                        help='Run only these stages and what they depend on. Default = all')
+    parser.add_argument('--force', type=str, nargs='+', default=[],
+                        help='Stages to rerun even if up to date.')
+    parser.add_argument('--metrics', type=str,
+                        help='Path to write per-stage timings to as JSON.')
+
+    args = parser.parse_args()
+
+    setup_logging()
+    metrics = RunMetrics('coastline_runner')
+    runner = PipelineRunner(coastline_stages(args), os.path.join(args.wd, 'pickles', 'pipeline_state.json'),
+                            metrics=metrics)
+    try:
+        runner.run(force=args.force, stages=args.stages)
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
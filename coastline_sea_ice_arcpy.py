@@ -9,126 +9,41 @@ import arcpy
 import logging
 import os
 import numpy as np
-import pickle
 import sys
 
+from coastline_selection import DATE_COL_LUT, ID_COL_LUT
+from pipeline_metrics import RunMetrics, setup_logging
+from sea_ice_cache import RasterCache
+from sea_ice_aggregate import SeaIceAggregates
+from sea_ice_cube import cube_dates, cube_day_version, cube_raster_source
+from sea_ice_gapfill import GapFiller
+from sea_ice_index import load_pole_indexes
+from sea_ice_parallel import SourceFactory, sample_sea_ice_sharded
+from sea_ice_prefetch import RasterPrefetcher, sampling_order
+from sea_ice_results import (RESULT_COLUMNS, SamplingResultStore, file_day_version, footprint_keys,
+                              footprint_versions, raster_version)
+from sea_ice_sampling import file_nearest_lookup, file_raster_source, sample_sea_ice
+from sea_ice_tiles import file_tile_lookup
+from sea_ice_zonal import zonal_sea_ice
 
-def coastline_sea_ice(src, initial_candidates, final_candidates, wd, gdb, ice_threshold, update_luts=False):
+
+def coastline_sea_ice(src, initial_candidates, final_candidates, wd, gdb, ice_threshold, update_luts=False, cube_dir=None, cache_mb=512,
+                      nearest_day=False, max_days=None, max_radius_km=100, zonal=False,
+                      gap_fill=True, max_gap_days=5, metrics_p=None, profile=False, reuse_results=True,
+                      processes=1, prefetch_depth=4, prefetch_mb=256, aggregate_dir=None,
+                      tile_summaries=True):
     #### Logging
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    
-    
-    def create_daily_dict(year_start=1978, year_stop=2020):
-        ## Initialize empty dictionary with entries for each year, month, and day
-        years = [str(year) for year in range(year_start, year_stop+1)]
-        months = [str(month) if len(str(month))==2 else '0'+str(month) for month in range(1, 13)]
-        days = [str(day) if len(str(day))==2 else '0'+str(day) for day in range(1,32)]
-        empty_index = {year: {month: {day: None for day in days} for month in months} for year in years}
-        
-        return empty_index
-    
-    
-    def get_raster_paths(sea_ice_dir, update=False):
-        '''
-        Gets all of the raster paths for the given path and puts them in a dictionary
-        sorted by year, month, day.
-        sea_ice_dir: directory to parse
-        '''
-        raster_index = create_daily_dict()
-        
-        for root, dirs, files in os.walk(sea_ice_dir):
-            for f in files:
-                # Only add concentration rasters
-                if f.endswith('_concentration_v3.0.tif'):
-                    date = f.split('_')[1] # f format: N_ N_19851126_concentration_v3.0.tif
-                    year = date[0:4]
-                    month = date[4:6]
-                    day = date[6:8]
-                    raster_index[year][month][day] = os.path.join(root, f)
+    logger = setup_logging()
+    ## Per-stage timings and counts, written to metrics_p as JSON
+    metrics = RunMetrics('coastline_sea_ice', profile=profile)
     
-        ## Remove empty dictionary entries
-        # Remove empty days
-        for year_k, year_v in raster_index.copy().items():
-            for month_k, month_v in raster_index[year_k].copy().items():
-                for day_k, day_v in raster_index[year_k][month_k].copy().items():
-                    if day_v == None:
-                        del raster_index[year_k][month_k][day_k]
-        # Remove empty months
-        for year_k, year_v in raster_index.copy().items():
-            for month_k, month_v in raster_index[year_k].copy().items():
-                if not month_v:
-                    del raster_index[year_k][month_k]
-        # Remove empty years
-        for year_k, year_v in raster_index.copy().items():
-            if not year_v:
-                del raster_index[year_k]
-                
-        return raster_index
-    
-    
-    def create_raster_lut(pole, year_start=1978, year_stop=2020, update=False):
-        '''
-        Creates a lookup dictionary for each raster in the sea ice
-        raster directory.
-        pole: 'arctic' or 'antarctic' to determine which rasters to sample
-        '''
-        ## Create a 'arctic_sea_ice_path' and 'antarctic_sea_ice_path - use lat to determine which to sample
-        arctic_pickle_path = os.path.join(wd, r'pickles\arc_sea_ice_concentraion_index.pkl')
-        antarctic_pickle_path = os.path.join(wd, r'pickles\ant_sea_ice_concentraion_index.pkl')
-        if update == False:
-    #        raster_index = pd.read_pickle(pickle_path)
-            if pole == 'arctic':
-                with open(arctic_pickle_path, 'rb') as handle:
-                    raster_index = pickle.load(handle)
-            elif pole == 'antarctic':
-                with open(antarctic_pickle_path, 'rb') as handle:
-                    raster_index = pickle.load(handle)
-        else:
-            ## Concentration raster locations
-            arctic_ice_dir = os.path.join(wd, r'noaa_sea_ice\north\resampled_nd\daily\geotiff')
-            antarctic_ice_dir = os.path.join(wd, r'noaa_sea_ice\south\resampled_nd\daily\geotiff')
-            
-    #        logger.info('Creating look-up table of sea-ice rasters by date...')
-            ## Walk rasters extracting date information
-            if pole == 'arctic':
-                raster_index = get_raster_paths(arctic_ice_dir)
-                with open(arctic_pickle_path, 'wb') as handle:
-                    pickle.dump(raster_index)
-            elif pole == 'antarctic':
-                raster_index = get_raster_paths(antarctic_ice_dir)
-                with open(arctic_pickle_path, 'wb') as handle:
-                    pickle.dump(raster_index)
-            else:
-                logging.ERROR('Unrecognized pole argument while creating raster lookup table: {}'.format(pole))
-            
-        return raster_index
     
-    
-    def choose_pole(y):
-        '''
-        Returns the raster look-up-table appropriate for given y (latitude)
-        '''
-        if y > 50.0:
-            pole = 'arctic'
-        elif y < -50.0:
-            pole = 'antarctic'
-        else:
-            pole = None
-        
-        return pole
-    
-    
-    #### Load raster look up tables - dictionaries sorted by date [year][month][day] = daily_raster_path
-    logger.info('Loading raster look-up-tables.')
-    arctic_lut = create_raster_lut(pole='arctic', update=update_luts)
-    ant_lut = create_raster_lut(pole='antarctic', update=update_luts)
+    #### Load raster look up tables - sorted dates with parallel daily raster paths
+    ## Not needed when sampling from the memmapped cubes built by sea_ice_cube.py
+    if cube_dir is None:
+        logger.info('Loading raster look-up-tables.')
+        with metrics.stage('load_luts'):
+            luts = load_pole_indexes(wd, refresh=update_luts)
     
         
     #### Loop through candidates, determine appropriate look-up-table, assign path to new field (or just sample path)
@@ -136,16 +51,9 @@ def coastline_sea_ice(src, initial_candidates, final_candidates, wd, gdb, ice_th
     logger.info('Copying candidates feature class.')
     ## Name of intermediate feature class - in memory
     sea_ice_fc = '{}_all_ice'.format(src) ## fix to write to memory, getting CopyFeatures error)
-    arcpy.CopyFeatures_management(initial_candidates, sea_ice_fc)
+    with metrics.stage('copy'):
+        arcpy.CopyFeatures_management(initial_candidates, sea_ice_fc)
 
-    ## Date column based on src
-    date_col_lut = {
-            'dg': 'acqdate',
-            'mfp': 'acq_time',
-            'mfp_test': 'acq_time',
-            'nasa': 'ACQ_TIME',
-            'oh': 'acq_time'}
-    
     ## Add count field to output feature class
     fields = [field.name for field in arcpy.ListFields(sea_ice_fc)]
     concentration_field = 'sea_ice_concentration'
@@ -153,73 +61,148 @@ def coastline_sea_ice(src, initial_candidates, final_candidates, wd, gdb, ice_th
         arcpy.AddField_management(sea_ice_fc,
                               field_name=concentration_field,
                               field_type='DOUBLE')
-    
-    
-    #### TO DO: sort data, interpolate raster
+    ## Distance (km) from the centroid to the nearest valid pixel when its window was all no data
+    distance_field = 'sea_ice_distance'
+    ## Zonal mode: max concentration and ice-covered fraction over the whole footprint
+    max_field = 'sea_ice_max'
+    fraction_field = 'sea_ice_fraction'
+    for field in (distance_field, max_field, fraction_field):
+        if field not in fields:
+            arcpy.AddField_management(sea_ice_fc,
+                                  field_name=field,
+                                  field_type='DOUBLE')
+    ## 1 where the footprint's date had no raster and was interpolated from neighbouring days
+    interpolated_field = 'sea_ice_interpolated'
+    if interpolated_field not in fields:
+        arcpy.AddField_management(sea_ice_fc,
+                              field_name=interpolated_field,
+                              field_type='SHORT')
+    
+    
+    logger.info('Reading footprint centroids and dates...')
+    oids, ids, xs, ys, wkbs, dates = [], [], [], [], [], []
+    fields = ["OBJECTID", "SHAPE@XY", DATE_COL_LUT[src], ID_COL_LUT[src]] + (["SHAPE@WKB"] if zonal else [])
+    with metrics.stage('query'), arcpy.da.SearchCursor(sea_ice_fc, fields, spatial_reference=arcpy.SpatialReference(4326)) as cursor:
+        for row in cursor:
+            oids.append(row[0])
+            xs.append(row[1][0])
+            ys.append(row[1][1])
+            dates.append(str(row[2])[:10])
+            ids.append(row[3])
+            if zonal:
+                wkbs.append(bytes(row[4]))
+    metrics.count('rows_in', len(oids))
+    ids, xs, ys, dates = np.array(ids, dtype=str), np.array(xs), np.array(ys), np.array(dates)
+
     logger.info('Sampling rasters for ice concentration...')
-    with arcpy.da.UpdateCursor(sea_ice_fc, ["SHAPE@XY", date_col_lut[src], "OBJECTID", concentration_field]) as cursor:
+    if cube_dir is not None:
+        raster_source = cube_raster_source(cube_dir)
+        nearest_lookup = tile_lookup = None
+        available = cube_dates(cube_dir)
+        ## A hash of each day's slice, so a rebuilt cube invalidates results sampled from the old one
+        day_version = cube_day_version(cube_dir)
+    else:
+        def raster_lookup(pole, date):
+            return luts[pole].lookup(date, nearest=nearest_day, max_days=max_days)
+        ## Decoded rasters are shared across the run, bounded by cache_mb
+        raster_cache = RasterCache(max_mb=cache_mb)
+        raster_source = file_raster_source(raster_lookup, reader=raster_cache.read)
+        nearest_lookup = file_nearest_lookup(raster_lookup)
+        ## Per-tile statistics written by resample_loop settle many footprints without a pixel read
+        tile_lookup = file_tile_lookup(raster_lookup) if tile_summaries else None
+        available = {pole: lut.dates for pole, lut in luts.items()}
+        day_version = file_day_version(raster_lookup)
+    ## Reads the next prefetch_depth days in the background while a day is sampled
+    prefetcher = RasterPrefetcher(raster_source, depth=prefetch_depth, max_mb=prefetch_mb)
+    raster_source = prefetcher
+    if gap_fill:
+        ## Synthesize days with no raster from the nearest earlier and later days
+        raster_source = GapFiller(raster_source, available, max_gap_days=max_gap_days)
+
+    #### Reuse results of earlier runs whose rasters have not changed since
+    values = np.full((len(oids), len(RESULT_COLUMNS)), np.nan)
+    todo = np.arange(len(oids))
+    if reuse_results:
+        params = {'source': 'files' if cube_dir is None else 'cube', 'zonal': zonal, 'max_radius_km': max_radius_km,
+                  'nearest_day': nearest_day, 'max_days': max_days, 'gap_fill': gap_fill, 'max_gap_days': max_gap_days}
+        store = SamplingResultStore(os.path.join(wd, 'pickles', 'sea_ice_results.sqlite'), params=params)
+        ## Catalog ids are not unique in scene level sources, so key on each scene's centroid too
+        footprints = footprint_keys(ids, xs, ys, wkbs=wkbs if zonal else None)
+        with metrics.stage('result_lookup'):
+            versions = footprint_versions(ys, dates, raster_version(day_version, raster_source if gap_fill else None))
+            found, values = store.get(footprints, dates, versions)
+            todo = np.flatnonzero(~found)
+        store.log_stats(found)
+        metrics.count('rows_reused', found.sum())
+
+    ## Footprints whose weekly, monthly or seasonal maximum is ice free get 0 without a daily read
+    aggregates = SeaIceAggregates(aggregate_dir) if aggregate_dir is not None and not zonal else None
+    ## Only the days of footprints still to sample, in the order the sampler visits them
+    prefetcher.reschedule(sampling_order(ys[todo], dates[todo]))
+    with metrics.stage('sampling'):
+        if zonal:
+            ## Mean over every pixel of the footprint rather than around the centroid
+            stats = zonal_sea_ice([wkbs[i] for i in todo], dates[todo], raster_source)
+            concentrations = stats['mean']
+            distances = np.full(concentrations.shape, np.nan)
+            maxes, fractions = stats['max'], stats['ice_fraction']
+            interpolated = raster_source.flags(ys[todo], dates[todo]) if gap_fill else np.zeros(todo.shape, dtype=bool)
+        elif processes > 1:
+            ## Shards of whole days on a process pool, each worker with its own rasters and cache
+            sources = SourceFactory(wd, cube_dir=cube_dir, cache_mb=cache_mb, nearest_day=nearest_day, max_days=max_days,
+                                    gap_fill=gap_fill, max_gap_days=max_gap_days, tile_summaries=tile_summaries)
+            concentrations, distances, interpolated = sample_sea_ice_sharded(xs[todo], ys[todo], dates[todo], sources,
+                                                                             processes=processes, metrics=metrics,
+                                                                             max_radius_km=max_radius_km,
+                                                                             aggregates=aggregates)
+            maxes = fractions = np.full(concentrations.shape, np.nan)
+        else:
+            concentrations, distances = sample_sea_ice(xs[todo], ys[todo], dates[todo], raster_source,
+                                                       max_radius_km=max_radius_km, nearest_lookup=nearest_lookup,
+                                                       return_distance=True, metrics=metrics,
+                                                       aggregates=aggregates, tile_lookup=tile_lookup)
+            maxes = fractions = np.full(concentrations.shape, np.nan)
+            interpolated = raster_source.flags(ys[todo], dates[todo]) if gap_fill else np.zeros(todo.shape, dtype=bool)
+        values[todo] = np.column_stack([concentrations, distances, maxes, fractions, interpolated])
+    prefetcher.close()
+    if aggregates is not None:
+        aggregates.log_stats()
+        metrics.update(aggregates.stats(), prefix='aggregate_pruned_')
+    if processes <= 1 or zonal:
+        ## Stall time is how long sampling waited on rasters, raise prefetch_depth if it is high
+        prefetcher.log_stats()
+        metrics.update(prefetcher.stats(), prefix='prefetch_')
+    if reuse_results:
+        with metrics.stage('result_store'):
+            store.put(footprints[todo], dates[todo], versions[todo], values[todo])
+        store.close()
+    logger.info('Footprints sampled from interpolated rasters: {:,}'.format(int(np.nansum(values[:, 4]))))
+    concentration_lut = dict(zip(oids, values.tolist()))
+    metrics.count('rows_interpolated', np.nansum(values[:, 4]))
+    if cube_dir is None:
+        raster_cache.log_stats()
+        ## Cache misses are the rasters opened
+        metrics.update(raster_cache.stats(), prefix='raster_cache_')
+
+    logger.info('Writing ice concentrations...')
+    with metrics.stage('write'), arcpy.da.UpdateCursor(sea_ice_fc, ["OBJECTID", concentration_field, distance_field,
+                                                                 max_field, fraction_field, interpolated_field]) as cursor:
         for i, row in enumerate(cursor):
-            ## Get latitude to determine whether to sample arctic, antarctic, or neither
-    #        print(row[2])
             if i % 10000 == 0:
-                logging.info('Calculating sea ice on feature number: {}...'.format(i))
-            x, y = row[0][0], row[0][1]
-    
-            pole = choose_pole(y)
-            year, month, day = row[1][:10].split('-')
-            
-            if pole != None:
-                if pole == 'arctic':
-                    lut = arctic_lut
-                    epsg = 3413 # NSIDC Polar Stereographic North (same as sea-ice rasters)
-                elif pole == 'antarctic':
-                    lut = ant_lut
-                    epsg = 3412 # NSIDC Polar Stereographic South
-                
-                ## Coordinates of footprint centroid in projection of raster
-                center_prj = arcpy.PointGeometry(arcpy.Point(x, y),arcpy.SpatialReference(4326)).projectAs(arcpy.SpatialReference(epsg))
-                x_prj, y_prj = center_prj.centroid.X, center_prj.centroid.Y
-                
-                raster_p = lut[year][month][day]
-                raster = arcpy.Raster(raster_p)
-                
-                cell_height, cell_width = raster.meanCellHeight, raster.meanCellWidth
-                
-                lower_left = arcpy.Point(X=x_prj-(2*cell_width), Y=y_prj-(2*cell_height))
-                window_shape = (4,4)
-                ncols = window_shape[0]
-                nrows = window_shape[1]            
-    #            lower_left = arcpy.Point(raster.extent.XMin, raster.extent.YMin)
-                valid_values = False
-                while valid_values == False:
-                    sea_ice_arr = arcpy.RasterToNumPyArray(raster_p, 
-                                                              lower_left_corner=lower_left, 
-                                                              ncols=ncols, 
-                                                              nrows=nrows,
-                                                              nodata_to_value=None
-                                                              )
-                    sea_ice_arr = np.where(sea_ice_arr == -9999, np.nan, sea_ice_arr)
-                    
-                    if False in np.isnan(sea_ice_arr):
-                        concentration = int(np.nanmean(sea_ice_arr) / 10)
-                        row[3] = concentration
-    #                    print(concentration)
-                        valid_values = True
-                    else:
-                        if nrows > 10:
-                            valid_values = True
-                            concentration = 0
-    #                    print('growing...')
-                        nrows += 1
-                        ncols += 1
-                cursor.updateRow(row)
-            ## Nonpolar
-            else:
-    #            print('nonpolar')
-                row[3] = 0
-                cursor.updateRow(row)
+                logging.info('Writing sea ice on feature number: {}...'.format(i))
+            ## No valid pixels (within max_radius_km) - leave empty
+            values = concentration_lut[row[0]]
+            row[1:5] = [None if np.isnan(v) else v for v in values[:4]]
+            row[5] = int(values[4])
+            cursor.updateRow(row)
                 
     logging.info('Writing {}...'.format(final_candidates))
     where = """{} <= {}""".format(concentration_field, ice_threshold)
-    selection = arcpy.MakeFeatureLayer_management(sea_ice_fc, final_candidates, where_clause=where)
-    arcpy.CopyFeatures_management(selection, out_feature_class=final_candidates)
+    with metrics.stage('threshold_select'):
+        selection = arcpy.MakeFeatureLayer_management(sea_ice_fc, final_candidates, where_clause=where)
+        arcpy.CopyFeatures_management(selection, out_feature_class=final_candidates)
+        metrics.count('rows_out', int(arcpy.GetCount_management(selection)[0]))
+    
+    metrics.log()
+    if metrics_p:
+        metrics.write(metrics_p)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Attribute selection criteria and column names for each footprint source.
+
+Shared by the arcpy scripts and the arcpy-free pipeline.
+"""
+
+import sys
+
+
+## Catalog id column based on src
+ID_COL_LUT = {
+        'dg': 'catalogid',
+        'mfp': 'catalog_id',
+        'nasa': 'CATALOG_ID'}
+
+## Date column based on src
+DATE_COL_LUT = {
+        'dg': 'acqdate',
+        'mfp': 'acq_time',
+        'mfp_test': 'acq_time',
+        'nasa': 'ACQ_TIME',
+        'oh': 'acq_time'}
+
+## Sensor column based on src
+SENSOR_COL_LUT = {
+        'dg': 'platform',
+        'mfp': 'sensor',
+        'nasa': 'SENSOR'}
+
+#### Selection criteria
+#STATUS = 'online' ## Not currently being used
+CLOUDCOVER = 0.2
+SENSORS = ('WV02', 'WV03')
+PROD_CODE = 'M1BS'
+
+
+def selection_clause(src):
+    '''
+    Returns the selection criteria for a given source, master footprint or dg footprint
+    src: str 'mfp' or 'dg'
+    '''
+    cloudcover = CLOUDCOVER
+    sensors = SENSORS
+    prod_code = PROD_CODE
+    abscalfact = 'NOT NULL'
+    bandwith = 'NOT NULL'
+    sun_elev = 'NOT NULL'
+
+    if src == 'mfp':
+        where = f"""(cloudcover <= {cloudcover}) 
+            AND (sensor IN {sensors})
+            AND (prod_code = '{prod_code}')
+            AND (abscalfact IS {abscalfact}) 
+            AND (bandwidth IS {bandwith}) 
+            AND (sun_elev IS {sun_elev})"""
+#           AND (status = {status})"""
+
+    elif src == 'dg':
+        where = f"""(cloudcover <= {int(cloudcover*100)})
+            AND (platform IN {sensors})"""
+    
+    elif src == 'nasa':
+        where = f"""(CLOUDCOVER <= {cloudcover}) 
+            AND (SENSOR IN {sensors}) 
+            AND (PROD_CODE = '{prod_code}')
+            AND (ABSCALFACT IS {abscalfact}) 
+            AND (BANDWIDTH IS {bandwith}) 
+            AND (SUN_ELEV IS {sun_elev})"""
+#            AND (status = {status})"""
+            
+    else:
+        print('Unknown source for selection_clause(), must be one of "mfp" or "dg"')
+        sys.exit()
+
+    return where
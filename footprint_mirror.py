@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Local GeoParquet mirror of the footprint sources.
+
+Each source is copied once into {mirror_dir}/{src}, hive partitioned by
+sensor and acquisition year, with footprints as WKB in WGS84 and rows
+sorted by acquisition date within each file. Queries read only the
+columns they ask for and skip partitions and row groups whose statistics
+fail the selection criteria, instead of rescanning the source.
+
+With a modification timestamp column, a sync pulls only rows changed
+since the last sync and replaces earlier copies of those rows, matched on
+a unique row id, wherever they are in the mirror. Without one, rows added
+or reprocessed with an old acquisition date cannot be told apart, so each
+sync is a full resync that replaces the whole mirror.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from osgeo import ogr
+
+from coastline_selection import (CLOUDCOVER, DATE_COL_LUT, PROD_CODE, SENSOR_COL_LUT, SENSORS)
+from pipeline_metrics import setup_logging
+
+
+logger = logging.getLogger(__name__)
+
+
+GEOMETRY_COL = 'geometry'
+YEAR_COL = 'acq_year'
+
+## Column unique to each row, used to replace changed rows (catalog ids repeat across scenes of mfp and nasa)
+ROW_ID_COL_LUT = {
+        'dg': 'catalogid',
+        'mfp': 'scene_id',
+        'nasa': 'SCENE_ID'}
+
+## GeoParquet metadata for WKB footprints in WGS84 (the default CRS when crs is omitted)
+GEO_METADATA = {
+        'version': '1.0.0',
+        'primary_column': GEOMETRY_COL,
+        'columns': {GEOMETRY_COL: {'encoding': 'WKB', 'geometry_types': []}}}
+
+
+## Arrow types of OGR field types, anything else (e.g. dates) as strings
+OGR_ARROW_TYPES = {
+        ogr.OFTInteger: pa.int32(),
+        ogr.OFTInteger64: pa.int64(),
+        ogr.OFTReal: pa.float64()}
+
+
+def arrow_schema(lyr, skip=()):
+    '''
+    Returns the arrow schema of the mirror of an OGR layer: the WKB
+    geometry plus every attribute field not in skip.
+    '''
+    defn = lyr.GetLayerDefn()
+    fields = [pa.field(GEOMETRY_COL, pa.binary())]
+    for i in range(defn.GetFieldCount()):
+        field_defn = defn.GetFieldDefn(i)
+        if field_defn.GetName() not in skip:
+            fields.append(pa.field(field_defn.GetName(), OGR_ARROW_TYPES.get(field_defn.GetType(), pa.string())))
+
+    return pa.schema(fields, metadata={b'geo': json.dumps(GEO_METADATA).encode('utf-8')})
+
+
+def selection_expression(src):
+    '''
+    Returns a pyarrow dataset expression with the same criteria as
+    coastline_selection.selection_clause(src).
+    '''
+    if src == 'dg':
+        return (ds.field('cloudcover') <= int(CLOUDCOVER * 100)) & ds.field('platform').isin(list(SENSORS))
+
+    cols = {name: name.upper() if src == 'nasa' else name
+            for name in ('cloudcover', 'sensor', 'prod_code', 'abscalfact', 'bandwidth', 'sun_elev')}
+    expression = ((ds.field(cols['cloudcover']) <= CLOUDCOVER)
+                  & ds.field(cols['sensor']).isin(list(SENSORS))
+                  & (ds.field(cols['prod_code']) == PROD_CODE))
+    for name in ('abscalfact', 'bandwidth', 'sun_elev'):
+        expression = expression & ds.field(cols[name]).is_valid()
+
+    return expression
+
+
+class FootprintMirror(object):
+    '''
+    GeoParquet mirror of one footprint source.
+    mirror_dir: directory holding the mirrors of every source
+    src: 'mfp', 'nasa', or 'dg'
+    '''
+    def __init__(self, mirror_dir, src):
+        self.src = src
+        self.root = os.path.join(mirror_dir, src)
+        self.state_p = os.path.join(self.root, '_sync.json')
+        self.state = {}
+        if os.path.exists(self.state_p):
+            with open(self.state_p, 'r') as handle:
+                self.state = json.load(handle)
+
+
+    def __len__(self):
+        return self.state.get('rows', 0)
+
+
+    def save_state(self):
+        tmp_p = '{}.tmp'.format(self.state_p)
+        with open(tmp_p, 'w') as handle:
+            json.dump(self.state, handle)
+        os.replace(tmp_p, self.state_p)
+
+
+    def partition_dir(self, sensor, year):
+        return os.path.join(self.root, '{}={}'.format(SENSOR_COL_LUT[self.src], sensor), '{}={}'.format(YEAR_COL, year))
+
+
+    def to_table(self, batch, schema):
+        '''
+        Converts a batch from coastline_pipeline.read_batches to a table
+        with schema (from arrow_schema).
+        '''
+        columns = [pa.array(batch['wkb'].tolist(), type=pa.binary())]
+        for field in schema:
+            if field.name != GEOMETRY_COL:
+                columns.append(pa.array(batch[field.name].tolist(), type=field.type))
+
+        return pa.Table.from_arrays(columns, schema=schema)
+
+
+    def write_partition(self, table, sensor, year, name):
+        part_dir = self.partition_dir(sensor, year)
+        os.makedirs(part_dir, exist_ok=True)
+        ## Sorted by date so row group date statistics are tight
+        table = table.sort_by(DATE_COL_LUT[self.src])
+        part_p = os.path.join(part_dir, '{}.parquet'.format(name))
+        ## Dot files are skipped when the mirror is read
+        tmp_p = os.path.join(part_dir, '.{}.tmp'.format(name))
+        pq.write_table(table, tmp_p, row_group_size=65536, compression='zstd')
+        os.replace(tmp_p, part_p)
+
+        return part_p
+
+
+    def sync(self, src_p, src_layer=None, changed_col=None, row_id_col=None, batch_size=100000):
+        '''
+        Pulls rows added or changed since the last sync into the mirror, the
+        whole source on the first sync or without changed_col. Returns the
+        number of rows pulled.
+        src_p: OGR datasource of the source footprint
+        changed_col: modification timestamp column, set whenever a row is
+                     added or changed; without it every sync is a full resync
+        row_id_col: column unique to each row, ROW_ID_COL_LUT[src] if None
+        '''
+        ## Imported here as coastline_pipeline reads from the mirror
+        from coastline_pipeline import read_batches
+
+        src_ds = ogr.Open(src_p)
+        lyr = src_ds.GetLayerByName(src_layer) if src_layer else src_ds.GetLayer(0)
+        ## The sensor column is held by the partition path
+        schema = arrow_schema(lyr, skip=(SENSOR_COL_LUT[self.src], ))
+        row_id_col = row_id_col or ROW_ID_COL_LUT[self.src]
+        synced_through = self.state.get('synced_through')
+        incremental = (changed_col is not None and synced_through is not None
+                       and self.state.get('watermark_col') == changed_col)
+        if incremental:
+            if schema.get_field_index(row_id_col) == -1:
+                raise ValueError('Row id column {} is not in {}, pass row_id_col to sync incrementally.'.format(
+                    row_id_col, src_p))
+            lyr.SetAttributeFilter("{} > '{}'".format(changed_col, synced_through))
+        else:
+            logger.info('Full resync of {} into {}.'.format(self.src, self.root))
+
+        ## Files from earlier syncs, which may hold older copies of pulled rows
+        earlier_files = set(glob.glob(os.path.join(self.root, '*', '*', '*.parquet')))
+        sync_id = uuid.uuid4().hex[:12]
+        pulled_ids = set()
+        rows = 0
+        latest = synced_through if incremental else None
+        for i, batch in enumerate(read_batches(lyr, batch_size)):
+            sensors = batch[SENSOR_COL_LUT[self.src]].astype(str)
+            dates = batch[DATE_COL_LUT[self.src]].astype(str)
+            years = np.array([d[:4] for d in dates])
+            table = self.to_table(batch, schema)
+            for sensor, year in set(zip(sensors.tolist(), years.tolist())):
+                in_part = np.flatnonzero((sensors == sensor) & (years == year))
+                self.write_partition(table.take(in_part), sensor, year, 'part-{}-{:05d}'.format(sync_id, i))
+            if incremental:
+                pulled_ids.update(batch[row_id_col].astype(str))
+            if changed_col is not None:
+                watermarks = [str(w) for w in batch[changed_col] if w is not None]
+                latest = max([latest] + watermarks if latest else watermarks, default=latest)
+            rows += batch['wkb'].size
+            logger.info('Synced {:,} {} rows...'.format(rows, self.src))
+        src_ds = None
+
+        if incremental:
+            self.drop_replaced(earlier_files, pulled_ids, row_id_col)
+        else:
+            ## Every row was just written again
+            for part_p in earlier_files:
+                os.remove(part_p)
+
+        self.state.update({'synced_through': latest, 'watermark_col': changed_col,
+                           'rows': self.count_rows()})
+        self.save_state()
+        logger.info('Pulled {:,} {} rows into {} ({:,} rows).'.format(rows, self.src, self.root, len(self)))
+
+        return rows
+
+
+    def drop_replaced(self, earlier_files, pulled_ids, row_id_col):
+        '''
+        Rewrites files from earlier syncs without the rows that were pulled
+        again. Every partition is checked, as a changed row may have moved
+        to another sensor or year.
+        '''
+        if not pulled_ids:
+            return
+        pulled_ids = list(pulled_ids)
+        for part_p in sorted(earlier_files):
+            ## Only the id column is read to find files holding pulled rows
+            ids = pq.read_table(part_p, columns=[row_id_col]).column(row_id_col).to_pylist()
+            keep = ~np.isin(np.array(ids, dtype=str), pulled_ids)
+            if keep.all():
+                continue
+            logger.info('Replacing {:,} rows in {}.'.format((~keep).sum(), part_p))
+            table = pq.read_table(part_p)
+            tmp_p = os.path.join(os.path.dirname(part_p), '.{}.tmp'.format(os.path.basename(part_p)))
+            pq.write_table(table.filter(pa.array(keep)), tmp_p, row_group_size=65536, compression='zstd')
+            os.replace(tmp_p, part_p)
+
+
+    def dataset(self):
+        return ds.dataset(self.root, format='parquet', partitioning='hive')
+
+
+    def count_rows(self):
+        return self.dataset().count_rows() if os.path.isdir(self.root) else 0
+
+
+    def read(self, columns=None, where=None):
+        '''
+        Returns a table of the mirrored rows matching where, reading only
+        columns (all if None).
+        where: pyarrow dataset expression, e.g. selection_expression(src)
+        '''
+        return self.dataset().to_table(columns=columns, filter=where)
+
+
+    def batches(self, batch_size=50000, where=None):
+        '''
+        Yields record batches in the format of coastline_pipeline.read_batches.
+        '''
+        scanner = self.dataset().scanner(filter=where, batch_size=batch_size)
+        for record_batch in scanner.to_batches():
+            if record_batch.num_rows == 0:
+                continue
+            batch = {'wkb': np.array(record_batch.column(GEOMETRY_COL).to_pylist(), dtype=object)}
+            for name in record_batch.schema.names:
+                if name not in (GEOMETRY_COL, YEAR_COL):
+                    batch[name] = np.array(record_batch.column(name).to_pylist(), dtype=object)
+            yield batch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src', type=str, choices=['mfp', 'dg', 'nasa'],
+                        help='Footprint source to mirror.')
+    parser.add_argument('src_path', type=str,
+                        help='OGR datasource of the source footprint, e.g. the imagery index gdb.')
+    parser.add_argument('mirror_dir', type=str,
+                        help='Directory holding the mirrors.')
+    parser.add_argument('--src_layer', type=str,
+                        help='Layer within src_path. Default = first layer')
+    parser.add_argument('--changed_col', type=str,
+                        help='Modification timestamp column used to find new and changed rows. '
+                             'Default = none, every sync is a full resync')
+    parser.add_argument('--row_id_col', type=str,
+                        help='Column unique to each row. Default = catalogid for dg, scene_id for mfp, SCENE_ID for nasa')
+    parser.add_argument('--batch_size', type=int, default=100000,
+                        help='Rows read per batch. Default = 100000')
+
+    args = parser.parse_args()
+
+    setup_logging()
+
+    FootprintMirror(args.mirror_dir, args.src).sync(args.src_path, src_layer=args.src_layer,
+                                                    changed_col=args.changed_col, row_id_col=args.row_id_col,
+                                                    batch_size=args.batch_size)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Run instrumentation for the coastline pipeline.
+
+Stages are timed for wall and CPU time, counters are accumulated by name,
+and an optional cProfile of the timed stages is saved next to the metrics.
+Each run is written out as one JSON file, so production runs show where
+the time goes without reading the logs.
+"""
+
+from collections import OrderedDict
+import contextlib
+import cProfile
+import json
+import logging
+import numbers
+import os
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def setup_logging(level=logging.INFO):
+    '''
+    Sets the root logger level and adds a stdout handler to it, once,
+    however many times it is called from one driver.
+    '''
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not any(getattr(handler, 'coastline_stdout', False) for handler in root.handlers):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        handler.coastline_stdout = True
+        root.addHandler(handler)
+
+    return root
+
+
+class RunMetrics(object):
+    '''
+    Wall and CPU time per stage plus named counters for one run. Counters
+    keep counts as integers and amounts (seconds, megabytes) as floats.
+    CPU time is for this process only, not worker processes.
+    name: name of the run, e.g. the function being instrumented
+    profile: collect a cProfile of the timed stages
+    '''
+    def __init__(self, name, profile=False):
+        self.name = name
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.profiler = cProfile.Profile() if profile else None
+        self.depth = 0
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Times the enclosed block, adding to the stage's totals if it runs
+        more than once (e.g. once per batch).
+        '''
+        totals = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'calls': 0})
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self.profiler is not None and self.depth == 0:
+            self.profiler.enable()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if self.profiler is not None and self.depth == 0:
+                self.profiler.disable()
+            totals['wall_s'] += time.perf_counter() - wall
+            totals['cpu_s'] += time.process_time() - cpu
+            totals['calls'] += 1
+
+
+    def count(self, name, n=1):
+        ## Floats (e.g. seconds stalled) are kept, numpy integers made JSON serializable
+        n = int(n) if isinstance(n, numbers.Integral) else float(n)
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def update(self, counters, prefix=''):
+        '''
+        Adds a dictionary of counts, e.g. RasterCache.stats(), under prefix.
+        '''
+        for name, n in counters.items():
+            self.count('{}{}'.format(prefix, name), n)
+
+
+    def to_dict(self):
+        return {
+                'name': self.name,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_s': round(time.time() - self.started, 3),
+                'stages': {name: {k: round(v, 3) for k, v in totals.items()} for name, totals in self.stages.items()},
+                'counters': {name: round(n, 3) if isinstance(n, float) else n for name, n in self.counters.items()},
+                }
+
+
+    def log(self):
+        for name, totals in self.stages.items():
+            logger.info('{} - {}: {:.1f} s wall, {:.1f} s cpu ({} calls)'.format(
+                self.name, name, totals['wall_s'], totals['cpu_s'], totals['calls']))
+        logger.info('{} - {}'.format(self.name, ', '.join(
+                '{}: {:,.3f}'.format(k, v) if isinstance(v, float) else '{}: {:,}'.format(k, v)
+                for k, v in self.counters.items())))
+
+
+    def write(self, metrics_p):
+        '''
+        Writes the metrics as JSON to metrics_p, and the profile, if any,
+        to the same path with a .prof extension.
+        '''
+        out_dir = os.path.dirname(metrics_p)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        tmp_p = '{}.tmp'.format(metrics_p)
+        with open(tmp_p, 'w') as handle:
+            json.dump(self.to_dict(), handle, indent=2)
+        os.replace(tmp_p, metrics_p)
+        if self.profiler is not None:
+            self.profiler.dump_stats('{}.prof'.format(os.path.splitext(metrics_p)[0]))
+        logger.info('Wrote run metrics to {}.'.format(metrics_p))
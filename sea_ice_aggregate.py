@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Weekly, monthly and seasonal maximum sea-ice concentration rasters, used
+to settle footprints that are surely ice free without reading their day.
+
+The daily rasters of each period are streamed into a per-pixel maximum
+and a mask of pixels valid on every day of the period, saved as
+{aggregate_dir}/{pole}/{period}/{key}.npz. A footprint is ice free on a
+day in the period if every pixel of its sampling window stays below 10
+(0 once divided by 10 and truncated) and at least one of them is always
+valid, so its window can never fall back to a farther pixel. Its daily
+concentration is then surely 0, the same value the daily read would give.
+
+The aggregates are updated incrementally: new days are folded into their
+periods, and a period holding a day that was rewritten (e.g. reprocessed
+by resample_loop) is rebuilt from its days.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import os
+
+import numpy as np
+
+from pipeline_metrics import setup_logging
+from sea_ice_cube import find_concentration_rasters
+from sea_ice_results import file_version
+from sea_ice_sampling import ICE_FREE_BELOW, read_sea_ice_raster, window_origins
+
+
+logger = logging.getLogger(__name__)
+
+
+## Coarsest first, the order they are checked in
+PERIODS = ('season', 'month', 'week')
+
+SEASONS = ('DJF', 'MAM', 'JJA', 'SON')
+
+## Pole of a raster from the first letter of its name, e.g. N_19851126_concentration_v3.0.tif
+POLE_PREFIX = {'N': 'arctic', 'S': 'antarctic'}
+
+
+def period_key(period, date):
+    '''
+    Returns the key of the period holding date: the first day of its week
+    (seven day periods from 1970-01-01), 'YYYY-MM', or 'YYYY-DJF' etc, where
+    December belongs to the following year's DJF.
+    '''
+    date = np.datetime64(date, 'D')
+    if period == 'week':
+        return str(date.astype('datetime64[W]').astype('datetime64[D]'))
+    if period == 'month':
+        return str(date.astype('datetime64[M]'))
+    if period == 'season':
+        month = date.astype('datetime64[M]').astype(int) % 12 + 1
+        year = date.astype('datetime64[Y]').astype(int) + 1970 + (month == 12)
+        return '{}-{}'.format(year, SEASONS[(month % 12) // 3])
+    raise ValueError('Unknown period: {}'.format(period))
+
+
+def aggregate_path(aggregate_dir, pole, period, key):
+    return os.path.join(aggregate_dir, pole, period, '{}.npz'.format(key))
+
+
+def load_aggregate(aggregate_p):
+    '''
+    Returns the saved aggregate as a dictionary of max, always_valid, gt
+    and days (a set of date strings), or None if there is none.
+    '''
+    if not os.path.exists(aggregate_p):
+        return None
+    with np.load(aggregate_p) as npz:
+        return {'max': npz['max'], 'always_valid': npz['always_valid'], 'gt': tuple(npz['gt'].tolist()),
+                'days': set(npz['days'].tolist())}
+
+
+def save_aggregate(aggregate, aggregate_p):
+    os.makedirs(os.path.dirname(aggregate_p), exist_ok=True)
+    ## np.savez appends .npz to names without it, so write to a .npz temp file
+    tmp_p = '{}.tmp.npz'.format(os.path.splitext(aggregate_p)[0])
+    np.savez_compressed(tmp_p, max=aggregate['max'], always_valid=aggregate['always_valid'],
+                        gt=np.array(aggregate['gt']), days=np.array(sorted(aggregate['days']), dtype=str))
+    os.replace(tmp_p, aggregate_p)
+
+
+def fold_day(aggregate, arr, gt, date):
+    '''
+    Folds one day's raster (no data as NaN) into an aggregate, starting one
+    if aggregate is None. Folding a day twice has no further effect.
+    '''
+    valid = ~np.isnan(arr)
+    if aggregate is None:
+        return {'max': arr.astype(np.float32), 'always_valid': valid, 'gt': tuple(gt), 'days': {str(date)}}
+    if arr.shape != aggregate['max'].shape:
+        logger.warning('Skipping {}: grid {} does not match aggregate grid {}'.format(
+            date, arr.shape, aggregate['max'].shape))
+        return aggregate
+    aggregate['max'] = np.fmax(aggregate['max'], arr.astype(np.float32))
+    aggregate['always_valid'] &= valid
+    aggregate['days'].add(str(date))
+
+    return aggregate
+
+
+def update_aggregates(resampled_dir, aggregate_dir, pole, periods=PERIODS):
+    '''
+    Brings the pole's aggregates up to date with the concentration rasters
+    in resampled_dir, reading only new days and the days of periods holding
+    a changed or removed day. Returns the number of days read.
+    resampled_dir: directory of rasters written by resample_loop for one pole
+    aggregate_dir: directory to write the aggregates to
+    pole: 'arctic' or 'antarctic'
+    '''
+    index_p = os.path.join(aggregate_dir, '{}_aggregate_index.json'.format(pole))
+    index = {}
+    if os.path.exists(index_p):
+        with open(index_p, 'r') as handle:
+            index = json.load(handle)
+
+    rasters = {date: raster_p for date, raster_p in find_concentration_rasters(resampled_dir).items()
+               if POLE_PREFIX.get(os.path.basename(raster_p)[0]) == pole}
+    versions = {date: file_version(raster_p) for date, raster_p in rasters.items()}
+    changed = [date for date in index if versions.get(date) != index[date]]
+    new = {date for date in versions if date not in index}
+    if not changed and not new:
+        logger.info('{} aggregates are up to date ({:,} days).'.format(pole, len(index)))
+        return 0
+
+    ## Periods with a changed day are rebuilt from all their days, others only fold in new days
+    rebuild = {period: {period_key(period, date) for date in changed} for period in periods}
+    keys = {period: {date: period_key(period, date) for date in versions} for period in periods}
+    reads = {}
+    for period in periods:
+        for date, key in keys[period].items():
+            if key in rebuild[period] or date in new:
+                reads.setdefault(date, []).append((period, key))
+    logger.info('Updating {} aggregates: {:,} new and {:,} changed days, {:,} days to read...'.format(
+        pole, len(new), len(changed), len(reads)))
+
+    ## Days are read in order, so each period's days are contiguous and it is saved once complete
+    current = {}
+    def flush(period):
+        key, aggregate = current.pop(period)
+        if aggregate is not None:
+            save_aggregate(aggregate, aggregate_path(aggregate_dir, pole, period, key))
+
+    for date in sorted(reads):
+        arr, gt = read_sea_ice_raster(rasters[date])
+        for period, key in reads[date]:
+            if period in current and current[period][0] != key:
+                flush(period)
+            if period not in current:
+                start = None if key in rebuild[period] else load_aggregate(aggregate_path(aggregate_dir, pole, period, key))
+                current[period] = (key, start)
+            current[period] = (key, fold_day(current[period][1], arr, gt, date))
+    for period in list(current):
+        flush(period)
+
+    ## Periods left with no days once their changed days were removed
+    for period in periods:
+        for key in rebuild[period] - set(keys[period].values()):
+            aggregate_p = aggregate_path(aggregate_dir, pole, period, key)
+            if os.path.exists(aggregate_p):
+                os.remove(aggregate_p)
+
+    os.makedirs(aggregate_dir, exist_ok=True)
+    tmp_p = '{}.tmp'.format(index_p)
+    with open(tmp_p, 'w') as handle:
+        json.dump(versions, handle)
+    os.replace(tmp_p, index_p)
+
+    return len(reads)
+
+
+def window_ice_free(aggregate, rows, cols, window=4):
+    '''
+    Returns a boolean array, True where every pixel of the window stays
+    below ICE_FREE_BELOW and at least one is valid on every day.
+    rows, cols: cell holding the lower left corner of each window, as from
+                sea_ice_sampling.window_origins
+    '''
+    pad = window
+    peak = np.pad(aggregate['max'], pad, mode='constant', constant_values=np.nan)
+    always_valid = np.pad(aggregate['always_valid'], pad, mode='constant', constant_values=False)
+    ## Rows run upward from the lower left corner, columns rightward, as in window_means
+    offsets = np.arange(window)
+    r = np.clip(rows[:, None] + pad - offsets[::-1], 0, peak.shape[0] - 1)
+    c = np.clip(cols[:, None] + pad + offsets, 0, peak.shape[1] - 1)
+    values = peak[r[:, :, None], c[:, None, :]]
+
+    below = (np.isnan(values) | (values < ICE_FREE_BELOW)).all(axis=(1, 2))
+
+    return below & always_valid[r[:, :, None], c[:, None, :]].any(axis=(1, 2))
+
+
+class SeaIceAggregates(object):
+    '''
+    Reader of the aggregates for sea_ice_sampling.sample_sea_ice.
+    aggregate_dir: directory written by update_aggregates
+    periods: periods to check, coarsest first
+    max_cached: number of aggregates to keep loaded
+    '''
+    def __init__(self, aggregate_dir, periods=PERIODS, max_cached=32):
+        self.aggregate_dir = aggregate_dir
+        self.periods = tuple(periods)
+        self.max_cached = max_cached
+        self.loaded = OrderedDict()
+        self.pruned = {period: 0 for period in self.periods}
+
+
+    def __getstate__(self):
+        ## Sent to worker processes without the loaded aggregates
+        state = self.__dict__.copy()
+        state['loaded'] = OrderedDict()
+        return state
+
+
+    def aggregate(self, pole, period, key):
+        if (pole, period, key) in self.loaded:
+            self.loaded.move_to_end((pole, period, key))
+            return self.loaded[(pole, period, key)]
+        aggregate = load_aggregate(aggregate_path(self.aggregate_dir, pole, period, key))
+        self.loaded[(pole, period, key)] = aggregate
+        while len(self.loaded) > self.max_cached:
+            self.loaded.popitem(last=False)
+
+        return aggregate
+
+
+    def ice_free(self, pole, date, x_prj, y_prj, window=4):
+        '''
+        Returns a boolean array, True for footprints whose concentration on
+        date is surely 0. Periods are checked coarsest first, each only for
+        footprints not already settled. A period is only used if date is one
+        of its days, so gap filled days are never settled.
+        x_prj, y_prj: footprint centroids in the pole's projection
+        '''
+        free = np.zeros(np.shape(x_prj), dtype=bool)
+        for period in self.periods:
+            pending = np.flatnonzero(~free)
+            if pending.size == 0:
+                break
+            aggregate = self.aggregate(pole, period, period_key(period, date))
+            if aggregate is None or str(date) not in aggregate['days']:
+                continue
+            rows, cols = window_origins(aggregate['gt'], x_prj[pending], y_prj[pending])
+            settled = pending[window_ice_free(aggregate, rows, cols, window=window)]
+            free[settled] = True
+            self.pruned[period] += settled.size
+
+        return free
+
+
+    def stats(self):
+        return dict(self.pruned)
+
+
+    def log_stats(self):
+        logger.info('Aggregate pruning - {}'.format(', '.join('{}: {:,}'.format(p, n) for p, n in self.pruned.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('resampled_directory', type=str,
+                        help='Directory of resampled rasters for one pole, as written by sea_ice_nodata.py.')
+    parser.add_argument('aggregate_directory', type=str,
+                        help='Directory to write the aggregates to.')
+    parser.add_argument('pole', type=str, choices=['arctic', 'antarctic'],
+                        help='Pole the rasters cover.')
+
+    args = parser.parse_args()
+
+    setup_logging()
+    update_aggregates(args.resampled_directory, args.aggregate_directory, args.pole)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded, least-recently-used cache of decoded sea-ice rasters.
+
+Holds the decoded array and geotransform of each raster keyed by path so
+that footprints sharing an acquisition date cost a dictionary lookup
+rather than a file open and decode. Safe to share between threads, e.g.
+with sea_ice_prefetch reading ahead in the background.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+from sea_ice_sampling import read_sea_ice_raster
+
+
+logger = logging.getLogger(__name__)
+
+
+class RasterCache(object):
+    '''
+    LRU cache of (array, geotransform) keyed by raster path.
+    reader: function taking a raster path and returning (array, geotransform)
+    max_mb: memory budget for cached arrays, in megabytes
+    '''
+    def __init__(self, reader=read_sea_ice_raster, max_mb=512):
+        self.reader = reader
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        ## Guards entries and counters, not the reads themselves
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, raster_p):
+        return raster_p in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def read(self, raster_p):
+        '''
+        Returns (array, geotransform) for raster_p, reading it on a miss.
+        '''
+        with self.lock:
+            if raster_p in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(raster_p)
+                return self.entries[raster_p]
+            self.misses += 1
+
+        arr, gt = self.reader(raster_p)
+        self.put(raster_p, arr, gt)
+
+        return arr, gt
+
+
+    def put(self, raster_p, arr, gt):
+        '''
+        Adds a decoded raster, evicting the least recently used until it
+        fits. Rasters larger than the whole budget are not cached.
+        '''
+        with self.lock:
+            if raster_p in self.entries:
+                self.nbytes -= self.entries.pop(raster_p)[0].nbytes
+            if arr.nbytes > self.max_bytes:
+                return
+            while self.entries and self.nbytes + arr.nbytes > self.max_bytes:
+                evicted_arr, _gt = self.entries.popitem(last=False)[1]
+                self.nbytes -= evicted_arr.nbytes
+                self.evictions += 1
+            self.entries[raster_p] = (arr, gt)
+            self.nbytes += arr.nbytes
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'mb': round(self.nbytes / (1024 * 1024), 1),
+                    }
+
+
+    def log_stats(self):
+        logger.info('Raster cache - hits: {hits:,}, misses: {misses:,}, evictions: {evictions:,}, '
+                    'entries: {entries:,} ({mb} MB)'.format(**self.stats()))
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Stacks the resampled daily sea-ice concentration rasters into a single
+on-disk cube per pole, shaped (day, y, x).
+
+Each cube is a raw binary file read through np.memmap, with a JSON index
+next to it holding the dtype, grid shape, geotransform, projection, no
+data value, scale and offset and the date of each slice. Cubes built from
+compact (Byte percent) rasters take half the space of Int16 ones. New
+days are appended to the end of the binary file, so updating the cube
+never rewrites existing days.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal, gdal_array
+
+from pipeline_metrics import setup_logging
+from sea_ice_sampling import RESAMPLED_NODATA, unscale
+
+
+gdal.UseExceptions()
+
+logger = logging.getLogger(__name__)
+
+
+def cube_paths(cube_dir, pole):
+    '''
+    Returns the paths to the binary data and JSON index of a pole's cube.
+    '''
+    data_p = os.path.join(cube_dir, '{}_concentration.dat'.format(pole))
+    index_p = os.path.join(cube_dir, '{}_concentration_index.json'.format(pole))
+
+    return data_p, index_p
+
+
+def find_concentration_rasters(resampled_dir):
+    '''
+    Returns a dictionary of date string (YYYY-MM-DD) to path for every
+    *_concentration_v3.0.tif under resampled_dir.
+    '''
+    rasters = {}
+    for root, dirs, files in os.walk(resampled_dir):
+        for f in files:
+            if f.endswith('_concentration_v3.0.tif'):
+                date = f.split('_')[1] # f format: N_19851126_concentration_v3.0.tif
+                rasters['{}-{}-{}'.format(date[0:4], date[4:6], date[6:8])] = os.path.join(root, f)
+
+    return rasters
+
+
+def load_index(index_p):
+    with open(index_p, 'r') as handle:
+        return json.load(handle)
+
+
+def write_index(index, index_p):
+    ## Write to a temporary file and swap in so a crash never leaves a partial index
+    tmp_p = '{}.tmp'.format(index_p)
+    with open(tmp_p, 'w') as handle:
+        json.dump(index, handle)
+    os.replace(tmp_p, index_p)
+
+
+def build_cube(resampled_dir, cube_dir, pole):
+    '''
+    Appends any concentration rasters not yet in the pole's cube.
+    resampled_dir: directory of rasters written by resample_loop for one pole
+    cube_dir: directory to write the cube to
+    pole: 'arctic' or 'antarctic', used to name the cube
+    '''
+    os.makedirs(cube_dir, exist_ok=True)
+    data_p, index_p = cube_paths(cube_dir, pole)
+
+    rasters = find_concentration_rasters(resampled_dir)
+    index = load_index(index_p) if os.path.exists(index_p) else None
+    existing = set(index['dates']) if index else set()
+    new_dates = sorted(d for d in rasters if d not in existing)
+    if not new_dates:
+        logger.info('{} cube is up to date ({:,} days).'.format(pole, len(existing)))
+        return index
+
+    if index is None:
+        ## Take the grid and data type from the first raster
+        ds = gdal.Open(rasters[new_dates[0]])
+        band = ds.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        index = {
+                'dtype': np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)).str,
+                'shape': [ds.RasterYSize, ds.RasterXSize],
+                'geotransform': list(ds.GetGeoTransform()),
+                'projection': ds.GetProjectionRef(),
+                'nodata': RESAMPLED_NODATA if nodata is None else nodata,
+                'scale': band.GetScale() or 1.0,
+                'offset': band.GetOffset() or 0.0,
+                'dates': [],
+                }
+        ds = None
+
+    dtype = np.dtype(index['dtype'])
+    shape = tuple(index['shape'])
+    frame_bytes = dtype.itemsize * shape[0] * shape[1]
+
+    logger.info('Appending {:,} days to the {} cube...'.format(len(new_dates), pole))
+    mode = 'r+b' if os.path.exists(data_p) else 'wb'
+    with open(data_p, mode) as handle:
+        ## Drop any bytes from an append that crashed before its index was written
+        handle.truncate(frame_bytes * len(index['dates']))
+        handle.seek(0, os.SEEK_END)
+        for date in new_dates:
+            ds = gdal.Open(rasters[date])
+            if (ds.RasterYSize, ds.RasterXSize) != shape:
+                logger.warning('Skipping {}: grid {} does not match cube grid {}'.format(
+                    rasters[date], (ds.RasterYSize, ds.RasterXSize), shape))
+                continue
+            band = ds.GetRasterBand(1)
+            encoding = (np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)).str,
+                        band.GetScale() or 1.0, band.GetOffset() or 0.0)
+            if encoding != (index['dtype'], index.get('scale', 1.0), index.get('offset', 0.0)):
+                ## e.g. a compact raster appended to a full cube, rebuild the cube instead
+                logger.warning('Skipping {}: dtype, scale and offset {} do not match the cube'.format(
+                    rasters[date], encoding))
+                continue
+            arr = ds.ReadAsArray()
+            ds = None
+            frame = np.ascontiguousarray(arr, dtype=dtype).tobytes()
+            handle.write(frame)
+            index['dates'].append(date)
+            index.setdefault('hashes', {})[date] = hashlib.sha1(frame).hexdigest()[:16]
+        handle.flush()
+        os.fsync(handle.fileno())
+
+    write_index(index, index_p)
+
+    return index
+
+
+def open_cube(cube_dir, pole):
+    '''
+    Returns a read-only memmap of the pole's cube, shaped (day, y, x), and
+    its index with an added 'slices' date-to-slice lookup.
+    '''
+    data_p, index_p = cube_paths(cube_dir, pole)
+    index = load_index(index_p)
+    shape = (len(index['dates']), ) + tuple(index['shape'])
+    cube = np.memmap(data_p, dtype=np.dtype(index['dtype']), mode='r', shape=shape)
+    index['slices'] = {date: i for i, date in enumerate(index['dates'])}
+
+    return cube, index
+
+
+def open_cubes(cube_dir, poles=('arctic', 'antarctic')):
+    '''
+    Returns a dictionary of pole to (cube, index) from open_cube for the
+    poles with a cube in cube_dir, e.g. only arctic if only it was built.
+    '''
+    cubes = {}
+    for pole in poles:
+        if not os.path.exists(cube_paths(cube_dir, pole)[1]):
+            logger.warning('No {} cube in {}, its footprints will not be sampled.'.format(pole, cube_dir))
+            continue
+        cubes[pole] = open_cube(cube_dir, pole)
+
+    return cubes
+
+
+def cube_dates(cube_dir, poles=('arctic', 'antarctic')):
+    '''
+    Returns a dictionary of pole to the dates in its cube, for the poles
+    with a cube.
+    '''
+    return {pole: index['dates'] for pole, (cube, index) in open_cubes(cube_dir, poles).items()}
+
+
+def cube_raster_source(cube_dir, poles=('arctic', 'antarctic')):
+    '''
+    Returns a raster source for sea_ice_sampling.sample_sea_ice that reads
+    days from the memmapped cubes instead of opening GeoTIFFs.
+    '''
+    cubes = open_cubes(cube_dir, poles)
+
+    def source(pole, date):
+        if pole not in cubes:
+            return None
+        cube, index = cubes[pole]
+        if str(date) not in index['slices']:
+            return None
+        arr = cube[index['slices'][str(date)]].astype(np.float64)
+        arr[arr == index['nodata']] = np.nan
+        arr[arr == RESAMPLED_NODATA] = np.nan
+        unscale(arr, index.get('scale'), index.get('offset'))
+        return arr, tuple(index['geotransform'])
+
+    return source
+
+
+def cube_day_version(cube_dir, poles=('arctic', 'antarctic')):
+    '''
+    Returns a function taking (pole, date) and returning the version of
+    that day's cube slice, None if the cube has no such day. The version is
+    a hash of the slice with the cube's encoding, so a cube rebuilt from
+    other rasters (e.g. compact ones) gives new versions.
+    '''
+    cubes = open_cubes(cube_dir, poles)
+
+    def day_version(pole, date):
+        if pole not in cubes:
+            return None
+        cube, index = cubes[pole]
+        date = str(date)
+        if date not in index['slices']:
+            return None
+        hashes = index.setdefault('hashes', {})
+        if date not in hashes:
+            ## Cubes built before slices were hashed
+            hashes[date] = hashlib.sha1(np.ascontiguousarray(cube[index['slices'][date]]).tobytes()).hexdigest()[:16]
+        return 'cube:{}:{}:{}:{}'.format(index['dtype'], index.get('scale', 1.0), index.get('offset', 0.0), hashes[date])
+
+    return day_version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('resampled_directory', type=str,
+                        help='Directory of resampled rasters for one pole, as written by sea_ice_nodata.py.')
+    parser.add_argument('cube_directory', type=str,
+                        help='Directory to write the cube to.')
+    parser.add_argument('pole', type=str, choices=['arctic', 'antarctic'],
+                        help='Pole the rasters cover.')
+
+    args = parser.parse_args()
+
+    setup_logging()
+    build_cube(args.resampled_directory, args.cube_directory, args.pole)
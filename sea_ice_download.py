@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental sync of the NSIDC daily sea-ice GeoTIFFs (G02135) over FTP.
+
+Files are fetched concurrently over a small pool of reused FTP
+connections, resumed from partial downloads, written atomically into
+out_dir/{north|south}/daily/geotiff/YYYY/MM, and recorded in a size and
+checksum manifest so files already on disk are skipped on the next run.
+The host, port and root are parameters so the sync can be pointed at a
+local FTP server.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from ftplib import FTP, error_perm, error_reply, error_temp
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+NSIDC_HOST = 'sidads.colorado.edu'
+NSIDC_ROOT = '/DATASETS/NOAA/G02135'
+
+
+class FTPPool(object):
+    '''
+    Pool of reusable, logged in FTP connections.
+    size: maximum number of open connections
+    '''
+    def __init__(self, host=NSIDC_HOST, port=21, user='', passwd='', size=4, timeout=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+
+    def connect(self):
+        ftp = FTP()
+        ftp.connect(self.host, self.port, timeout=self.timeout)
+        ftp.login(self.user, self.passwd)
+
+        return ftp
+
+
+    @contextmanager
+    def connection(self):
+        '''
+        Yields an idle connection, opening one if none are free. Connections
+        that raise are closed rather than returned to the pool.
+        '''
+        self.slots.acquire()
+        try:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                ftp = self.connect()
+            try:
+                yield ftp
+            except Exception:
+                ftp.close()
+                raise
+            self.idle.put(ftp)
+        finally:
+            self.slots.release()
+
+
+    def close(self):
+        while not self.idle.empty():
+            ftp = self.idle.get_nowait()
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+
+def list_names(ftp, remote_dir):
+    ## Some servers return full paths from NLST, others bare names
+    return sorted(os.path.basename(n.rstrip('/')) for n in ftp.nlst(remote_dir)
+                  if os.path.basename(n.rstrip('/')) not in ('.', '..'))
+
+
+def list_sizes(ftp, remote_dir):
+    '''
+    Returns a dictionary of file name to size in bytes for the files in
+    remote_dir, from one MLSD listing, or a LIST listing on servers
+    without MLSD, rather than a SIZE round trip per file.
+    '''
+    try:
+        return {name: int(facts['size']) for name, facts in ftp.mlsd(remote_dir, facts=['type', 'size'])
+                if facts.get('type') == 'file' and 'size' in facts}
+    except error_perm:
+        ## 500/502: MLSD not supported, parse a Unix style LIST instead
+        lines = []
+        ftp.retrlines('LIST {}'.format(remote_dir), lines.append)
+    sizes = {}
+    for line in lines:
+        ## -rw-r--r--   1 owner group   1057234 Aug 02  2019 N_20190801_concentration_v3.0.tif
+        fields = line.split(None, 8)
+        if len(fields) == 9 and line.startswith('-'):
+            sizes[fields[8]] = int(fields[4])
+
+    return sizes
+
+
+def list_remote(pool, root, hemisphere, last_update=None):
+    '''
+    Lists the daily GeoTIFFs for a hemisphere acquired after last_update.
+    Returns a list of (remote path, relative local path, size).
+    hemisphere: 'north' or 'south'
+    last_update: date string like '2019-07-31', or None for everything
+    '''
+    last_update_dt = datetime.strptime(last_update, '%Y-%m-%d') if last_update else None
+    data_dir = '{}/{}/daily/geotiff'.format(root.rstrip('/'), hemisphere)
+
+    files = []
+    with pool.connection() as ftp:
+        for year_dir in list_names(ftp, data_dir):
+            if not year_dir.isdigit():
+                continue
+            if last_update_dt and int(year_dir) < last_update_dt.year:
+                continue
+            for month_dir in list_names(ftp, '{}/{}'.format(data_dir, year_dir)):
+                # Month directories are like 01_Jan
+                month = month_dir[:2]
+                if not month.isdigit():
+                    continue
+                month_p = '{}/{}/{}'.format(data_dir, year_dir, month_dir)
+                for file_n, size in sorted(list_sizes(ftp, month_p).items()):
+                    if not file_n.endswith('.tif'):
+                        continue
+                    ## Date is part of file name: N_20190801_concentration_v3.0.tif
+                    date = datetime.strptime(file_n.split('_')[1], '%Y%m%d')
+                    if last_update_dt and date <= last_update_dt:
+                        continue
+                    remote_p = '{}/{}'.format(month_p, file_n)
+                    rel_p = os.path.join(hemisphere, 'daily', 'geotiff', year_dir, month, file_n)
+                    files.append((remote_p, rel_p, size))
+
+    return files
+
+
+def md5sum(path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def download_file(pool, remote_p, local_p, size, retries=3):
+    '''
+    Downloads remote_p to local_p, resuming from local_p.part if an earlier
+    transfer was interrupted, and moving the file into place only once it
+    is complete. Dropped connections and temporary (4xx) errors are retried,
+    permanent (5xx) errors are raised at once. Returns the manifest entry
+    for the file.
+    '''
+    os.makedirs(os.path.dirname(local_p), exist_ok=True)
+    part_p = '{}.part'.format(local_p)
+
+    for attempt in range(1, retries + 1):
+        offset = os.path.getsize(part_p) if os.path.exists(part_p) else 0
+        if offset > size:
+            os.remove(part_p)
+            offset = 0
+        try:
+            if offset < size:
+                with pool.connection() as ftp, open(part_p, 'ab') as handle:
+                    ftp.retrbinary('RETR {}'.format(remote_p), handle.write, rest=offset or None)
+            else:
+                ## Nothing left to transfer, e.g. an empty remote file
+                open(part_p, 'ab').close()
+            break
+        except (OSError, EOFError, error_temp, error_reply) as e:
+            logger.warning('Transfer of {} failed (attempt {}/{}): {}'.format(remote_p, attempt, retries, e))
+            if attempt == retries:
+                raise
+
+    if os.path.getsize(part_p) != size:
+        raise IOError('Size mismatch for {}: expected {}, got {}'.format(remote_p, size, os.path.getsize(part_p)))
+    entry = {'size': size, 'md5': md5sum(part_p)}
+    os.replace(part_p, local_p)
+
+    return entry
+
+
+def load_manifest(manifest_p):
+    if os.path.exists(manifest_p):
+        with open(manifest_p, 'r') as handle:
+            return json.load(handle)
+    return {}
+
+
+def write_manifest(manifest, manifest_p):
+    tmp_p = '{}.tmp'.format(manifest_p)
+    with open(tmp_p, 'w') as handle:
+        json.dump(manifest, handle, indent=1, sort_keys=True)
+    os.replace(tmp_p, manifest_p)
+
+
+def is_present(local_p, entry, size, verify=False):
+    '''
+    True if local_p is already on disk at the remote size, checked against
+    its manifest entry (and its checksum if verify).
+    '''
+    if entry is None or entry['size'] != size or not os.path.exists(local_p):
+        return False
+    if os.path.getsize(local_p) != size:
+        return False
+
+    return not verify or md5sum(local_p) == entry['md5']
+
+
+def sync_rasters(out_dir, last_update=None, hemispheres=('north', 'south'), connections=4,
+                 host=NSIDC_HOST, port=21, root=NSIDC_ROOT, user='', passwd='', verify=False):
+    '''
+    Downloads any daily rasters after last_update that are not already
+    present in out_dir. Returns the number of files downloaded. A file that
+    fails does not stop the others; every finished file is recorded in the
+    manifest and a RuntimeError naming the failures is raised at the end.
+    out_dir: local directory mirroring north|south/daily/geotiff/YYYY/MM
+    last_update: date string like '2019-07-31', or None to check everything
+    connections: number of concurrent FTP connections
+    verify: recompute checksums of files already on disk before skipping them
+    '''
+    manifest_p = os.path.join(out_dir, 'download_manifest.json')
+    manifest = load_manifest(manifest_p)
+    pool = FTPPool(host=host, port=port, user=user, passwd=passwd, size=connections)
+
+    try:
+        remote = []
+        for hemisphere in hemispheres:
+            remote.extend(list_remote(pool, root, hemisphere, last_update=last_update))
+
+        todo = [(remote_p, rel_p, size) for remote_p, rel_p, size in remote
+                if not is_present(os.path.join(out_dir, rel_p), manifest.get(rel_p.replace(os.sep, '/')), size,
+                                  verify=verify)]
+        logger.info('{:,} remote files, {:,} to download.'.format(len(remote), len(todo)))
+
+        start = time.time()
+        nbytes = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = {executor.submit(download_file, pool, remote_p, os.path.join(out_dir, rel_p), size): rel_p
+                       for remote_p, rel_p, size in todo}
+            for i, future in enumerate(as_completed(futures), start=1):
+                rel_p = futures[future]
+                try:
+                    manifest[rel_p.replace(os.sep, '/')] = future.result()
+                except Exception as e:
+                    logger.error('Failed to download {}: {!r}'.format(rel_p, e))
+                    failed.append(rel_p)
+                    continue
+                nbytes += manifest[rel_p.replace(os.sep, '/')]['size']
+                ## Checkpoint the manifest periodically so a crash keeps finished files
+                if i % 100 == 0:
+                    write_manifest(manifest, manifest_p)
+    finally:
+        pool.close()
+        os.makedirs(out_dir, exist_ok=True)
+        write_manifest(manifest, manifest_p)
+
+    elapsed = time.time() - start
+    downloaded = len(todo) - len(failed)
+    if downloaded:
+        logger.info('Downloaded {:,} files ({:.1f} MB) in {:.1f}s.'.format(downloaded, nbytes / (1024 * 1024), elapsed))
+    if failed:
+        raise RuntimeError('{:,} of {:,} files failed to download, first: {}'.format(
+            len(failed), len(todo), sorted(failed)[0]))
+
+    return downloaded
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Temporal gap filling for days with no sea-ice raster.
+
+Wraps a raster source so that a missing day (the early every-other-day
+record, outages, the most recent days) is synthesized by linear
+interpolation between the nearest earlier and later rasters, or carried
+forward from the nearest earlier raster when there is no later one. A
+synthesized day is computed on its first request and cached, and is
+recorded so footprints sampled from it can be flagged.
+"""
+
+from collections import OrderedDict
+import logging
+
+import numpy as np
+
+from sea_ice_sampling import choose_poles, to_dates
+
+
+logger = logging.getLogger(__name__)
+
+
+def interpolate_days(earlier, later, weight):
+    '''
+    Linear interpolation between two days' arrays, weight 0 at earlier and
+    1 at later. Pixels with no data on one day take the other day's value.
+    '''
+    arr = earlier * (1 - weight) + later * weight
+    arr = np.where(np.isnan(earlier), later, arr)
+    arr = np.where(np.isnan(later), earlier, arr)
+
+    return arr
+
+
+class GapFiller(object):
+    '''
+    Raster source that fills missing days of another raster source.
+    raster_source: function taking (pole, date) and returning (array, geotransform) or None
+    available: dictionary of pole to the days with rasters (any order)
+    max_gap_days: furthest an earlier or later raster may be from the missing day
+    max_cached: number of synthesized days to keep
+    '''
+    def __init__(self, raster_source, available, max_gap_days=5, max_cached=64):
+        self.raster_source = raster_source
+        self.available = {pole: np.sort(np.asarray(dates, dtype='datetime64[D]')) for pole, dates in available.items()}
+        self.max_gap_days = max_gap_days
+        self.max_cached = max_cached
+        self.filled = OrderedDict()
+        self.interpolated = set()
+
+
+    def neighbours(self, pole, date):
+        '''
+        Returns the nearest earlier and later available days within
+        max_gap_days, either None if there is none.
+        '''
+        dates = self.available.get(pole, np.array([], dtype='datetime64[D]'))
+        i = int(np.searchsorted(dates, date))
+        max_gap = np.timedelta64(self.max_gap_days, 'D')
+        earlier = dates[i - 1] if i > 0 and date - dates[i - 1] <= max_gap else None
+        later = dates[i] if i < dates.size and dates[i] - date <= max_gap else None
+
+        return earlier, later
+
+
+    def __call__(self, pole, date):
+        date = np.datetime64(date, 'D')
+        raster = self.raster_source(pole, date)
+        if raster is not None:
+            return raster
+
+        if (pole, date) in self.filled:
+            self.filled.move_to_end((pole, date))
+            return self.filled[(pole, date)]
+
+        earlier, later = self.neighbours(pole, date)
+        if earlier is not None and later is not None:
+            earlier_arr, gt = self.raster_source(pole, earlier)
+            later_arr, _gt = self.raster_source(pole, later)
+            weight = (date - earlier).astype(int) / (later - earlier).astype(int)
+            arr = interpolate_days(earlier_arr, later_arr, weight)
+        elif earlier is not None or later is not None:
+            ## Only one side, e.g. the most recent days: carry the nearest day over
+            arr, gt = self.raster_source(pole, earlier if earlier is not None else later)
+        else:
+            return None
+        logger.info('Filled missing {} raster for {} from {} and {}.'.format(pole, date, earlier, later))
+
+        self.filled[(pole, date)] = (arr, gt)
+        self.interpolated.add((pole, date))
+        while len(self.filled) > self.max_cached:
+            self.filled.popitem(last=False)
+
+        return arr, gt
+
+
+    def flags(self, ys, dates):
+        '''
+        Returns a boolean array, True for footprints whose date was filled.
+        ys: centroid latitudes, used to choose the pole as the sampler does
+        '''
+        poles = choose_poles(ys)
+        dates = to_dates(dates)
+
+        return np.array([(pole, date) in self.interpolated for pole, date in zip(poles, dates)], dtype=bool)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Compact per-pole index of the resampled daily sea-ice concentration
+rasters: a sorted datetime64 array of dates with a parallel array of
+paths, saved as .npz.
+
+Refreshing the index only lists directories whose mtime has changed
+since the last scan; unchanged directories reuse their saved entries.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def raster_date(f):
+    '''
+    Returns the date of a concentration raster from its file name, or None
+    if it is not one. f format: N_19851126_concentration_v3.0.tif
+    '''
+    if not f.endswith('_concentration_v3.0.tif'):
+        return None
+    date = f.split('_')[1]
+
+    return np.datetime64('{}-{}-{}'.format(date[0:4], date[4:6], date[6:8]), 'D')
+
+
+class RasterIndex(object):
+    '''
+    Sorted index of daily raster paths for one pole.
+    dates: datetime64[D] array, sorted
+    paths: array of raster paths parallel to dates
+    dir_mtimes: dictionary of scanned directory path to mtime (ns)
+    '''
+    def __init__(self, dates=None, paths=None, dir_mtimes=None):
+        self.dates = np.array([] if dates is None else dates, dtype='datetime64[D]')
+        self.paths = np.array([] if paths is None else paths, dtype=str)
+        self.dir_mtimes = dir_mtimes or {}
+
+
+    def __len__(self):
+        return self.dates.size
+
+
+    @classmethod
+    def load(cls, index_p):
+        with np.load(index_p) as npz:
+            return cls(npz['dates'], npz['paths'],
+                       dict(zip(npz['dir_paths'].tolist(), npz['dir_mtimes'].tolist())))
+
+
+    def save(self, index_p):
+        os.makedirs(os.path.dirname(index_p), exist_ok=True)
+        ## np.savez appends .npz to names without it, so write to a .npz temp file
+        tmp_p = '{}.tmp.npz'.format(os.path.splitext(index_p)[0])
+        np.savez(tmp_p,
+                 dates=self.dates,
+                 paths=self.paths,
+                 dir_paths=np.array(list(self.dir_mtimes.keys()), dtype=str),
+                 dir_mtimes=np.array(list(self.dir_mtimes.values()), dtype=np.int64))
+        os.replace(tmp_p, index_p)
+
+
+    def refresh(self, sea_ice_dir):
+        '''
+        Rescans sea_ice_dir, listing only directories whose mtime changed.
+        Returns the number of directories listed.
+        '''
+        ## Saved entries grouped by directory
+        saved_files = {}
+        for date, path in zip(self.dates, self.paths):
+            saved_files.setdefault(os.path.dirname(path), []).append((date, path))
+        saved_subdirs = {}
+        for dir_p in self.dir_mtimes:
+            saved_subdirs.setdefault(os.path.dirname(dir_p), []).append(dir_p)
+
+        dates, paths, dir_mtimes = [], [], {}
+        listed = 0
+        stack = [sea_ice_dir]
+        while stack:
+            dir_p = stack.pop()
+            mtime = os.stat(dir_p).st_mtime_ns
+            dir_mtimes[dir_p] = mtime
+            if self.dir_mtimes.get(dir_p) == mtime:
+                ## Directory contents unchanged since the last scan
+                for date, path in saved_files.get(dir_p, []):
+                    dates.append(date)
+                    paths.append(path)
+                stack.extend(saved_subdirs.get(dir_p, []))
+                continue
+
+            listed += 1
+            with os.scandir(dir_p) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    else:
+                        date = raster_date(entry.name)
+                        if date is not None:
+                            dates.append(date)
+                            paths.append(entry.path)
+
+        dates = np.array(dates, dtype='datetime64[D]')
+        paths = np.array(paths, dtype=str)
+        order = np.argsort(dates, kind='stable')
+        self.dates, self.paths, self.dir_mtimes = dates[order], paths[order], dir_mtimes
+
+        return listed
+
+
+    def lookup(self, date, nearest=False, max_days=None):
+        '''
+        Returns the raster path for date, or None if there is none.
+        date: date string, datetime or datetime64
+        nearest: fall back to the nearest available day
+        max_days: furthest to look for the nearest day, unlimited if None
+        '''
+        date = np.datetime64(str(date)[:10], 'D')
+        i = int(np.searchsorted(self.dates, date))
+        if i < self.dates.size and self.dates[i] == date:
+            return str(self.paths[i])
+        if not nearest or self.dates.size == 0:
+            return None
+
+        ## Closest of the neighbouring days, the earlier one on ties
+        neighbours = [j for j in (i - 1, i) if 0 <= j < self.dates.size]
+        j = min(neighbours, key=lambda j: abs(int((self.dates[j] - date).astype(int))))
+        if max_days is not None and abs(int((self.dates[j] - date).astype(int))) > max_days:
+            return None
+
+        return str(self.paths[j])
+
+
+def load_raster_index(index_p, sea_ice_dir, refresh=False):
+    '''
+    Loads the index saved at index_p, building it if it does not exist
+    and rescanning changed directories of sea_ice_dir if refresh is True.
+    '''
+    if os.path.exists(index_p) and not refresh:
+        return RasterIndex.load(index_p)
+
+    index = RasterIndex.load(index_p) if os.path.exists(index_p) else RasterIndex()
+    listed = index.refresh(sea_ice_dir)
+    logger.info('Indexed {:,} rasters in {} ({:,} directories rescanned).'.format(len(index), sea_ice_dir, listed))
+    index.save(index_p)
+
+    return index
+
+
+def load_pole_indexes(wd, refresh=False):
+    '''
+    Loads the arctic and antarctic indexes for the project working directory,
+    which holds the resampled rasters under noaa_sea_ice and the indexes
+    under pickles.
+    '''
+    sea_ice_dirs = {
+            'arctic': os.path.join(wd, 'noaa_sea_ice', 'north', 'resampled_nd', 'daily', 'geotiff'),
+            'antarctic': os.path.join(wd, 'noaa_sea_ice', 'south', 'resampled_nd', 'daily', 'geotiff')}
+
+    return {pole: load_raster_index(os.path.join(wd, 'pickles', '{}_sea_ice_concentration_index.npz'.format(pole)),
+                                    sea_ice_dir, refresh=refresh)
+            for pole, sea_ice_dir in sea_ice_dirs.items()}
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Nearest-valid-pixel index for the resampled sea-ice rasters.
+
+A Euclidean distance transform of each raster's no data mask gives, for
+every pixel, the row and column of the nearest pixel with a valid
+concentration and the distance to it. The index is stored next to the
+raster as {raster}.nearest.npz, so a footprint whose sampling window is
+all land, coast or pole hole gets its nearest valid value in one lookup.
+"""
+
+import os
+
+import numpy as np
+from scipy import ndimage
+
+
+def nearest_index_path(raster_p):
+    return '{}.nearest.npz'.format(raster_p)
+
+
+def nearest_valid_index(arr):
+    '''
+    Returns (indices, distances) for a raster with no data as NaN:
+    indices is (2, rows, cols) holding the row and column of the nearest
+    valid pixel, distances the distance to it in pixels.
+    '''
+    invalid = np.isnan(arr)
+    if invalid.all():
+        ## No valid pixels to point to
+        indices = np.zeros((2, ) + arr.shape, dtype=np.int16)
+        return indices, np.full(arr.shape, np.inf, dtype=np.float32)
+    distances, indices = ndimage.distance_transform_edt(invalid, return_indices=True)
+
+    return indices.astype(np.int16), distances.astype(np.float32)
+
+
+def write_nearest_index(raster_p, arr):
+    '''
+    Computes and saves the nearest-valid-pixel index for raster_p.
+    arr: raster values with no data as NaN
+    '''
+    indices, distances = nearest_valid_index(arr)
+    index_p = nearest_index_path(raster_p)
+    tmp_p = '{}.tmp.npz'.format(index_p[:-len('.npz')])
+    np.savez_compressed(tmp_p, indices=indices, distances=distances,
+                        raster_mtime=np.int64(os.stat(raster_p).st_mtime_ns))
+    os.replace(tmp_p, index_p)
+
+    return indices, distances
+
+
+def load_nearest_index(raster_p, arr):
+    '''
+    Returns the saved (indices, distances) for raster_p, computing and
+    saving them if there is no index or the raster has changed since.
+    arr: raster values with no data as NaN, or None to only load a current
+         index, returning None if there is none
+    '''
+    index_p = nearest_index_path(raster_p)
+    if os.path.exists(index_p):
+        with np.load(index_p) as npz:
+            if int(npz['raster_mtime']) == os.stat(raster_p).st_mtime_ns:
+                return npz['indices'], npz['distances']
+    if arr is None:
+        return None
+
+    return write_nearest_index(raster_p, arr)
+
+
+def nearest_values(arr, indices, distances, rows, cols, cell_size, max_radius):
+    '''
+    Returns (values, distances) of the nearest valid pixel to each (row, col),
+    NaN where the point is off the raster or farther than max_radius.
+    cell_size: pixel size in map units
+    max_radius: furthest to look, in map units
+    '''
+    values = np.full(rows.shape, np.nan)
+    dists = np.full(rows.shape, np.nan)
+    on_raster = (rows >= 0) & (rows < arr.shape[0]) & (cols >= 0) & (cols < arr.shape[1])
+    r, c = rows[on_raster], cols[on_raster]
+    d = distances[r, c].astype(np.float64) * cell_size
+    within = d <= max_radius
+    nearest_r = indices[0, r, c][within]
+    nearest_c = indices[1, r, c][within]
+    on_i = np.flatnonzero(on_raster)[within]
+    values[on_i] = arr[nearest_r, nearest_c]
+    dists[on_i] = d[within]
+
+    return values, dists
@@ -7,105 +7,68 @@ Created on Thu Jul 18 14:00:21 2019
 Resamples NSDIC Sea-Ice Rasters to change class values (land, coast, etc.)
 to be no data value.
 
-TO DO: Change to also download new rasters since last update
-Resamples values in rasters to a new no data value.
+Resamples values in rasters to a new no data value. New rasters since the
+last update can be downloaded with update_rasters.
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from ftplib import FTP
+import json
+import logging
 import numpy as np
 import os
-from osgeo import gdal, osr
+import time
+from osgeo import gdal, gdal_array, osr
 from tqdm import tqdm
 
+from pipeline_metrics import setup_logging
+from sea_ice_aggregate import POLE_PREFIX, update_aggregates
+from sea_ice_download import sync_rasters
+from sea_ice_nearest import write_nearest_index
+from sea_ice_sampling import COMPACT_NODATA, read_sea_ice_raster
+from sea_ice_tiles import write_tile_summary
+
 
 gdal.UseExceptions()
 
+logger = logging.getLogger(__name__)
+
 
-def update_rasters(last_update, north=True, south=True):
+def update_rasters(last_update, out_dir, north=True, south=True, connections=4, **ftp_kwargs):
     '''
     Downloads any new rasters since the last update date.
     last_update: date string like '2019-07-31'
+    out_dir: directory to mirror north|south/daily/geotiff/YYYY/MM into
     north: update Arctic rasters
     south: update Antarctic rasters
+    connections: number of concurrent FTP connections
+    ftp_kwargs: host, port, root, user, passwd overrides, e.g. for a local server
     '''
-    ## Convert last update to datetime and get year, month, day
-
-#last_update = '2019-09-02'
-#north = True
-#south = False
-
-    last_update_dt = datetime.strptime(last_update, r'%Y-%m-%d')
-    last_update_year = last_update_dt.year
-    last_update_month = last_update_dt.month
-    last_update_day = last_update_dt.day
-    
-    ftp = FTP(r'sidads.colorado.edu')
-    ftp.login()
-    ftp.cwd(r'/DATASETS/NOAA/G02135/')
-
+    hemispheres = [h for h, update in (('north', north), ('south', south)) if update]
 
-    ## Fix this - loop through each of N and S if True
-#    if north:
-#        ftp.cwd(r'north/daily/geotiff/')
-#            
-#    elif south:
-#        ftp.cwd(r'south/daily/geotiff/')
-    
-    ## Get current directory and iterate    
-    data_dir = ftp.pwd()
-    
-    years = ftp.nlst(data_dir)[2:] # drop '.' and '..' from list of dirs
-    for year_dir in years:
-        if int(year_dir) > last_update_year:
-            ## Get it all
-    #        ftp.cwd(r'{}/{}'.format(data_dir, year_dir))
-            x = ''
-            
-        elif int(year_dir) == last_update_year:
-    #        ftp.cwd(r'{}/{}'.format(data_dir, year_dir))
-            month_dirs = ftp.nlst(r'{}/{}'.format(data_dir, year_dir))[2:]
-            
-            for month_dir in month_dirs:
-                month = int(month_dir[:2])
-            
-                if month > last_update_month:
-                    ## Get it all
-                    print('month >', month)
-            
-                elif month == last_update_month:
-                    print('month ==', month)
-                    file_ps = ftp.nlst(r'{}/{}/{}'.format(data_dir, year_dir, month_dir))[2:]
-    #                print(file_ps)
-                    ## Date is part of file name - day is element 8 and 9
-                    days = {x[8:10]: x for x in file_ps}
-                    for day, file_n in days.items():
-                        print(day)
-                        if int(day) > last_update_day:
-                            ## Get it all
-                            file_p = r'{}/{}/{}/{}'.format(data_dir, year_dir, month_dir, file_n)
-                            out_p = os.path.join(r'C:\temp\sea_ice', file_n)
-                            print(r'Getting: {}/{}/{}'.format(data_dir, year_dir, file_p))
-                            
-                            #### TO DO: FUNCTION TO CREATE SUBDIRS IF NEEDED FOR A FILE PATH
-                            with open(out_p, 'wb') as fhandle:
-                                ftp.retrbinary("RETR {}".format(file_p), fhandle.write)
-                        
-
-
-    
-    
-# update_rasters('2019-01-01')
+    return sync_rasters(out_dir, last_update=last_update, hemispheres=hemispheres,
+                        connections=connections, **ftp_kwargs)
 
 
-def resample_nodata(f_p, nd1, nd2, nd3, nd4, out_path, out_nodata):
+def resample_nodata(f_p, nd1, nd2, nd3, nd4, out_path, out_nodata, tile_size=256, compact_scale=None):
     '''
     Takes the NSDIC Sea-ice .tifs and resamples the four 
-    classes to be no-data values.
+    classes to be no-data values. The source is streamed in windows of
+    its own blocks (whole-row strips for the NSIDC GeoTIFFs), so each block
+    is decoded once and memory use does not depend on raster height, and
+    written as an internally tiled, deflate compressed GeoTIFF.
     f_p: file path to .tif
-    nd1 - nd4: no data values (how to provide a list of args to np.where?)
+    nd1 - nd4: no data values
     out_path: path to write resampled .tif to
+    tile_size: output tile size in pixels (multiple of 16). The default
+               covers a whole 25 km polar grid in 2x2 tiles, so the
+               sampler's small windows almost always fall in one tile.
+    compact_scale: if given, write Byte values of round(value / compact_scale)
+                   with COMPACT_NODATA as no data (out_nodata is ignored),
+                   recording compact_scale as the band scale so readers
+                   get back the original units, e.g. 10 stores
+                   concentrations (0 - 1000) as percent
     '''
     
     ## Read source and metadata
@@ -117,14 +80,9 @@ def resample_nodata(f_p, nd1, nd2, nd3, nd4, out_path, out_nodata):
     
     x_sz = ds.RasterXSize
     y_sz = ds.RasterYSize
-#    src_nodata = ds.GetRasterBand(1).GetNoDataValue()
-    dtype = ds.GetRasterBand(1).DataType
-#    dtype = gdal.GetDataTypeName(dtype)
-
-    
-    ## Read as array and convert no data to -9999
-    ar = ds.ReadAsArray()
-    ar = np.where((ar == nd1) | (ar == nd2) | (ar == nd3) | (ar == nd4), out_nodata, ar)
+    src_band = ds.GetRasterBand(1)
+    dtype = src_band.DataType
+    nodata_values = np.array([nd1, nd2, nd3, nd4])
 
     
     ## Write
@@ -148,62 +106,220 @@ def resample_nodata(f_p, nd1, nd2, nd3, nd4, out_path, out_nodata):
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
     fmt = 'GTiff'
     driver = gdal.GetDriverByName(fmt)
-    dst_dtype = signed_dtype_lut[dtype]['dst']
-    dst_ds = driver.Create(out_path, x_sz, y_sz, 1, dst_dtype)
-    dst_ds.GetRasterBand(1).WriteArray(ar)
+    if compact_scale is not None:
+        dst_dtype = gdal.GDT_Byte
+        out_nodata = COMPACT_NODATA
+    else:
+        dst_dtype = signed_dtype_lut[dtype]['dst']
+    options = ['TILED=YES',
+               'BLOCKXSIZE={}'.format(tile_size),
+               'BLOCKYSIZE={}'.format(tile_size),
+               'COMPRESS=DEFLATE',
+               'PREDICTOR=2']
+    dst_ds = driver.Create(out_path, x_sz, y_sz, 1, dst_dtype, options=options)
     dst_ds.SetGeoTransform(gt)
     dst_ds.SetProjection(prj.ExportToWkt())
-    dst_ds.GetRasterBand(1).SetNoDataValue(out_nodata)
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue(out_nodata)
+    if compact_scale is not None:
+        dst_band.SetScale(compact_scale)
+        dst_band.SetOffset(0)
     
+    ## Stream windows of whole source blocks, converting no data classes to out_nodata in place
+    # Working type that can hold both the source values and out_nodata
+    work_dtype = np.result_type(gdal_array.GDALTypeCodeToNumericTypeCode(dst_dtype), np.min_scalar_type(out_nodata))
+    block_x, block_y = src_band.GetBlockSize()
+    # Strips are a block per row (or few rows), so read enough of them to fill a row of output tiles
+    x_step = min(block_x, x_sz)
+    y_step = block_y * max(1, tile_size // block_y)
+    for yoff in range(0, y_sz, y_step):
+        ysize = min(y_step, y_sz - yoff)
+        for xoff in range(0, x_sz, x_step):
+            xsize = min(x_step, x_sz - xoff)
+            ar = src_band.ReadAsArray(xoff, yoff, xsize, ysize)
+            if compact_scale is not None:
+                ## Valid values fit 0 - 254 once scaled, leaving 255 free for no data
+                nd_mask = np.isin(ar, nodata_values)
+                ar = np.clip(np.round(ar / compact_scale), 0, COMPACT_NODATA - 1).astype(np.uint8)
+                ar[nd_mask] = out_nodata
+            else:
+                ar = ar.astype(work_dtype, copy=False)
+                ar[np.isin(ar, nodata_values)] = out_nodata
+            dst_band.WriteArray(ar, xoff, yoff)
+    
+    dst_band = None
     dst_ds = None
+    ds = None
+
+
+## Class values set to no data in each raster type, keyed by file name suffix
+NODATA_VALUES = {
+        # Concentration: missing, land, coast, pole hole
+        '_concentration_v3.0.tif': (2550, 2540, 2530, 2510),
+        # Extent: missing, land, coast, pole hole
+        '_extent_v3.0.tif': (255, 254, 253, 210),
+        }
 
 
+## Scale of compact rasters of each type: concentrations (0 - 1000) as percent, extent as is
+COMPACT_SCALES = {
+        '_concentration_v3.0.tif': 10,
+        '_extent_v3.0.tif': 1,
+        }
 
-def resample_loop(sea_ice_directory, out_dir, last_update, out_nodata):
+
+def load_manifest(manifest_p):
+    '''
+    Reads the resample manifest, returning a dictionary of source path to
+    the last entry written for it.
     '''
-    Calls resample_nodata in a loop for every *_concetration.tif and 
-    *_extent.tif in the given directory, resampling class values to
-    no data.
+    manifest = {}
+    if os.path.exists(manifest_p):
+        with open(manifest_p, 'r') as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    ## Partial line from a crash mid-write
+                    continue
+                manifest[entry['src']] = entry
+
+    return manifest
+
+
+def manifest_entry(f_p, out_path, nodata_values, out_nodata, compact_scale=None):
+    stat = os.stat(f_p)
+    return {
+            'src': f_p,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'out': out_path,
+            'nodata': list(nodata_values),
+            'out_nodata': COMPACT_NODATA if compact_scale is not None else out_nodata,
+            'compact_scale': compact_scale,
+            }
+
+
+def is_current(entry, previous):
+    '''
+    True if a file was already resampled from the same source with the same
+    no data values and its output still exists.
+    '''
+    if previous is None or not os.path.exists(previous['out']):
+        return False
+    keys = ('size', 'mtime', 'out', 'nodata', 'out_nodata', 'compact_scale')
+
+    ## Entries from before compact output have no compact_scale
+    return all(entry.get(k) == previous.get(k) for k in keys)
+
+
+def resample_task(entry):
+    '''
+    Resamples one raster in a worker process, returning its manifest entry
+    and the time taken.
+    '''
+    start = time.time()
+    resample_nodata(entry['src'], *entry['nodata'], out_path=entry['out'], out_nodata=entry['out_nodata'],
+                    compact_scale=entry.get('compact_scale'))
+    ## Nearest-valid-pixel index used by the sampler when a window is all no data,
+    ## and tile summary used to settle footprints without reading pixels
+    if entry['out'].endswith('_concentration_v3.0.tif'):
+        arr, gt = read_sea_ice_raster(entry['out'])
+        write_nearest_index(entry['out'], arr)
+        write_tile_summary(entry['out'], arr, gt)
+
+    return entry, time.time() - start
+
+
+def resample_loop(sea_ice_directory, out_dir, last_update, out_nodata, processes=4, manifest_p=None,
+                  compact=False, aggregate_dir=None):
+    '''
+    Calls resample_nodata across a process pool for every *_concetration.tif
+    and *_extent.tif in the given directory, resampling class values to
+    no data. A manifest of every resampled file is kept so reruns only
+    process new or changed inputs, and can resume after a crash.
     sea_ice_path: path to directory holding rasters. sub-directories are OK.
     out_dir: path to write resampled rasters to.
     last_update: date of last update. Rasters after this date will be 
                     resampled. e.g. '2019-07-31'
+    processes: number of worker processes
+    manifest_p: path to the manifest, defaults to resample_manifest.jsonl in out_dir
+    compact: write Byte rasters scaled by COMPACT_SCALES, e.g. concentration
+             as percent, instead of the widened signed source type
+    aggregate_dir: if given, fold the resampled concentration rasters into
+                   the weekly, monthly and seasonal maximum rasters there
+    A raster that fails is logged and left out of the manifest, so the next
+    run retries it; the others are still resampled, and a RuntimeError
+    with the number of failures is raised at the end.
     '''
-    ## Convert last update to datetime and get year, month, day
-    last_update_dt = datetime.strptime(last_update, '%Y-%M-%d')
-    last_update_year = last_update_dt.year
-    last_update_month = last_update_dt.month
-    last_update_day = last_update_dt.day
-        
-    ## Concentration raster no data values
-    con_miss = 2550
-    con_land = 2540
-    con_coast = 2530
-    con_pol = 2510
-    
-    ## Extent raster no data values
-    ext_miss = 255
-    ext_land = 254
-    ext_coast = 253
-    ext_pol = 210
-    
+    last_update_dt = datetime.strptime(last_update, '%Y-%m-%d')
+    if manifest_p is None:
+        manifest_p = os.path.join(out_dir, 'resample_manifest.jsonl')
+    manifest = load_manifest(manifest_p)
     
-    ## Loop through rasters
+    ## Find rasters after last_update that are new or changed since they were last resampled
+    tasks = []
+    skipped = 0
+    poles = set()
     for root, dirs, files in os.walk(sea_ice_directory):
-        for file in tqdm(files):
+        for file in files:
+            suffix = [s for s in NODATA_VALUES if file.endswith(s)]
+            if not suffix:
+                continue
             f_p = os.path.join(root, file)
             ## The raster date is part of the filename
-            date = os.path.basename(f_p).split('_')[1]
-            year, month, day = int(date[:4]), int(date[4:6]), int(date[6:8])
-            ## If the rasters date is after last_update, resample
-            if year >= last_update_year and month >= last_update_month and day > last_update_day:
-                out_path = os.path.join(out_dir, os.path.relpath(os.path.join(root, file), sea_ice_directory))
-                # Resample concentration rasters
-                if file.endswith('_concentration_v3.0.tif'):
-                    resample_nodata(con_miss, con_land, con_coast, con_pol, out_path=out_path, out_nodata=out_nodata)
-                # Resample extent rasters
-                if file.endswith('_extent_v3.0.tif'):
-                    resample_nodata(ext_miss, ext_land, ext_coast, ext_pol, out_path=out_path, out_nodata=out_nodata)
+            date = datetime.strptime(file.split('_')[1], '%Y%m%d')
+            if date <= last_update_dt:
+                continue
+            if file.endswith('_concentration_v3.0.tif') and file[0] in POLE_PREFIX:
+                poles.add(POLE_PREFIX[file[0]])
+            out_path = os.path.join(out_dir, os.path.relpath(f_p, sea_ice_directory))
+            entry = manifest_entry(f_p, out_path, NODATA_VALUES[suffix[0]], out_nodata,
+                                   compact_scale=COMPACT_SCALES[suffix[0]] if compact else None)
+            if is_current(entry, manifest.get(f_p)):
+                skipped += 1
+                continue
+            tasks.append(entry)
+    
+    logger.info('Resampling {:,} rasters ({:,} already up to date) with {} processes...'.format(
+        len(tasks), skipped, processes))
+    
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_p)), exist_ok=True)
+    start = time.time()
+    nbytes = 0
+    file_times = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes) as executor, open(manifest_p, 'a') as manifest_handle:
+        futures = {executor.submit(resample_task, task): task for task in tasks}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                entry, elapsed = future.result()
+            except Exception as e:
+                logger.error('Failed to resample {}: {!r}'.format(futures[future]['src'], e))
+                failed.append(futures[future]['src'])
+                continue
+            ## Record each file as soon as it is done so a crash loses nothing already written
+            manifest_handle.write(json.dumps(entry) + '\n')
+            manifest_handle.flush()
+            nbytes += entry['size']
+            file_times.append(elapsed)
+            logger.debug('Resampled {} in {:.2f}s'.format(entry['src'], elapsed))
+    
+    elapsed = time.time() - start
+    if file_times:
+        logger.info('Resampled {:,} rasters in {:.1f}s: {:.1f} files/s, {:.1f} MB/s, '
+                    '{:.3f}s mean / {:.3f}s max per file'.format(
+                        len(file_times), elapsed, len(file_times) / elapsed, nbytes / (1024 * 1024) / elapsed,
+                        sum(file_times) / len(file_times), max(file_times)))
+
+    if aggregate_dir is not None:
+        for pole in sorted(poles):
+            update_aggregates(out_dir, aggregate_dir, pole)
+
+    if failed:
+        logger.error('{:,} of {:,} rasters failed to resample and will be retried on the next run.'.format(
+            len(failed), len(tasks)))
+        raise RuntimeError('{:,} rasters failed to resample, first: {}'.format(len(failed), sorted(failed)[0]))
 
 
 if __name__ == '__main__':
@@ -216,8 +332,16 @@ if __name__ == '__main__':
                         to resample everything from 1990-01-01 to present.""")
     parser.add_argument('out_directory', type=str,
                         help='Directory to write resampled rasters to.')
-    parser.add_argument('--out_nodata', type=str, default=-9999,
+    parser.add_argument('--out_nodata', type=int, default=-9999,
                         help='No data value to use for resampled rasters. Default = -9999')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='Number of worker processes. Default = 4')
+    parser.add_argument('--manifest', type=str,
+                        help='Path to the resample manifest. Default = out_directory/resample_manifest.jsonl')
+    parser.add_argument('--compact', action='store_true',
+                        help='Write Byte rasters with concentration as percent and 255 as no data.')
+    parser.add_argument('--aggregate_dir', type=str,
+                        help='Update the weekly, monthly and seasonal maximum rasters in this directory.')
     
     args = parser.parse_args()
     
@@ -226,4 +350,7 @@ if __name__ == '__main__':
     out_dir = args.out_directory
     out_nodata = args.out_nodata
     
-    resample_loop(sea_ice_dir, out_dir=out_dir, last_update=last_update, out_nodata=out_nodata)
+    setup_logging()
+    resample_loop(sea_ice_dir, out_dir=out_dir, last_update=last_update, out_nodata=out_nodata,
+                  processes=args.processes, manifest_p=args.manifest, compact=args.compact,
+                  aggregate_dir=args.aggregate_dir)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded multi-process sea-ice sampling.
+
+Footprints are split into shards by pole and contiguous date range, so
+each worker reads a disjoint set of daily rasters and keeps its own
+raster cache. Shards run on a process pool, a failed shard is retried on
+a fresh pool, and results are scattered back to the input order so the
+output does not depend on which worker finished first. A worker crash
+fails every shard left in its pool, so those shards are rerun each in a
+pool of its own, and only a shard that crashes its own pool is charged a
+retry.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+import logging
+import time
+
+import numpy as np
+
+from pipeline_metrics import RunMetrics
+from sea_ice_cache import RasterCache
+from sea_ice_cube import cube_dates, cube_raster_source
+from sea_ice_gapfill import GapFiller
+from sea_ice_index import load_pole_indexes
+from sea_ice_sampling import (POLE_EPSG, choose_poles, file_nearest_lookup, file_raster_source,
+                              sample_sea_ice, to_dates)
+from sea_ice_tiles import file_tile_lookup
+
+
+logger = logging.getLogger(__name__)
+
+
+class SourceFactory(object):
+    '''
+    Picklable recipe for the raster source, built once in each worker
+    rather than sent with every shard.
+    wd: project working directory holding the raster indexes
+    cube_dir: sample from the cubes in cube_dir instead of the GeoTIFFs
+    cache_mb: raster cache budget of each worker
+    nearest_day, max_days: fall back to the nearest day's raster, as for RasterIndex.lookup
+    gap_fill, max_gap_days: wrap the source in a GapFiller
+    tile_summaries: settle footprints from the tile summaries next to the rasters
+    '''
+    def __init__(self, wd, cube_dir=None, cache_mb=512, nearest_day=False, max_days=None,
+                 gap_fill=True, max_gap_days=5, tile_summaries=True):
+        self.wd = wd
+        self.cube_dir = cube_dir
+        self.cache_mb = cache_mb
+        self.nearest_day = nearest_day
+        self.max_days = max_days
+        self.gap_fill = gap_fill
+        self.max_gap_days = max_gap_days
+        self.tile_summaries = tile_summaries
+
+
+    def __call__(self):
+        '''
+        Returns (raster_source, nearest_lookup, tile_lookup) for sample_sea_ice.
+        '''
+        if self.cube_dir is not None:
+            raster_source = cube_raster_source(self.cube_dir)
+            nearest_lookup = tile_lookup = None
+            available = cube_dates(self.cube_dir)
+        else:
+            luts = load_pole_indexes(self.wd)
+            def raster_lookup(pole, date):
+                return luts[pole].lookup(date, nearest=self.nearest_day, max_days=self.max_days)
+            raster_cache = RasterCache(max_mb=self.cache_mb)
+            raster_source = file_raster_source(raster_lookup, reader=raster_cache.read)
+            nearest_lookup = file_nearest_lookup(raster_lookup)
+            tile_lookup = file_tile_lookup(raster_lookup) if self.tile_summaries else None
+            available = {pole: lut.dates for pole, lut in luts.items()}
+        if self.gap_fill:
+            raster_source = GapFiller(raster_source, available, max_gap_days=self.max_gap_days)
+
+        return raster_source, nearest_lookup, tile_lookup
+
+
+def make_shards(ys, dates, n_shards):
+    '''
+    Returns a list of (pole, indices) shards covering every polar footprint.
+    Each pole gets a share of n_shards in proportion to its footprints, cut
+    into runs of whole days holding roughly equal numbers of footprints.
+    '''
+    poles = choose_poles(ys)
+    dates = to_dates(dates)
+    n_polar = max((poles != '').sum(), 1)
+
+    shards = []
+    for pole in POLE_EPSG:
+        in_pole = np.flatnonzero(poles == pole)
+        if in_pole.size == 0:
+            continue
+        members = in_pole[np.argsort(dates[in_pole], kind='stable')]
+        member_dates = dates[members]
+        n = max(1, int(round(n_shards * in_pole.size / n_polar)))
+        ## Move equal-count cut points back to the first footprint of their day
+        cuts = np.linspace(0, members.size, n + 1).astype(np.int64)[1:-1]
+        cuts = np.unique(np.searchsorted(member_dates, member_dates[cuts], side='left'))
+        cuts = cuts[cuts > 0]
+        shards.extend((pole, part) for part in np.split(members, cuts))
+
+    return shards
+
+
+def init_worker(source_factory):
+    global _worker_sources
+    _worker_sources = source_factory()
+
+
+def sample_shard(args):
+    '''
+    Samples one shard in a worker, returning (concentrations, distances,
+    interpolated, counters, pruned, seconds): the shard's sample_sea_ice
+    counters, and footprints settled by each aggregate period.
+    '''
+    xs, ys, dates, sample_kwargs = args
+    raster_source, nearest_lookup, tile_lookup = _worker_sources
+    metrics = RunMetrics('sample_shard')
+    aggregates = sample_kwargs.get('aggregates')
+    ## The aggregates arrive with the counts of earlier shards, so only this shard's are returned
+    pruned_before = aggregates.stats() if aggregates is not None else {}
+    start = time.time()
+    concentrations, distances = sample_sea_ice(xs, ys, dates, raster_source, nearest_lookup=nearest_lookup,
+                                               tile_lookup=tile_lookup, return_distance=True, metrics=metrics,
+                                               **sample_kwargs)
+    if isinstance(raster_source, GapFiller):
+        interpolated = raster_source.flags(ys, dates)
+    else:
+        interpolated = np.zeros(concentrations.shape, dtype=bool)
+    pruned = {period: n - pruned_before[period] for period, n in aggregates.stats().items()} if aggregates is not None else {}
+
+    return concentrations, distances, interpolated, dict(metrics.counters), pruned, time.time() - start
+
+
+def sample_sea_ice_sharded(xs, ys, dates, source_factory, processes=4, shards_per_process=4, retries=2,
+                           metrics=None, **sample_kwargs):
+    '''
+    Samples sea-ice concentration across a process pool. Returns
+    (concentrations, distances, interpolated) in the order of the input,
+    with the same values as sea_ice_sampling.sample_sea_ice.
+    xs, ys, dates: as for sample_sea_ice
+    source_factory: SourceFactory, called once in each worker
+    processes: number of worker processes
+    shards_per_process: shards to cut per process, for load balancing
+    retries: times to rerun a failed shard before giving up
+    metrics: pipeline_metrics.RunMetrics to add the counters of every shard to
+    sample_kwargs: passed on to sample_sea_ice, e.g. max_radius_km; the
+                   footprints each shard prunes are added to aggregates
+    '''
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    dates = to_dates(dates)
+    aggregates = sample_kwargs.get('aggregates')
+    ## Non-polar footprints keep 0 without being sent anywhere
+    concentrations = np.zeros(xs.shape, dtype=np.float64)
+    distances = np.zeros(xs.shape, dtype=np.float64)
+    interpolated = np.zeros(xs.shape, dtype=bool)
+
+    shards = make_shards(ys, dates, processes * shards_per_process)
+    logger.info('Sampling {:,} footprints in {:,} shards with {} processes.'.format(
+        sum(indices.size for pole, indices in shards), len(shards), processes))
+
+    attempts = [0] * len(shards)
+    pending = list(range(len(shards)))
+    isolate = False
+    while pending:
+        failed, broken = [], []
+        ## After a crash, shards run processes at a time, each in a single worker pool of its own
+        groups = [pending[j:j + processes] for j in range(0, len(pending), processes)] if isolate else [pending]
+        for group in groups:
+            ## A fresh pool each round, as a crashed worker breaks the pool it was in
+            with ExitStack() as stack:
+                pools = [stack.enter_context(ProcessPoolExecutor(max_workers=1 if isolate else processes,
+                                                                 initializer=init_worker,
+                                                                 initargs=(source_factory, )))
+                         for _pool in (group if isolate else [None])]
+                futures = {}
+                for j, i in enumerate(group):
+                    pole, indices = shards[i]
+                    futures[pools[j if isolate else 0].submit(
+                            sample_shard, (xs[indices], ys[indices], dates[indices], sample_kwargs))] = i
+                for future in as_completed(futures):
+                    i = futures[future]
+                    pole, indices = shards[i]
+                    try:
+                        (shard_concentrations, shard_distances, shard_interpolated, counters, pruned,
+                         elapsed) = future.result()
+                    except BrokenProcessPool as e:
+                        if not isolate:
+                            ## Any shard in the pool may have crashed it, so none is charged yet
+                            logger.warning('Shard {} ({} {} to {}) lost to a worker crash, rerunning alone: {}'.format(
+                                i, pole, dates[indices[0]], dates[indices[-1]], e))
+                            broken.append(i)
+                            continue
+                        error = e
+                    except Exception as e:
+                        error = e
+                    else:
+                        concentrations[indices] = shard_concentrations
+                        distances[indices] = shard_distances
+                        interpolated[indices] = shard_interpolated
+                        if metrics is not None:
+                            metrics.update(counters)
+                        if aggregates is not None:
+                            for period, n in pruned.items():
+                                aggregates.pruned[period] += n
+                        logger.info('Shard {} ({} {} to {}): {:,} footprints in {:.1f}s, {:,.0f} footprints/s'.format(
+                            i, pole, dates[indices[0]], dates[indices[-1]], indices.size, elapsed,
+                            indices.size / max(elapsed, 1e-9)))
+                        continue
+                    attempts[i] += 1
+                    if attempts[i] > retries:
+                        raise error
+                    logger.warning('Shard {} ({} {} to {}) failed on attempt {}, retrying: {}'.format(
+                        i, pole, dates[indices[0]], dates[indices[-1]], attempts[i], error))
+                    failed.append(i)
+        pending = failed + broken
+        isolate = bool(broken)
+
+    return concentrations, distances, interpolated
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Background prefetch of the daily sea-ice rasters a sampling run will
+read next.
+
+The sampler visits each pole's dates in ascending order, so the sequence
+of rasters it will ask for is known before it starts. A RasterPrefetcher
+wraps a raster source and, as each day is requested, reads and decodes
+the next few days on a thread pool while the current day's footprints
+are computed. Time the sampler spends waiting on a raster (a stall) is
+recorded, to tune the depth for slow or network-mounted raster shares.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+import numpy as np
+
+from sea_ice_sampling import POLE_EPSG, choose_poles, to_dates
+
+
+logger = logging.getLogger(__name__)
+
+
+def sampling_order(ys, dates):
+    '''
+    Returns the list of (pole, date) that sea_ice_sampling.sample_sea_ice
+    requests from its raster source for these footprints, in order.
+    ys: centroid latitudes
+    dates: acquisition dates
+    '''
+    poles = choose_poles(ys)
+    dates = to_dates(dates)
+    order = []
+    for pole in POLE_EPSG:
+        order.extend((pole, date) for date in np.unique(dates[poles == pole]))
+
+    return order
+
+
+class RasterPrefetcher(object):
+    '''
+    Raster source that reads ahead of the sampler.
+    raster_source: function taking (pole, date) and returning (array, geotransform) or None,
+                   called from the worker threads, so it must be thread safe
+    schedule: (pole, date) in the order they will be requested, from sampling_order;
+              days may be passed over, and days before the last requested
+              (e.g. the gap filler's neighbouring days) are read directly
+    depth: most days to read ahead
+    max_mb: memory ceiling for rasters read ahead but not yet requested
+    workers: number of reader threads
+    '''
+    def __init__(self, raster_source, schedule=(), depth=4, max_mb=256, workers=2):
+        self.raster_source = raster_source
+        self.depth = depth
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.executor = ThreadPoolExecutor(max_workers=workers) if depth > 0 else None
+        self.pending = OrderedDict()
+        self.raster_bytes = None
+        self.reschedule(schedule)
+        self.ready = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.direct = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def reschedule(self, schedule):
+        '''
+        Replaces the schedule, e.g. once the footprints still to sample are
+        known, dropping anything read ahead for the old one.
+        '''
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.schedule = [(pole, np.datetime64(date, 'D')) for pole, date in schedule]
+        self.positions = {key: i for i, key in enumerate(self.schedule)}
+        ## Position in the schedule of the last day requested in order, and of the next to read ahead
+        self.cursor = -1
+        self.next_i = 0
+
+
+    def close(self):
+        if self.executor is not None:
+            for future in self.pending.values():
+                future.cancel()
+            self.executor.shutdown(wait=True)
+        self.pending.clear()
+
+
+    def read_ahead(self):
+        '''
+        Submits the days after the cursor until depth days are pending or
+        the next would pass the memory ceiling.
+        '''
+        if self.executor is None:
+            return
+        self.next_i = max(self.next_i, self.cursor + 1)
+        while self.next_i < len(self.schedule) and len(self.pending) < self.depth:
+            ## Until the first raster is read its size is unknown, so read one at a time
+            limit = 1 if self.raster_bytes is None else self.max_bytes // max(self.raster_bytes, 1)
+            if len(self.pending) >= limit:
+                break
+            key = self.schedule[self.next_i]
+            self.next_i += 1
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(self.raster_source, *key)
+
+
+    def __call__(self, pole, date):
+        key = (pole, np.datetime64(date, 'D'))
+        position = self.positions.get(key, -1)
+        in_order = position > self.cursor
+        future = None
+        if in_order:
+            ## Days passed over were not needed, e.g. every footprint settled by the aggregates
+            for skipped in [k for k in self.pending if self.positions[k] < position]:
+                self.pending.pop(skipped).cancel()
+            self.cursor = position
+            ## Start on the following days before waiting on this one
+            future = self.pending.pop(key, None)
+            self.read_ahead()
+
+        start = time.time()
+        if future is None:
+            self.direct += 1
+            raster = self.raster_source(*key)
+        else:
+            if future.done():
+                self.ready += 1
+            raster = future.result()
+        waited = time.time() - start
+        if future is None or waited > 0.001:
+            self.stalls += 1
+            self.stall_seconds += waited
+
+        if raster is not None:
+            self.raster_bytes = max(self.raster_bytes or 0, raster[0].nbytes)
+        if in_order:
+            self.read_ahead()
+
+        return raster
+
+
+    def stats(self):
+        return {
+                'ready': self.ready,
+                'direct': self.direct,
+                'stalls': self.stalls,
+                'stall_seconds': round(self.stall_seconds, 3),
+                }
+
+
+    def log_stats(self):
+        logger.info('Raster prefetch - ready: {ready:,}, read directly: {direct:,}, '
+                    'stalls: {stalls:,} ({stall_seconds:.1f}s)'.format(**self.stats()))
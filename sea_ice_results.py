@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent store of sea-ice sampling results.
+
+Results are kept in SQLite keyed by footprint (catalog id and centroid,
+as scene level sources hold several scenes per catalog id), acquisition
+date and the sampling parameters, alongside the version (mtime and size) of the raster
+they were sampled from. A rerun over overlapping candidates only samples
+footprints that are new or whose raster has changed since, e.g. after
+resample_loop reprocesses a day, and a change of ice threshold is a
+filter over stored concentrations.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
+from sea_ice_sampling import choose_poles, to_dates
+
+
+logger = logging.getLogger(__name__)
+
+
+## Stored values of each footprint, in order
+RESULT_COLUMNS = ('concentration', 'distance', 'max', 'fraction', 'interpolated')
+
+
+def footprint_keys(ids, xs, ys, wkbs=None):
+    '''
+    Returns a key for each footprint that is unique per scene and stable
+    across runs (unlike OBJECTID): the catalog id and the centroid to about
+    a decimetre, plus a hash of the geometry when it is sampled whole.
+    ids: catalog ids
+    xs, ys: centroid longitude, latitude
+    wkbs: footprint geometries as WKB, for zonal sampling
+    '''
+    keys = ['{}|{:.6f}|{:.6f}'.format(i, x, y) for i, x, y in zip(ids, xs, ys)]
+    if wkbs is not None:
+        keys = ['{}|{}'.format(key, hashlib.sha1(wkb).hexdigest()[:16]) for key, wkb in zip(keys, wkbs)]
+
+    return np.array(keys, dtype=object)
+
+
+def file_version(raster_p):
+    '''
+    Returns a version string that changes whenever the raster is rewritten.
+    '''
+    stat = os.stat(raster_p)
+
+    return '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def file_day_version(raster_lookup):
+    '''
+    Returns a function taking (pole, date) and returning the version of
+    that day's raster file, or None if there is none.
+    raster_lookup: function taking (pole, date) and returning a raster path
+    '''
+    def day_version(pole, date):
+        raster_p = raster_lookup(pole, date)
+        return None if raster_p is None else file_version(raster_p)
+
+    return day_version
+
+
+def raster_version(day_version, gap_filler=None):
+    '''
+    Returns a function taking (pole, date) and returning the version of the
+    raster sampled for that day, or '' if there is none. Gap filled days
+    take the versions of the days they were interpolated from.
+    day_version: function taking (pole, date) and returning a version string,
+                 or None if there is no raster for the day
+    gap_filler: sea_ice_gapfill.GapFiller wrapping the raster source, if any
+    '''
+    def version(pole, date):
+        day = day_version(pole, date)
+        if day is not None:
+            return day
+        if gap_filler is None:
+            return ''
+        earlier, later = gap_filler.neighbours(pole, np.datetime64(date, 'D'))
+        if earlier is None and later is None:
+            return ''
+        return 'filled:{}|{}'.format(day_version(pole, earlier) if earlier is not None else '',
+                                     day_version(pole, later) if later is not None else '')
+
+    return version
+
+
+def footprint_versions(ys, dates, version):
+    '''
+    Returns an array of the raster version for each footprint, calling
+    version (from raster_version) once per (pole, date). Non-polar
+    footprints get ''.
+    '''
+    poles = choose_poles(ys)
+    dates = to_dates(dates)
+    versions = np.full(poles.shape, '', dtype=object)
+    for pole in np.unique(poles[poles != '']):
+        in_pole = np.flatnonzero(poles == pole)
+        group_dates, inverse = np.unique(dates[in_pole], return_inverse=True)
+        group_versions = np.array([version(pole, date) for date in group_dates], dtype=object)
+        versions[in_pole] = group_versions[inverse]
+
+    return versions
+
+
+class SamplingResultStore(object):
+    '''
+    SQLite store of sampling results.
+    db_p: path to the database, created if it does not exist
+    params: dictionary of sampling parameters; results sampled with other
+            parameters are kept apart
+    '''
+    def __init__(self, db_p, params=None):
+        os.makedirs(os.path.dirname(db_p) or '.', exist_ok=True)
+        self.db_p = db_p
+        self.params = json.dumps(params or {}, sort_keys=True)
+        self.conn = sqlite3.connect(db_p)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(results)')]
+        if columns and 'footprint' not in columns:
+            ## Results keyed by catalog id alone mixed up scenes of one catalog id, so drop them
+            logger.info('Dropping results keyed by catalog id from {}.'.format(db_p))
+            self.conn.execute('DROP TABLE results')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                             footprint TEXT NOT NULL,
+                             acq_date TEXT NOT NULL,
+                             params TEXT NOT NULL,
+                             raster_version TEXT NOT NULL,
+                             {},
+                             PRIMARY KEY (footprint, acq_date, params))'''.format(
+                          ', '.join('{} REAL'.format(c) for c in RESULT_COLUMNS)))
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def keys(self, footprints, dates, versions):
+        return list(zip([str(f) for f in footprints], [str(d) for d in to_dates(dates)], [str(v) for v in versions]))
+
+
+    def get(self, footprints, dates, versions):
+        '''
+        Returns (found, values): a boolean array of footprints with a
+        current result, and a (n, len(RESULT_COLUMNS)) array of their
+        values, NaN where not found or stored empty.
+        footprints: footprint keys, from footprint_keys
+        dates: acquisition dates
+        versions: raster version of each footprint, from footprint_versions
+        '''
+        keys = self.keys(footprints, dates, versions)
+        found = np.zeros(len(keys), dtype=bool)
+        values = np.full((len(keys), len(RESULT_COLUMNS)), np.nan)
+        if not keys:
+            return found, values
+
+        ## Join against the wanted keys in a temporary table rather than one query per footprint
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (i INTEGER, footprint TEXT, acq_date TEXT, raster_version TEXT)')
+        self.conn.execute('DELETE FROM wanted')
+        self.conn.executemany('INSERT INTO wanted VALUES (?, ?, ?, ?)',
+                              [(i, ) + key for i, key in enumerate(keys)])
+        rows = self.conn.execute('''SELECT w.i, {} FROM wanted w JOIN results r
+                                    ON r.footprint = w.footprint AND r.acq_date = w.acq_date
+                                    AND r.params = ? AND r.raster_version = w.raster_version'''.format(
+                                 ', '.join('r.{}'.format(c) for c in RESULT_COLUMNS)), (self.params, )).fetchall()
+        self.conn.execute('DELETE FROM wanted')
+        if rows:
+            rows = np.array(rows, dtype=np.float64)
+            i = rows[:, 0].astype(np.int64)
+            found[i] = True
+            values[i] = rows[:, 1:]
+
+        return found, values
+
+
+    def put(self, footprints, dates, versions, values):
+        '''
+        Stores results, replacing any sampled from an older raster version.
+        values: (n, len(RESULT_COLUMNS)) array, NaN stored as empty
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        rows = [key[:2] + (self.params, key[2]) + tuple(None if np.isnan(v) else float(v) for v in vals)
+                for key, vals in zip(self.keys(footprints, dates, versions), values)]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, {})'.format(
+                                  ', '.join('?' * len(RESULT_COLUMNS))), rows)
+
+
+    def log_stats(self, found):
+        logger.info('Sampling result store - reused: {:,}, sampled: {:,}'.format(found.sum(), found.size - found.sum()))
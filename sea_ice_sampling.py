@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Batch sampling of the resampled NSIDC sea-ice concentration rasters.
+
+Samples every footprint centroid at once rather than one cursor row at
+a time: points are grouped by (pole, date), each group is reprojected
+with a single transform, each daily raster is opened once and every
+window is pulled out with NumPy fancy indexing.
+
+Values follow the original per-row sampling in coastline_sea_ice: the
+mean of a 4x4 window whose lower left corner is two cells down and left
+of the centroid, divided by 10 and truncated. Where the window is all no
+data the nearest valid pixel is used, from a precomputed index, rather
+than growing the window (still available with fallback='window').
+"""
+
+import logging
+
+import numpy as np
+from osgeo import gdal, osr
+
+from sea_ice_nearest import load_nearest_index, nearest_valid_index, nearest_values
+
+
+gdal.UseExceptions()
+
+logger = logging.getLogger(__name__)
+
+
+## Polar stereographic projections of the sea-ice rasters
+POLE_EPSG = {
+        'arctic': 3413, # NSIDC Polar Stereographic North
+        'antarctic': 3412, # NSIDC Polar Stereographic South
+        }
+
+## Sentinel value written to resampled rasters by sea_ice_nodata.resample_nodata
+RESAMPLED_NODATA = -9999
+
+## No data value of compact (uint8) rasters, whose values are read through the band scale and offset
+COMPACT_NODATA = 255
+
+## Highest window value that still samples as 0 (values are 0 - 1000, divided by 10 and truncated)
+ICE_FREE_BELOW = 10
+
+
+def choose_poles(ys):
+    '''
+    Returns an array of the pole to sample for each y (latitude): 'arctic',
+    'antarctic', or '' for non-polar points.
+    ys: array of latitudes
+    '''
+    ys = np.asarray(ys, dtype=np.float64)
+    poles = np.full(ys.shape, '', dtype='<U9')
+    poles[ys > 50.0] = 'arctic'
+    poles[ys < -50.0] = 'antarctic'
+
+    return poles
+
+
+def to_dates(dates):
+    '''
+    Converts date strings ('2019-08-21', '2019-08-21 14:15:04' or OGR's
+    '2019/08/21'), datetimes or datetime64 values to a datetime64[D] array.
+    '''
+    dates = np.asarray(dates)
+    if dates.dtype.kind in ('U', 'S', 'O'):
+        dates = np.array([str(d)[:10].replace('/', '-') for d in dates], dtype='datetime64[D]')
+
+    return dates.astype('datetime64[D]')
+
+
+def project_points(xs, ys, epsg, src_epsg=4326):
+    '''
+    Reprojects arrays of points with a single transform.
+    xs, ys: arrays of coordinates in src_epsg (longitude, latitude by default)
+    epsg: EPSG code to project to
+    '''
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromEPSG(src_epsg)
+    src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(epsg)
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    if xs.size == 0:
+        return xs.copy(), ys.copy()
+    projected = np.array(transform.TransformPoints(np.column_stack([xs, ys]).tolist()))
+
+    return projected[:, 0], projected[:, 1]
+
+
+def unscale(arr, scale=None, offset=None):
+    '''
+    Applies a raster's scale and offset in place, e.g. compact rasters
+    stored as percent with a scale of 10 are returned in the original
+    0 - 1000 units. Returns arr.
+    '''
+    scale = 1.0 if scale is None else scale
+    offset = 0.0 if offset is None else offset
+    if scale != 1.0:
+        arr *= scale
+    if offset != 0.0:
+        arr += offset
+
+    return arr
+
+
+def read_sea_ice_raster(raster_p):
+    '''
+    Reads a resampled sea-ice raster, returning the values as a float array
+    with no data as NaN, and the geotransform. Values are read through the
+    band's scale and offset, so compact rasters come back in the same units
+    as full ones.
+    raster_p: path to raster
+    '''
+    ds = gdal.Open(raster_p)
+    gt = ds.GetGeoTransform()
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    arr = band.ReadAsArray().astype(np.float64)
+    arr[arr == RESAMPLED_NODATA] = np.nan
+    if nodata is not None:
+        arr[arr == nodata] = np.nan
+    unscale(arr, band.GetScale(), band.GetOffset())
+    ds = None
+
+    return arr, gt
+
+
+def file_raster_source(raster_lookup, reader=read_sea_ice_raster):
+    '''
+    Returns a raster source for sample_sea_ice that reads daily rasters
+    from disk.
+    raster_lookup: function taking (pole, date) and returning a raster path,
+                   or None if there is no raster for that day
+    reader: function taking a raster path and returning (array, geotransform)
+    '''
+    def source(pole, date):
+        raster_p = raster_lookup(pole, date)
+        if raster_p is None:
+            return None
+        return reader(raster_p)
+
+    return source
+
+
+def window_origins(gt, x_prj, y_prj):
+    '''
+    Returns the (row, col) of the cell holding the lower left corner of
+    each point's sampling window: two cells down and left of the point.
+    gt: geotransform of the raster
+    x_prj, y_prj: arrays of coordinates in the projection of the raster
+    '''
+    cell_width, cell_height = abs(gt[1]), abs(gt[5])
+    ll_x = x_prj - (2 * cell_width)
+    ll_y = y_prj - (2 * cell_height)
+    cols = np.floor((ll_x - gt[0]) / gt[1]).astype(np.int64)
+    rows = np.floor((ll_y - gt[3]) / gt[5]).astype(np.int64)
+
+    return rows, cols
+
+
+def window_means(arr, rows, cols, window=4, max_window=11):
+    '''
+    Returns the mean of the valid values in each point's window, growing
+    the window by one row and column (up and right) while it holds no
+    valid values. NaN where the window is still empty at max_window.
+    arr: raster values with no data as NaN
+    rows, cols: cell holding the lower left corner of each window
+    '''
+    ## Pad so windows hanging off the raster read as no data
+    pad = max_window
+    padded = np.pad(arr, pad, mode='constant', constant_values=np.nan)
+    rows = rows + pad
+    cols = cols + pad
+
+    means = np.full(rows.shape, np.nan)
+    pending = np.arange(rows.size)
+    size = window
+    while pending.size and size <= max_window:
+        ## Rows run upward from the lower left corner, columns rightward
+        offsets = np.arange(size)
+        r = np.clip(rows[pending, None] - offsets[::-1], 0, padded.shape[0] - 1)
+        c = np.clip(cols[pending, None] + offsets, 0, padded.shape[1] - 1)
+        values = padded[r[:, :, None], c[:, None, :]]
+
+        valid = ~np.isnan(values)
+        counts = valid.sum(axis=(1, 2))
+        totals = np.where(valid, values, 0.0).sum(axis=(1, 2))
+        found = counts > 0
+        means[pending[found]] = totals[found] / counts[found]
+
+        pending = pending[~found]
+        size += 1
+
+    return means
+
+
+def pixel_locations(gt, x_prj, y_prj):
+    '''
+    Returns the (row, col) of the cell holding each point.
+    '''
+    cols = np.floor((x_prj - gt[0]) / gt[1]).astype(np.int64)
+    rows = np.floor((y_prj - gt[3]) / gt[5]).astype(np.int64)
+
+    return rows, cols
+
+
+def file_nearest_lookup(raster_lookup):
+    '''
+    Returns a nearest_lookup for sample_sea_ice that loads the nearest-valid-
+    pixel index saved next to each raster, building it if it is missing.
+    Days with no raster file (e.g. gap filled days) are indexed in memory.
+    Called with arr None, returns only a saved, current index or None.
+    raster_lookup: function taking (pole, date) and returning a raster path
+    '''
+    def lookup(pole, date, arr):
+        raster_p = raster_lookup(pole, date)
+        if raster_p is None:
+            return None if arr is None else nearest_valid_index(arr)
+        return load_nearest_index(raster_p, arr)
+
+    return lookup
+
+
+def settle_from_tiles(summary, pole, date, x_prj, y_prj, members, in_pole, concentrations, distances,
+                      window, fallback, max_radius_km, nearest_lookup, metrics=None):
+    '''
+    Fills in the footprints of one day that the day's tile summary settles,
+    as sample_sea_ice would from the pixels, returning the members left to
+    sample from the raster.
+    '''
+    rows, cols = window_origins(summary.gt, x_prj[members], y_prj[members])
+    zero, empty = summary.classify(rows, cols, window=window)
+    settled = zero.copy()
+    values = np.where(zero, 0.0, np.nan)
+    dists = np.where(zero, 0.0, np.nan)
+
+    empty_i = np.flatnonzero(empty)
+    if fallback == 'nearest' and empty_i.size:
+        ## Only with an index already saved, building one would need the pixels
+        nearest = nearest_lookup(pole, date, None)
+        if nearest is not None:
+            indices, pixel_distances = nearest
+            p_rows, p_cols = pixel_locations(summary.gt, x_prj[members][empty_i], y_prj[members][empty_i])
+            nearest_settled, values[empty_i], dists[empty_i] = summary.settle_nearest(
+                indices, pixel_distances, p_rows, p_cols, cell_size=abs(summary.gt[1]),
+                max_radius=max_radius_km * 1000)
+            dists[empty_i] /= 1000
+            settled[empty_i] = nearest_settled
+            if metrics is not None:
+                metrics.count('window_fallbacks', nearest_settled.sum())
+                metrics.count('unsampled', np.isnan(values[empty_i][nearest_settled]).sum())
+
+    out = in_pole[members[settled]]
+    concentrations[out] = values[settled]
+    distances[out] = dists[settled]
+    if metrics is not None:
+        metrics.count('tile_settled', settled.sum())
+
+    return members[~settled]
+
+
+def sample_sea_ice(xs, ys, dates, raster_source, window=4, max_window=11, fallback='nearest',
+                   max_radius_km=100, nearest_lookup=None, return_distance=False, metrics=None,
+                   aggregates=None, tile_lookup=None):
+    '''
+    Samples sea-ice concentration for arrays of footprint centroids.
+    Returns a float array of concentrations: 0 for non-polar points and
+    NaN where there is no raster for the date or no valid value was found.
+    With return_distance, also returns the distance in km from each
+    centroid to the value used: 0 for window hits and non-polar points.
+    xs, ys: arrays of centroid longitude, latitude
+    dates: array of acquisition dates (strings, datetimes or datetime64)
+    raster_source: function taking (pole, datetime64 date) and returning
+                   (array, geotransform) for that day's raster, or None
+    window: sampling window size in cells
+    fallback: what to do when the window is all no data:
+              'nearest' - take the nearest valid pixel within max_radius_km
+              'window' - grow the window one row and column at a time up
+                         to max_window, as the original per-row loop did
+    nearest_lookup: function taking (pole, date, array) and returning the
+                    (indices, distances) from sea_ice_nearest; computed from
+                    the array if None
+    metrics: pipeline_metrics.RunMetrics to count rasters and fallbacks in
+    aggregates: sea_ice_aggregate.SeaIceAggregates; footprints they show are
+                surely ice free get 0 without reading the day's raster
+    tile_lookup: function taking (pole, date) and returning the day's
+                 sea_ice_tiles.TileSummary or None; footprints it settles
+                 (ice-free windows, and all no data windows whose nearest
+                 valid pixel is ice free or out of range) are not read
+    '''
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    dates = to_dates(dates)
+    poles = choose_poles(ys)
+    if nearest_lookup is None:
+        nearest_lookup = lambda pole, date, arr: None if arr is None else nearest_valid_index(arr)
+
+    concentrations = np.zeros(xs.shape, dtype=np.float64)
+    distances = np.zeros(xs.shape, dtype=np.float64)
+
+    for pole, epsg in POLE_EPSG.items():
+        in_pole = np.flatnonzero(poles == pole)
+        if in_pole.size == 0:
+            continue
+        x_prj, y_prj = project_points(xs[in_pole], ys[in_pole], epsg)
+
+        ## Group by date so each daily raster is read once
+        order = np.argsort(dates[in_pole], kind='stable')
+        group_dates, starts = np.unique(dates[in_pole][order], return_index=True)
+        bounds = np.append(starts, order.size)
+        logger.info('Sampling {:,} {} footprints across {:,} dates.'.format(in_pole.size, pole, group_dates.size))
+        read_footprints = unique_windows = 0
+        for date, start, stop in zip(group_dates, bounds[:-1], bounds[1:]):
+            members = order[start:stop]
+            if aggregates is not None:
+                free = aggregates.ice_free(pole, date, x_prj[members], y_prj[members], window=window)
+                concentrations[in_pole[members[free]]] = 0
+                distances[in_pole[members[free]]] = 0
+                members = members[~free]
+                if metrics is not None:
+                    metrics.count('aggregate_pruned', free.sum())
+                if members.size == 0:
+                    if metrics is not None:
+                        metrics.count('rasters_pruned')
+                    continue
+            summary = tile_lookup(pole, date) if tile_lookup is not None else None
+            if summary is not None:
+                members = settle_from_tiles(summary, pole, date, x_prj, y_prj, members, in_pole, concentrations,
+                                            distances, window, fallback, max_radius_km, nearest_lookup, metrics)
+                if members.size == 0:
+                    if metrics is not None:
+                        metrics.count('rasters_pruned')
+                    continue
+            out = in_pole[members]
+            raster = raster_source(pole, date)
+            if raster is None:
+                logger.warning('No {} raster for {}, leaving {:,} footprints empty.'.format(pole, date, members.size))
+                concentrations[out] = np.nan
+                distances[out] = np.nan
+                if metrics is not None:
+                    metrics.count('rasters_missing')
+                continue
+            arr, gt = raster
+            rows, cols = window_origins(gt, x_prj[members], y_prj[members])
+            p_rows, p_cols = pixel_locations(gt, x_prj[members], y_prj[members])
+            ## Footprints with the same window and cell on this day (stereo pairs, repeat
+            ## collects, strips) are sampled once and the result scattered back to each
+            _keys, first, inverse = np.unique(np.column_stack([rows, cols, p_rows, p_cols]), axis=0,
+                                              return_index=True, return_inverse=True)
+            inverse = inverse.ravel()
+            read_footprints += members.size
+            unique_windows += first.size
+
+            grow_to = max_window if fallback == 'window' else window
+            means = window_means(arr, rows[first], cols[first], window=window, max_window=grow_to)
+            dists = np.where(np.isnan(means), np.nan, 0.0)
+
+            empty = np.flatnonzero(np.isnan(means))
+            if fallback == 'nearest' and empty.size:
+                ## One lookup in the nearest-valid-pixel index instead of growing the window
+                indices, pixel_distances = nearest_lookup(pole, date, arr)
+                means[empty], dists[empty] = nearest_values(arr, indices, pixel_distances,
+                                                            p_rows[first][empty], p_cols[first][empty],
+                                                            cell_size=abs(gt[1]), max_radius=max_radius_km * 1000)
+                dists[empty] /= 1000
+
+            concentrations[out] = np.trunc(means / 10)[inverse]
+            distances[out] = dists[inverse]
+            if metrics is not None:
+                metrics.count('rasters_sampled')
+                metrics.count('window_fallbacks', np.isin(inverse, empty).sum() if fallback == 'nearest' else 0)
+                metrics.count('unsampled', np.isnan(means)[inverse].sum())
+                metrics.count('footprints_read', members.size)
+                metrics.count('unique_windows', first.size)
+
+        if read_footprints:
+            logger.info('Sampled {:,} {} footprints from {:,} unique windows ({:.1%} deduplicated).'.format(
+                read_footprints, pole, unique_windows, 1 - unique_windows / read_footprints))
+
+    if return_distance:
+        return concentrations, distances
+
+    return concentrations
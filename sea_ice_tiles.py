@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Per-tile summaries of the resampled sea-ice rasters.
+
+Each daily concentration raster gets a sidecar, {raster}.tiles.npz, with
+the minimum, maximum and number of valid pixels of every tile_size square
+tile, and the geotransform to map footprint locations to tiles. From the
+sidecar alone the sampler can tell that a footprint's window lies in
+tiles that are wholly valid and below 10 (a concentration of 0 once
+divided by 10 and truncated), or in tiles with no valid pixels at all,
+where it goes straight to the nearest-valid-pixel fallback. Only days
+with footprints in tiles holding ice need their pixels read.
+"""
+
+import os
+
+import numpy as np
+
+from sea_ice_sampling import ICE_FREE_BELOW
+
+
+## Summary tile size in pixels, at least the sampling window so a window spans at most 2 x 2 tiles
+TILE_SIZE = 16
+
+
+def tile_summary_path(raster_p):
+    return '{}.tiles.npz'.format(raster_p)
+
+
+class TileSummary(object):
+    '''
+    Per-tile statistics of one raster.
+    tile_min, tile_max: (tile rows, tile cols) arrays, NaN for tiles with no valid pixels
+    valid: number of valid pixels in each tile
+    pixels: number of raster pixels in each tile (edge tiles may be partial)
+    shape: (rows, cols) of the raster
+    gt: geotransform of the raster
+    '''
+    def __init__(self, tile_min, tile_max, valid, pixels, shape, gt, tile_size=TILE_SIZE):
+        self.tile_min = tile_min
+        self.tile_max = tile_max
+        self.valid = valid
+        self.pixels = pixels
+        self.shape = tuple(int(n) for n in shape)
+        self.gt = tuple(gt)
+        self.tile_size = int(tile_size)
+
+
+    @classmethod
+    def from_array(cls, arr, gt, tile_size=TILE_SIZE):
+        '''
+        Summarizes a raster with no data as NaN.
+        '''
+        tile_rows = -(-arr.shape[0] // tile_size)
+        tile_cols = -(-arr.shape[1] // tile_size)
+        padded = np.full((tile_rows * tile_size, tile_cols * tile_size), np.nan)
+        padded[:arr.shape[0], :arr.shape[1]] = arr
+        tiles = padded.reshape(tile_rows, tile_size, tile_cols, tile_size).swapaxes(1, 2)
+        valid = ~np.isnan(tiles)
+
+        counts = valid.sum(axis=(2, 3))
+        tile_min = np.where(valid, tiles, np.inf).min(axis=(2, 3))
+        tile_max = np.where(valid, tiles, -np.inf).max(axis=(2, 3))
+        tile_min[counts == 0] = np.nan
+        tile_max[counts == 0] = np.nan
+        on_raster = np.zeros(padded.shape, dtype=bool)
+        on_raster[:arr.shape[0], :arr.shape[1]] = True
+        pixels = on_raster.reshape(tile_rows, tile_size, tile_cols, tile_size).sum(axis=(1, 3))
+
+        return cls(tile_min.astype(np.float32), tile_max.astype(np.float32), counts.astype(np.int32),
+                   pixels.astype(np.int32), arr.shape, gt, tile_size)
+
+
+    def tiles(self, rows, cols):
+        '''
+        Returns the (tile row, tile col) of each pixel, clipped to the tile grid.
+        '''
+        tile_rows = np.clip(rows // self.tile_size, 0, self.valid.shape[0] - 1)
+        tile_cols = np.clip(cols // self.tile_size, 0, self.valid.shape[1] - 1)
+
+        return tile_rows, tile_cols
+
+
+    def classify(self, rows, cols, window=4):
+        '''
+        Returns (zero, empty) boolean arrays for sampling windows: zero where
+        every pixel of the window is valid and below ICE_FREE_BELOW, so the
+        window samples as 0, and empty where no pixel of the window is valid.
+        rows, cols: cell holding the lower left corner of each window, as from
+                    sea_ice_sampling.window_origins
+        '''
+        if window > self.tile_size:
+            none = np.zeros(np.shape(rows), dtype=bool)
+            return none, none
+
+        ## Rows run upward from the lower left corner, columns rightward, as in window_means
+        top, bottom = rows - window + 1, rows
+        left, right = cols, cols + window - 1
+        on_raster = (top >= 0) & (bottom < self.shape[0]) & (left >= 0) & (right < self.shape[1])
+        off_raster = (bottom < 0) | (top >= self.shape[0]) | (right < 0) | (left >= self.shape[1])
+
+        ## A window spans at most two tiles each way, so its corner tiles cover it
+        zero = on_raster.copy()
+        empty = np.ones(np.shape(rows), dtype=bool)
+        for r in (np.clip(top, 0, self.shape[0] - 1), np.clip(bottom, 0, self.shape[0] - 1)):
+            for c in (np.clip(left, 0, self.shape[1] - 1), np.clip(right, 0, self.shape[1] - 1)):
+                tile_r, tile_c = self.tiles(r, c)
+                valid = self.valid[tile_r, tile_c]
+                zero &= (valid == self.pixels[tile_r, tile_c]) & (self.tile_max[tile_r, tile_c] < ICE_FREE_BELOW)
+                empty &= valid == 0
+
+        return zero, empty | off_raster
+
+
+    def below(self, rows, cols):
+        '''
+        Returns a boolean array, True where the pixel's tile is below
+        ICE_FREE_BELOW, so any valid value there samples as 0.
+        '''
+        tile_r, tile_c = self.tiles(rows, cols)
+
+        return self.tile_max[tile_r, tile_c] < ICE_FREE_BELOW
+
+
+    def settle_nearest(self, indices, distances, rows, cols, cell_size, max_radius):
+        '''
+        Settles the nearest-valid-pixel fallback without the raster's
+        pixels, as sea_ice_nearest.nearest_values would. Returns (settled,
+        values, distances): values are 0, or NaN where the point is off the
+        raster or the nearest valid pixel is farther than max_radius.
+        indices, distances: nearest-valid-pixel index of the raster
+        rows, cols: cell holding each point
+        '''
+        values = np.full(rows.shape, np.nan)
+        dists = np.full(rows.shape, np.nan)
+        settled = ~((rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1]))
+        on_i = np.flatnonzero(~settled)
+        r, c = rows[on_i], cols[on_i]
+        d = distances[r, c].astype(np.float64) * cell_size
+        beyond = d > max_radius
+        ## Within range: settled if the nearest valid pixel lies in a tile below ICE_FREE_BELOW
+        zero = ~beyond & self.below(indices[0, r, c].astype(np.int64), indices[1, r, c].astype(np.int64))
+        settled[on_i[beyond | zero]] = True
+        values[on_i[zero]] = 0
+        dists[on_i[zero]] = d[zero]
+
+        return settled, values, dists
+
+
+    def save(self, summary_p, raster_mtime):
+        ## np.savez appends .npz to names without it, so write to a .npz temp file
+        tmp_p = '{}.tmp.npz'.format(summary_p[:-len('.npz')])
+        np.savez_compressed(tmp_p, tile_min=self.tile_min, tile_max=self.tile_max, valid=self.valid,
+                            pixels=self.pixels, shape=np.array(self.shape), gt=np.array(self.gt),
+                            tile_size=self.tile_size, raster_mtime=np.int64(raster_mtime))
+        os.replace(tmp_p, summary_p)
+
+
+def write_tile_summary(raster_p, arr, gt, tile_size=TILE_SIZE):
+    '''
+    Computes and saves the tile summary for raster_p.
+    arr: raster values with no data as NaN
+    '''
+    summary = TileSummary.from_array(arr, gt, tile_size=tile_size)
+    summary.save(tile_summary_path(raster_p), os.stat(raster_p).st_mtime_ns)
+
+    return summary
+
+
+def load_tile_summary(raster_p):
+    '''
+    Returns the saved TileSummary for raster_p, or None if there is none or
+    the raster has changed since it was written.
+    '''
+    summary_p = tile_summary_path(raster_p)
+    if not os.path.exists(summary_p):
+        return None
+    with np.load(summary_p) as npz:
+        if int(npz['raster_mtime']) != os.stat(raster_p).st_mtime_ns:
+            return None
+        return TileSummary(npz['tile_min'], npz['tile_max'], npz['valid'], npz['pixels'], npz['shape'],
+                           npz['gt'].tolist(), int(npz['tile_size']))
+
+
+def file_tile_lookup(raster_lookup):
+    '''
+    Returns a tile_lookup for sea_ice_sampling.sample_sea_ice that loads the
+    summary saved next to each day's raster, None for days with no raster
+    file (e.g. gap filled days) or no current summary.
+    raster_lookup: function taking (pole, date) and returning a raster path
+    '''
+    def lookup(pole, date):
+        raster_p = raster_lookup(pole, date)
+        if raster_p is None:
+            return None
+        return load_tile_summary(raster_p)
+
+    return lookup
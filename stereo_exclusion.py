@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Excludes the higher off-nadir angle id of each stereopair from a set of
+footprints.
+
+The max off-nadir ids are kept as a sorted array of catalog ids in a
+.npy cache, and footprints are excluded with an anti-join against it
+rather than with a NOT IN clause in the selection where-clause.
+
+Given a change (ingest or modification timestamp) column of the stereo
+layer, a refresh pulls only the stereo rows changed since the stored
+watermark, with the min off-nadir rows of their ids, and merges their max
+off-nadir ids into the array. Pairs removed from the layers can only be
+seen in a full read of both layers, which is done on the first refresh,
+without a change column, and every full_refresh_days; it rewrites the
+cache only if the pair ids differ from the last full read.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from query_danco import query_footprint
+
+
+logger = logging.getLogger(__name__)
+
+
+MIN_ONA_LAYER = 'dg_stereo_catalogids_having_min_ona'
+STEREO_LAYER = 'dg_imagery_index_stereo_onhand_cc20'
+
+## Ids per min off nadir query in an incremental refresh
+QUERY_CHUNK = 1000
+
+
+def max_ona_ids(min_ona, all_str):
+    '''
+    Returns the unique ids with the higher off nadir angle of each stereopair.
+    min_ona: dataframe with 'catalogid' of the min off nadir ids
+    all_str: dataframe with 'catalogid' and 'stereopair' of stereo footprints
+    '''
+    min_ids = min_ona['catalogid']
+    ## Pairs listing the min ona id as 'catalogid' give the max as 'stereopair', and vice versa
+    max_ids1 = all_str.loc[all_str['catalogid'].isin(min_ids), 'stereopair']
+    max_ids2 = all_str.loc[all_str['stereopair'].isin(min_ids), 'catalogid']
+
+    return pd.concat([max_ids1, max_ids2]).dropna().unique()
+
+
+def latest(values, default=None):
+    '''
+    Returns the highest non-null value of a series as a string, default if none.
+    '''
+    values = values.dropna().astype(str)
+
+    return values.max() if len(values) else default
+
+
+class MaxOnaCache(object):
+    '''
+    Sorted array of max off nadir catalog ids saved under wd/pickles, with
+    the state of the last refresh: the hash of the pair ids at the last full
+    read, its date, and the change column watermark.
+    '''
+    def __init__(self, wd):
+        self.ids_p = os.path.join(wd, 'pickles', 'max_ona_ids.npy')
+        self.state_p = os.path.join(wd, 'pickles', 'max_ona_ids.json')
+        self.ids = np.array([], dtype=str)
+        self.state = {}
+        if os.path.exists(self.ids_p):
+            self.ids = np.load(self.ids_p)
+        if os.path.exists(self.state_p):
+            with open(self.state_p, 'r') as handle:
+                self.state = json.load(handle)
+
+
+    def __len__(self):
+        return self.ids.size
+
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.ids_p), exist_ok=True)
+        np.save(self.ids_p, self.ids)
+        with open(self.state_p, 'w') as handle:
+            json.dump(self.state, handle)
+
+
+    def refresh(self, where=None, changed_col=None, full_refresh_days=7):
+        '''
+        Brings the max off nadir ids up to date with the stereo layers.
+        Returns the number of ids added or removed.
+        where: additional SQL to limit the stereo footprints, e.g. "platform in ('WV02', 'WV03')"
+        changed_col: ingest or modification timestamp column of the stereo
+                     layer; without it every refresh is a full read
+        full_refresh_days: days between full reads, which drop removed pairs
+        '''
+        full_refreshed = self.state.get('full_refreshed')
+        due = (full_refreshed is None or
+               datetime.date.today() - datetime.date.fromisoformat(full_refreshed) >= datetime.timedelta(days=full_refresh_days))
+        if (changed_col is None or due or not os.path.exists(self.ids_p) or self.state.get('watermark') is None
+                or self.state.get('changed_col') != changed_col or self.state.get('where') != where):
+            return self.full_refresh(where=where, changed_col=changed_col)
+
+        clause = "{} > '{}'".format(changed_col, self.state['watermark'])
+        if where:
+            clause = '({}) AND ({})'.format(clause, where)
+        changed = query_footprint(layer=STEREO_LAYER, columns=['catalogid', 'stereopair', changed_col], where=clause)
+        if changed.empty:
+            logger.info('No stereopairs changed since {}.'.format(self.state['watermark']))
+            return 0
+
+        ## Only the min off nadir rows of the changed pairs' ids
+        pair_ids = np.unique(pd.concat([changed['catalogid'], changed['stereopair']]).dropna().astype(str))
+        min_ona = pd.concat([query_footprint(layer=MIN_ONA_LAYER, columns=['catalogid'],
+                                             where='catalogid IN ({})'.format(
+                                                     ', '.join("'{}'".format(i) for i in pair_ids[j:j + QUERY_CHUNK])))
+                             for j in range(0, pair_ids.size, QUERY_CHUNK)])
+        new_ids = np.unique(np.asarray(max_ona_ids(min_ona, changed), dtype=str))
+        before = self.ids.size
+        self.ids = np.union1d(self.ids, new_ids)
+        self.state['watermark'] = latest(changed[changed_col], self.state['watermark'])
+        self.save()
+        logger.info('Merged {:,} changed stereopairs: {:,} max off nadir ids added ({:,} total).'.format(
+            len(changed), self.ids.size - before, self.ids.size))
+
+        return self.ids.size - before
+
+
+    def full_refresh(self, where=None, changed_col=None):
+        '''
+        Recomputes the max off nadir ids from both layers in full, rewriting
+        the cache if the pair ids changed since the last full read.
+        '''
+        columns = ['catalogid', 'stereopair'] + ([changed_col] if changed_col else [])
+        all_str = query_footprint(layer=STEREO_LAYER, columns=columns, where=where)
+        min_ona = query_footprint(layer=MIN_ONA_LAYER, columns=['catalogid'])
+        self.state.update({'full_refreshed': datetime.date.today().isoformat(), 'changed_col': changed_col,
+                           'where': where,
+                           'watermark': latest(all_str[changed_col]) if changed_col else None})
+
+        ## Order independent hash of both layers' ids
+        digest = hashlib.sha1()
+        for values in (all_str['catalogid'], all_str['stereopair'], min_ona['catalogid']):
+            digest.update('\n'.join(sorted(values.dropna().astype(str))).encode('utf-8'))
+            digest.update(b'|')
+        pairs_hash = digest.hexdigest()
+        if pairs_hash == self.state.get('pairs_hash') and os.path.exists(self.ids_p):
+            logger.info('Stereopairs unchanged since the last full refresh.')
+            self.save()
+            return 0
+
+        ids = np.unique(np.asarray(max_ona_ids(min_ona, all_str), dtype=str))
+        changed = np.setxor1d(self.ids, ids).size
+        self.ids = ids
+        self.state['pairs_hash'] = pairs_hash
+        self.save()
+        logger.info('Refreshed max off nadir ids in full: {:,} added or removed ({:,} total).'.format(
+            changed, self.ids.size))
+
+        return changed
+
+
+    def excluded(self, ids):
+        '''
+        Returns a boolean array, True for ids that are max off nadir ids.
+        '''
+        ids = np.asarray(ids, dtype=str)
+        if self.ids.size == 0:
+            return np.zeros(ids.shape, dtype=bool)
+        pos = np.minimum(np.searchsorted(self.ids, ids), self.ids.size - 1)
+
+        return self.ids[pos] == ids
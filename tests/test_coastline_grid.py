@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that the distance grid pre-screen selects the same footprints as
+the exact coastline distance test.
+"""
+
+import numpy as np
+import pytest
+import shapely
+
+pytest.importorskip('osgeo')
+pytest.importorskip('scipy')
+from coastline_grid import DistanceGrid
+from coastline_proximity import CoastlineIndex, segment_coastline
+
+
+DISTANCE = 10
+KM_PER_DEG_LAT = 111.2
+
+## Parallels at the edge and centre of polar stereographic bands, and in a UTM zone
+COAST_LATS = (60.5, 65.0, 79.5, 84.5, 20.0)
+
+
+@pytest.fixture(scope='module')
+def segments():
+    lons = np.linspace(-20, 20, 161)
+    lines = [shapely.LineString(np.column_stack([lons, np.full(lons.size, lat)])) for lat in COAST_LATS]
+
+    return segment_coastline(np.array(lines, dtype=object))
+
+
+@pytest.fixture(scope='module')
+def grid(segments):
+    return DistanceGrid.build(segments, resolution=1.0, refine=16)
+
+
+def footprints_at(offsets_km, size_km=0.5):
+    '''
+    Returns square footprints whose nearest edge is offsets_km north and
+    south of each coastline parallel.
+    '''
+    geoms = []
+    for lat in COAST_LATS:
+        half_lon = size_km / 2 / (KM_PER_DEG_LAT * np.cos(np.radians(lat)))
+        for offset in offsets_km:
+            for sign in (1, -1):
+                near = lat + sign * offset / KM_PER_DEG_LAT
+                far = lat + sign * (offset + size_km) / KM_PER_DEG_LAT
+                geoms.append(shapely.box(-half_lon, min(near, far), half_lon, max(near, far)))
+
+    return np.array(geoms, dtype=object)
+
+
+@pytest.mark.parametrize('offsets_km', [(DISTANCE - 1, DISTANCE + 1), tuple(np.arange(0, 2 * DISTANCE, 0.25))])
+def test_grid_matches_exact_selection(segments, grid, offsets_km):
+    geoms = footprints_at(offsets_km)
+    exact = CoastlineIndex(segments).within_distance(geoms, DISTANCE)
+    screened = CoastlineIndex(segments, grid=grid).within_distance(geoms, DISTANCE)
+
+    np.testing.assert_array_equal(screened, exact)
+
+
+def test_grid_decides_clear_cases(segments, grid):
+    accept, reject = grid.screen(footprints_at((0.5, 3 * DISTANCE)), DISTANCE)
+
+    assert accept.reshape(len(COAST_LATS), 2, 2)[:, 0].all()
+    assert reject.reshape(len(COAST_LATS), 2, 2)[:, 1].all()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sea-ice FTP sync against a local FTP server.
+"""
+
+from contextlib import contextmanager
+from ftplib import error_perm, error_temp
+import hashlib
+import json
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+import sea_ice_download
+from sea_ice_download import FTPPool, download_file, list_remote, md5sum, sync_rasters
+
+
+MONTH_DIR = 'north/daily/geotiff/2019/08_Aug'
+RASTERS = {
+        'N_20190801_concentration_v3.0.tif': bytes(range(256)) * 40,
+        'N_20190802_concentration_v3.0.tif': b'\x01\x02' * 3000,
+        'N_20190803_concentration_v3.0.tif': b'',
+        }
+
+
+@pytest.fixture
+def ftp_root(tmp_path):
+    root = tmp_path / 'ftp'
+    month_dir = root / MONTH_DIR
+    month_dir.mkdir(parents=True)
+    (root / 'south' / 'daily' / 'geotiff').mkdir(parents=True)
+    for name, data in RASTERS.items():
+        (month_dir / name).write_bytes(data)
+
+    return root
+
+
+class NoMLSDHandler(FTPHandler):
+    '''
+    Server without MLSD, to exercise the LIST fallback.
+    '''
+    def ftp_MLSD(self, path):
+        self.respond('502 Command not implemented.')
+
+
+def serve(root, handler_class):
+    '''
+    Starts an FTP server on a free local port. Returns (port, stop).
+    '''
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(str(root))
+    handler = type('Handler', (handler_class, ), {'authorizer': authorizer})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    stopping = threading.Event()
+
+    def loop():
+        while not stopping.is_set():
+            server.serve_forever(timeout=0.01, blocking=False)
+
+    thread = threading.Thread(target=loop)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        ## The loop is stopped before the server is closed, so it never polls closed sockets
+        stopping.set()
+        thread.join(timeout=5)
+        server.close_all()
+
+    return server.address[1], stop
+
+
+@pytest.fixture
+def ftp_server(ftp_root):
+    port, stop = serve(ftp_root, FTPHandler)
+    yield port
+    stop()
+
+
+@pytest.fixture
+def list_only_server(ftp_root):
+    port, stop = serve(ftp_root, NoMLSDHandler)
+    yield port
+    stop()
+
+
+def test_sync_writes_manifest_and_skips_present_files(tmp_path, ftp_server):
+    out_dir = tmp_path / 'out'
+    kwargs = {'host': '127.0.0.1', 'port': ftp_server, 'root': '/', 'connections': 2}
+
+    assert sync_rasters(str(out_dir), **kwargs) == len(RASTERS)
+
+    with open(str(out_dir / 'download_manifest.json')) as handle:
+        manifest = json.load(handle)
+    assert set(manifest) == {'{}/{}'.format(MONTH_DIR.replace('08_Aug', '08'), name) for name in RASTERS}
+    for rel_p, entry in manifest.items():
+        data = RASTERS[os.path.basename(rel_p)]
+        assert (out_dir / rel_p).read_bytes() == data
+        assert entry == {'size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+
+    assert sync_rasters(str(out_dir), **kwargs) == 0
+    assert sync_rasters(str(out_dir), verify=True, **kwargs) == 0
+
+
+def test_sync_refetches_changed_file(tmp_path, ftp_server):
+    out_dir = tmp_path / 'out'
+    kwargs = {'host': '127.0.0.1', 'port': ftp_server, 'root': '/', 'connections': 2}
+    sync_rasters(str(out_dir), **kwargs)
+
+    local_p = out_dir / 'north' / 'daily' / 'geotiff' / '2019' / '08' / 'N_20190802_concentration_v3.0.tif'
+    local_p.write_bytes(b'\x00' * len(RASTERS['N_20190802_concentration_v3.0.tif']))
+
+    assert sync_rasters(str(out_dir), **kwargs) == 0
+    assert sync_rasters(str(out_dir), verify=True, **kwargs) == 1
+    assert local_p.read_bytes() == RASTERS['N_20190802_concentration_v3.0.tif']
+
+
+@pytest.mark.parametrize('server', ['ftp_server', 'list_only_server'])
+def test_list_remote_sizes(request, server):
+    pool = FTPPool(host='127.0.0.1', port=request.getfixturevalue(server), size=1)
+    try:
+        files = list_remote(pool, '/', 'north')
+    finally:
+        pool.close()
+
+    assert [(os.path.basename(remote_p), size) for remote_p, rel_p, size in files] == [
+            (name, len(data)) for name, data in sorted(RASTERS.items())]
+
+
+def test_sync_records_finished_files_when_one_fails(tmp_path, ftp_server, monkeypatch):
+    out_dir = tmp_path / 'out'
+    listed = list_remote
+
+    def list_with_missing(pool, root, hemisphere, last_update=None):
+        files = listed(pool, root, hemisphere, last_update=last_update)
+        if hemisphere == 'north':
+            files.append(('/{}/N_20190804_concentration_v3.0.tif'.format(MONTH_DIR),
+                          os.path.join('north', 'daily', 'geotiff', '2019', '08', 'N_20190804_concentration_v3.0.tif'),
+                          10))
+        return files
+
+    monkeypatch.setattr(sea_ice_download, 'list_remote', list_with_missing)
+    with pytest.raises(RuntimeError, match='1 of 4 files failed'):
+        sync_rasters(str(out_dir), host='127.0.0.1', port=ftp_server, root='/', connections=2)
+
+    with open(str(out_dir / 'download_manifest.json')) as handle:
+        manifest = json.load(handle)
+    assert sorted(os.path.basename(rel_p) for rel_p in manifest) == sorted(RASTERS)
+
+
+def test_download_resumes_partial_file(tmp_path, ftp_server):
+    name = 'N_20190801_concentration_v3.0.tif'
+    data = RASTERS[name]
+    local_p = str(tmp_path / name)
+    ## A marker prefix that differs from the remote bytes shows the transfer resumed rather than restarted
+    with open('{}.part'.format(local_p), 'wb') as handle:
+        handle.write(b'\xff' * 1000)
+
+    pool = FTPPool(host='127.0.0.1', port=ftp_server, size=1)
+    try:
+        entry = download_file(pool, '/{}/{}'.format(MONTH_DIR, name), local_p, len(data))
+    finally:
+        pool.close()
+
+    with open(local_p, 'rb') as handle:
+        assert handle.read() == b'\xff' * 1000 + data[1000:]
+    assert entry == {'size': len(data), 'md5': md5sum(local_p)}
+    assert not os.path.exists('{}.part'.format(local_p))
+
+
+def test_download_empty_file(tmp_path, ftp_server):
+    local_p = str(tmp_path / 'empty.tif')
+    pool = FTPPool(host='127.0.0.1', port=ftp_server, size=1)
+    try:
+        entry = download_file(pool, '/{}/N_20190803_concentration_v3.0.tif'.format(MONTH_DIR), local_p, 0)
+    finally:
+        pool.close()
+
+    assert os.path.getsize(local_p) == 0
+    assert entry == {'size': 0, 'md5': hashlib.md5(b'').hexdigest()}
+
+
+class FailingFTP(object):
+    '''
+    Stand-in connection whose transfers raise the queued errors, then
+    write data.
+    '''
+    def __init__(self, errors, data):
+        self.errors = errors
+        self.data = data
+        self.transfers = 0
+
+
+    def retrbinary(self, cmd, callback, rest=None):
+        self.transfers += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        callback(self.data[rest or 0:])
+
+
+class FailingPool(object):
+    def __init__(self, ftp):
+        self.ftp = ftp
+
+
+    @contextmanager
+    def connection(self):
+        yield self.ftp
+
+
+def test_download_retries_temporary_errors(tmp_path):
+    ftp = FailingFTP([error_temp('421 Too many connections'), EOFError()], b'abc')
+    entry = download_file(FailingPool(ftp), '/N.tif', str(tmp_path / 'N.tif'), 3, retries=3)
+
+    assert ftp.transfers == 3
+    assert entry['size'] == 3
+
+
+def test_download_does_not_retry_permanent_errors(tmp_path):
+    ftp = FailingFTP([error_perm('550 No such file')], b'abc')
+    with pytest.raises(error_perm):
+        download_file(FailingPool(ftp), '/N.tif', str(tmp_path / 'N.tif'), 3, retries=3)
+
+    assert ftp.transfers == 1